@@ -0,0 +1,673 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Copyright  2016  Miguel Tremblay
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+
+# You should have received a copy of the GNU General Public License
+# along with this program; if not see  <http://www.gnu.org/licenses/>.
+############################################################################
+
+"""
+Name:        exif_rename_files_benchmark.py
+Description: Generate a synthetic corpus of images and time each stage of
+ exif_rename_files.py on it: listing, EXIF extraction, new path creation,
+ collision handling and copy. The results can be saved as a baseline and
+ compared with a later run to find the regressions.
+
+Notes: The corpus is generated offline, with a fixed seed, so two runs with
+ the same parameters process the same files.
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import struct
+import sys
+import tempfile
+import time
+import tracemalloc
+import zlib
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import exif_rename_files as erf
+
+# Layouts of the generated files, with their default weight in the corpus
+LAYOUTS = {
+    "jpeg-le": 40,  # APP1 Exif only, little endian
+    "jpeg-jfif-be": 25,  # APP0 JFIF then APP1 Exif, big endian
+    "jpeg-padded": 15,  # Many IFD0 tags before the Exif IFD pointer
+    "jpeg-no-exif": 5,  # APP0 JFIF only
+    "png-exif": 5,  # PNG with an eXIf chunk
+    "empty": 2,  # Zero-byte file, like example/input/empty_file.jpg
+    "mp4": 4,  # ftyp and moov/mvhd boxes only
+    "mts": 4,  # BDAV MPEG-2 transport stream packets with the MDPM date
+}
+VIDEO_LAYOUTS = ["mp4", "mts"]
+
+# Stages timed, in the order of the batch mode
+STAGES = [
+    "get_image_records",
+    "read_records_exif",
+    "create_records_new_path",
+    "get_unique_records_path",
+    "duplicate_images",
+]
+
+# Number of distinct image bodies, reused to keep the generation fast
+NBR_BODIES = 8
+# Seconds between 1904-01-01, the MP4 epoch, and 1970-01-01
+MP4_EPOCH_OFFSET = 2082844800
+# UUID of the H.264 user data holding the date of the AVCHD videos
+MDPM_UUID = bytes.fromhex("17ee8c60f84d11d98cd60800200c9a66")
+# Name of the file describing a generated corpus
+CORPUS_DESCRIPTION = "corpus.json"
+
+
+def build_tiff(sDate, sEndian, nPaddingTags=0):
+    """
+    Build a TIFF structure holding the date sDate in the DateTimeOriginal tag
+    of the Exif IFD. nPaddingTags SHORT tags are added in IFD0 before the
+    Exif IFD pointer.
+    """
+    nIfd0Offset = 8
+    nIfd0Size = 2 + 12 * (nPaddingTags + 1) + 4
+    nExifIfdOffset = nIfd0Offset + nIfd0Size
+    nDateOffset = nExifIfdOffset + 2 + 12 + 4
+    sDate = sDate.encode("ascii") + b"\x00"
+
+    if sEndian == "<":
+        sTiff = b"II*\x00"
+    else:
+        sTiff = b"MM\x00*"
+    sTiff += struct.pack(sEndian + "I", nIfd0Offset)
+    sTiff += struct.pack(sEndian + "H", nPaddingTags + 1)
+    for i in range(nPaddingTags):
+        sTiff += struct.pack(sEndian + "HHIHH", 0x0100 + i, 3, 1, i, 0)
+    sTiff += struct.pack(sEndian + "HHII", erf.TIFF_TAG_EXIF_IFD, 4, 1, nExifIfdOffset)
+    sTiff += struct.pack(sEndian + "I", 0)
+    sTiff += struct.pack(sEndian + "H", 1)
+    sTiff += struct.pack(
+        sEndian + "HHII", erf.TIFF_TAG_DATE_TIME_ORIGINAL, 2, len(sDate), nDateOffset
+    )
+    sTiff += struct.pack(sEndian + "I", 0)
+    return sTiff + sDate
+
+
+def build_jpeg_segment(nMarker, sData):
+    """
+    Build a JPEG segment with its marker and length.
+    """
+    return struct.pack(">BBH", 0xFF, nMarker, len(sData) + 2) + sData
+
+
+def build_png_chunk(sType, sData):
+    """
+    Build a PNG chunk with its length and CRC.
+    """
+    return (
+        struct.pack(">I", len(sData))
+        + sType
+        + sData
+        + struct.pack(">I", zlib.crc32(sType + sData) & 0xFFFFFFFF)
+    )
+
+
+def build_file(sLayout, sDate, sBody):
+    """
+    Return the content of a file of the layout sLayout, dated sDate
+    ("YYYY:MM:DD HH:MM:SS") and whose image data is sBody.
+    """
+    sJfif = build_jpeg_segment(0xE0, b"JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00")
+    sScan = build_jpeg_segment(0xDA, b"\x00" * 10) + sBody + b"\xff\xd9"
+    if sLayout == "jpeg-le":
+        sExif = build_jpeg_segment(0xE1, b"Exif\x00\x00" + build_tiff(sDate, "<"))
+        return b"\xff\xd8" + sExif + sScan
+    elif sLayout == "jpeg-jfif-be":
+        sExif = build_jpeg_segment(0xE1, b"Exif\x00\x00" + build_tiff(sDate, ">"))
+        return b"\xff\xd8" + sJfif + sExif + sScan
+    elif sLayout == "jpeg-padded":
+        sExif = build_jpeg_segment(
+            0xE1, b"Exif\x00\x00" + build_tiff(sDate, "<", nPaddingTags=64)
+        )
+        return b"\xff\xd8" + sJfif + sExif + sScan
+    elif sLayout == "jpeg-no-exif":
+        return b"\xff\xd8" + sJfif + sScan
+    elif sLayout == "png-exif":
+        return (
+            b"\x89PNG\r\n\x1a\n"
+            + build_png_chunk(b"IHDR", struct.pack(">IIBBBBB", 1, 1, 8, 0, 0, 0, 0))
+            + build_png_chunk(b"eXIf", build_tiff(sDate, ">"))
+            + build_png_chunk(b"IDAT", sBody)
+            + build_png_chunk(b"IEND", b"")
+        )
+    elif sLayout == "empty":
+        return b""
+    elif sLayout == "mp4":
+        nTime = (
+            int(
+                datetime.datetime.strptime(sDate, "%Y:%m:%d %H:%M:%S")
+                .replace(tzinfo=datetime.timezone.utc)
+                .timestamp()
+            )
+            + MP4_EPOCH_OFFSET
+        )
+        sMvhd = struct.pack(">I4sIIIII", 108, b"mvhd", 0, nTime, nTime, 1000, 0)
+        sMvhd += b"\x00" * (108 - len(sMvhd))
+        sFtyp = struct.pack(">I4s4sI4s", 20, b"ftyp", b"isom", 0x200, b"isom")
+        sMoov = struct.pack(">I4s", 8 + len(sMvhd), b"moov") + sMvhd
+        return sFtyp + sMoov
+    elif sLayout == "mts":
+        # H.264 SEI user data with the date in BCD, in a PES packet
+        sBcd = bytes.fromhex(re.sub("[^0-9]", "", sDate))
+        sMdpm = b"MDPM\x02\x18\x00" + sBcd[:3] + b"\x19" + sBcd[3:]
+        sSei = b"\x05" + bytes([16 + len(sMdpm)]) + MDPM_UUID + sMdpm + b"\x80"
+        # Emulation prevention bytes, as in a real H.264 stream
+        sSei = re.sub(b"\x00\x00([\x00-\x03])", b"\x00\x00\x03\\1", sSei)
+        sPes = b"\x00\x00\x01\xe0\x00\x00\x80\x00\x00\x00\x00\x00\x01\x06" + sSei
+        # 4-byte timestamp then a 188-byte packet starting with the sync byte
+        sVideo = b"\x00\x00\x00\x00\x47\x50\x11\x10" + sPes.ljust(184, b"\xff")
+        sNull = b"\x00\x00\x00\x00\x47\x1f\xff\x10" + b"\xff" * 184
+        return sVideo + sNull * 3
+    else:
+        raise ValueError("Unknown layout '%s'" % (sLayout))
+
+
+def get_extension(sLayout):
+    """
+    Return the file extension used for the layout sLayout.
+    """
+    if sLayout == "png-exif":
+        return "png"
+    elif sLayout == "mp4":
+        return "mp4"
+    elif sLayout == "mts":
+        return "MTS"
+    else:
+        return "JPG"
+
+
+def get_corpus_parameters(tOptions):
+    """
+    Return the parameters defining the corpus, stored with it so that a
+    corpus is only reused for the same parameters.
+    """
+    return {
+        "files": tOptions.Files,
+        "files_per_directory": tOptions.FilesPerDirectory,
+        "depth": tOptions.Depth,
+        "collision_ratio": tOptions.CollisionRatio,
+        "image_size": tOptions.ImageSize,
+        "videos": tOptions.Videos,
+        "seed": tOptions.Seed,
+    }
+
+
+def generate_corpus(sInputDirectory, dParameters):
+    """
+    Generate the synthetic corpus described by dParameters in the directory
+    sInputDirectory. The files are spread in a tree of directories of the
+    given depth. A fraction collision_ratio of the files take their date in a
+    small set of dates, giving many files with the same second.
+    """
+    oRandom = random.Random(dParameters["seed"])
+    lBodies = [
+        bytes(oRandom.getrandbits(8) for _ in range(dParameters["image_size"]))
+        for _ in range(NBR_BODIES)
+    ]
+    lLayouts = [s for s in LAYOUTS if dParameters["videos"] or s not in VIDEO_LAYOUTS]
+    lWeights = [LAYOUTS[s] for s in lLayouts]
+    oStart = datetime.datetime(2015, 1, 1)
+    nSpan = 5 * 365 * 24 * 3600
+    nFiles = dParameters["files"]
+    lBurstDates = [
+        oStart + datetime.timedelta(seconds=oRandom.randrange(nSpan))
+        for _ in range(max(1, nFiles // 50))
+    ]
+
+    for i in range(nFiles):
+        # Directory of the file: one directory per files_per_directory files
+        nDirectory = i // dParameters["files_per_directory"]
+        lParts = []
+        for _ in range(dParameters["depth"]):
+            lParts.append("d%02d" % (nDirectory % 16))
+            nDirectory = nDirectory // 16
+        sDirectory = os.path.join(sInputDirectory, *lParts)
+        if not os.path.isdir(sDirectory):
+            os.makedirs(sDirectory)
+
+        if oRandom.random() < dParameters["collision_ratio"]:
+            oDate = oRandom.choice(lBurstDates)
+        else:
+            oDate = oStart + datetime.timedelta(seconds=oRandom.randrange(nSpan))
+        sLayout = oRandom.choices(lLayouts, lWeights)[0]
+        sContent = build_file(
+            sLayout, oDate.strftime("%Y:%m:%d %H:%M:%S"), oRandom.choice(lBodies)
+        )
+        sPath = os.path.join(sDirectory, "DSC%07d.%s" % (i, get_extension(sLayout)))
+        with open(sPath, "wb") as f:
+            f.write(sContent)
+
+
+def prepare_corpus(sCorpusDirectory, dParameters):
+    """
+    Generate the corpus in sCorpusDirectory, unless a corpus with the same
+    parameters is already there. Return the input directory of the corpus.
+    """
+    sInputDirectory = os.path.join(sCorpusDirectory, "input")
+    sDescription = os.path.join(sCorpusDirectory, CORPUS_DESCRIPTION)
+    if os.path.exists(sDescription):
+        with open(sDescription) as f:
+            if json.load(f) == dParameters:
+                print("Reusing the corpus in '%s'" % (sCorpusDirectory))
+                return sInputDirectory
+        shutil.rmtree(sInputDirectory, ignore_errors=True)
+
+    print("Generating %s files in '%s'" % (dParameters["files"], sCorpusDirectory))
+    nStart = time.perf_counter()
+    generate_corpus(sInputDirectory, dParameters)
+    with open(sDescription, "w") as f:
+        json.dump(dParameters, f, indent=2)
+    print("Corpus generated in %.1f s" % (time.perf_counter() - nStart))
+
+    return sInputDirectory
+
+
+def get_rename_options(sInputDirectory, sOutputDirectory, tOptions):
+    """
+    Return the options given to exif_rename_files for the benchmark: a
+    recursive copy in sOutputDirectory.
+    """
+    return erf.get_default_options(
+        [sInputDirectory],
+        OutputDirectory=sOutputDirectory,
+        DateDirectory=tOptions.DateDirectory,
+        Recursive=True,
+        CpNoExif=True,
+        Jobs=tOptions.Jobs,
+        JobsBackend=tOptions.JobsBackend,
+        CopyJobs=tOptions.CopyJobs,
+    )
+
+
+def run_stages(tRenameOptions, bTraceMemory=False):
+    """
+    Run the stages of the batch mode one after the other. Return a
+    dictionnary with, for each stage, a tuple (number of files processed,
+    seconds, peak memory in kB during the stage or None). The peak memory is
+    measured only if bTraceMemory is True, with tracemalloc, which slows the
+    stages down: it is the largest memory allocated by Python in this process
+    during the stage, including what the previous stages still hold.
+    """
+    dTimes = {}
+
+    def time_stage(sStage, nFiles, fStage, *args):
+        nPeak = None
+        if bTraceMemory:
+            tracemalloc.reset_peak()
+        nStart = time.perf_counter()
+        result = fStage(*args)
+        nSeconds = time.perf_counter() - nStart
+        if bTraceMemory:
+            nPeak = tracemalloc.get_traced_memory()[1] // 1024
+        dTimes[sStage] = (nFiles, nSeconds, nPeak)
+        return result
+
+    lRecords = time_stage("get_image_records", 0, erf.get_image_records, tRenameOptions)
+    nFound = len(lRecords)
+    dTimes["get_image_records"] = (nFound,) + dTimes["get_image_records"][1:]
+    lRecords = time_stage(
+        "read_records_exif",
+        nFound,
+        lambda: erf.read_records_exif(erf.sort_records(lRecords), tRenameOptions),
+    )
+    lRecords = time_stage(
+        "create_records_new_path",
+        len(lRecords),
+        erf.create_records_new_path,
+        lRecords,
+        tRenameOptions,
+    )
+    dIndex = {}
+    lRecords = time_stage(
+        "get_unique_records_path",
+        len(lRecords),
+        erf.get_unique_records_path,
+        lRecords,
+        dIndex,
+    )
+    time_stage(
+        "duplicate_images",
+        len(lRecords),
+        erf.duplicate_images,
+        erf.RecordPaths(lRecords),
+        tRenameOptions,
+        dIndex,
+        erf.has_chained_records(lRecords),
+    )
+
+    return dTimes
+
+
+def run_stages_once(tRenameOptions, sOutputDirectory, bTraceMemory=False):
+    """
+    Run the stages with run_stages, starting from an empty output directory
+    sOutputDirectory, and return their times.
+    """
+    shutil.rmtree(sOutputDirectory, ignore_errors=True)
+    os.makedirs(sOutputDirectory)
+    with open(os.devnull, "w") as fNull:
+        with contextlib.redirect_stdout(fNull):
+            if bTraceMemory:
+                tracemalloc.start()
+            try:
+                return run_stages(tRenameOptions, bTraceMemory)
+            finally:
+                if bTraceMemory:
+                    tracemalloc.stop()
+                erf.stop_exiftool()
+
+
+def benchmark(sInputDirectory, sOutputDirectory, tOptions):
+    """
+    Run the stages tOptions.Repeat times, starting from an empty output
+    directory each time, and keep the best time of each stage. The peak
+    memory of each stage is measured by one more run, not timed. Return the
+    results as a dictionnary ready to be saved in JSON.
+    """
+    tRenameOptions = get_rename_options(sInputDirectory, sOutputDirectory, tOptions)
+    dBest = {}
+    for i in range(tOptions.Repeat):
+        dTimes = run_stages_once(tRenameOptions, sOutputDirectory)
+        for sStage, tTime in dTimes.items():
+            if sStage not in dBest or tTime[1] < dBest[sStage][1]:
+                dBest[sStage] = tTime
+    dMemory = run_stages_once(tRenameOptions, sOutputDirectory, True)
+    shutil.rmtree(sOutputDirectory, ignore_errors=True)
+
+    dStages = {}
+    for sStage in STAGES:
+        nFiles, nSeconds = dBest[sStage][:2]
+        dStages[sStage] = {
+            "files": nFiles,
+            "seconds": round(nSeconds, 6),
+            "files_per_second": round(nFiles / nSeconds, 1) if nSeconds > 0 else None,
+            "peak_memory_kb": dMemory[sStage][2],
+        }
+
+    return {
+        "corpus": get_corpus_parameters(tOptions),
+        "settings": {
+            "jobs": tOptions.Jobs,
+            "jobs_backend": tOptions.JobsBackend,
+            "copy_jobs": tOptions.CopyJobs,
+            "date_subdirs": tOptions.DateDirectory,
+            "repeat": tOptions.Repeat,
+        },
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "stages": dStages,
+    }
+
+
+def print_results(dResults):
+    """
+    Print the results of the benchmark as a table.
+    """
+    print(
+        "%-28s %10s %10s %12s %12s"
+        % ("Stage", "Files", "Seconds", "Files/s", "Peak mem kB")
+    )
+    for sStage in STAGES:
+        dStage = dResults["stages"][sStage]
+        print(
+            "%-28s %10s %10.3f %12s %12s"
+            % (
+                sStage,
+                dStage["files"],
+                dStage["seconds"],
+                dStage["files_per_second"],
+                dStage["peak_memory_kb"],
+            )
+        )
+
+
+def compare_with_baseline(dResults, dBaseline, nTolerance):
+    """
+    Compare the files/s of each stage with the baseline. A stage slower than
+    the baseline by more than the fraction nTolerance is a regression.
+    Return the number of regressions.
+    """
+    for sKey in ["corpus", "settings"]:
+        if dResults[sKey] != dBaseline.get(sKey):
+            print(
+                "Warning: the %s of the baseline differ from this run, the comparison may not be meaningful"
+                % (sKey)
+            )
+
+    nRegressions = 0
+    print("%-28s %12s %12s %8s" % ("Stage", "Baseline", "Files/s", "Change"))
+    for sStage in STAGES:
+        nCurrent = dResults["stages"][sStage]["files_per_second"]
+        nReference = dBaseline["stages"].get(sStage, {}).get("files_per_second")
+        if not nCurrent or not nReference:
+            print("%-28s %12s %12s %8s" % (sStage, nReference, nCurrent, "n/a"))
+            continue
+        nChange = nCurrent / nReference - 1
+        sStatus = ""
+        if nChange < -nTolerance:
+            sStatus = " REGRESSION"
+            nRegressions = nRegressions + 1
+        print(
+            "%-28s %12s %12s %+7.1f%%%s"
+            % (sStage, nReference, nCurrent, 100 * nChange, sStatus)
+        )
+
+    return nRegressions
+
+
+def get_command_line():
+    """
+    Parse the command line and perform all the checks.
+    """
+
+    parser = argparse.ArgumentParser(
+        prog="PROG",
+        prefix_chars="-",
+        description="Time each stage of exif_rename_files.py on a synthetic corpus",
+    )
+    parser.add_argument(
+        "--files",
+        dest="Files",
+        help="Number of files in the corpus",
+        action="store",
+        type=int,
+        default=10000,
+    )
+    parser.add_argument(
+        "--files-per-directory",
+        dest="FilesPerDirectory",
+        help="Number of files in each directory of the corpus",
+        action="store",
+        type=int,
+        default=500,
+    )
+    parser.add_argument(
+        "--depth",
+        dest="Depth",
+        help="Depth of the directory tree of the corpus",
+        action="store",
+        type=int,
+        default=2,
+    )
+    parser.add_argument(
+        "--collision-ratio",
+        dest="CollisionRatio",
+        help="Fraction of the files sharing their date with many other files",
+        action="store",
+        type=float,
+        default=0.3,
+    )
+    parser.add_argument(
+        "--image-size",
+        dest="ImageSize",
+        help="Size in bytes of the image data of each file",
+        action="store",
+        type=int,
+        default=16384,
+    )
+    parser.add_argument(
+        "--no-videos",
+        dest="Videos",
+        help="Do not put MP4 and MTS files in the corpus",
+        action="store_false",
+        default=True,
+    )
+    parser.add_argument(
+        "--seed",
+        dest="Seed",
+        help="Seed of the random generator of the corpus",
+        action="store",
+        type=int,
+        default=0,
+    )
+    parser.add_argument(
+        "--corpus-directory",
+        dest="CorpusDirectory",
+        help="Directory where the corpus is generated and kept for the next runs. A temporary directory is used if not provided",
+        action="store",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        dest="Jobs",
+        help="Value of '--jobs' given to exif_rename_files.py",
+        action="store",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--jobs-backend",
+        dest="JobsBackend",
+        help="Value of '--jobs-backend' given to exif_rename_files.py",
+        action="store",
+        choices=["thread", "process", "asyncio"],
+        default="thread",
+    )
+    parser.add_argument(
+        "--copy-jobs",
+        dest="CopyJobs",
+        help="Value of '--copy-jobs' given to exif_rename_files.py",
+        action="store",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--date-subdirs",
+        dest="DateDirectory",
+        help="Write the files in subdirectories according to their date",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--repeat",
+        dest="Repeat",
+        help="Number of runs, the best time of each stage is kept",
+        action="store",
+        type=int,
+        default=3,
+    )
+    parser.add_argument(
+        "--save-baseline",
+        dest="SaveBaseline",
+        help="Save the results in this JSON file",
+        action="store",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--compare",
+        dest="Compare",
+        help="Compare the results with the baseline saved in this JSON file. Exit with status 1 on a regression",
+        action="store",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--tolerance",
+        dest="Tolerance",
+        help="Fraction of files/s a stage can lose before being reported as a regression",
+        action="store",
+        type=float,
+        default=0.2,
+    )
+
+    # Parse the args
+    options = parser.parse_args()
+
+    if options.Files < 1 or options.FilesPerDirectory < 1 or options.Repeat < 1:
+        print(
+            "Error: options '--files', '--files-per-directory' and '--repeat' should be positive. Exiting."
+        )
+        exit(2)
+
+    return options
+
+
+def main():
+    tOptions = get_command_line()
+    # exif_rename_files sets its verbosity in its own command line parsing,
+    # which also silences the warnings of exifread about the files with no
+    # EXIF, like the empty ones
+    erf.set_verbosity(erf.NORMAL)
+
+    if tOptions.CorpusDirectory is None:
+        sCorpusDirectory = tempfile.mkdtemp(prefix="exif_rename_files_benchmark_")
+    else:
+        sCorpusDirectory = tOptions.CorpusDirectory
+    try:
+        sInputDirectory = prepare_corpus(
+            sCorpusDirectory, get_corpus_parameters(tOptions)
+        )
+        dResults = benchmark(
+            sInputDirectory, os.path.join(sCorpusDirectory, "output"), tOptions
+        )
+    finally:
+        if tOptions.CorpusDirectory is None:
+            shutil.rmtree(sCorpusDirectory, ignore_errors=True)
+
+    print_results(dResults)
+
+    if tOptions.SaveBaseline is not None:
+        with open(tOptions.SaveBaseline, "w") as f:
+            json.dump(dResults, f, indent=2)
+        print("Baseline saved in '%s'" % (tOptions.SaveBaseline))
+
+    if tOptions.Compare is not None:
+        with open(tOptions.Compare) as f:
+            dBaseline = json.load(f)
+        nRegressions = compare_with_baseline(dResults, dBaseline, tOptions.Tolerance)
+        if nRegressions > 0:
+            print("%s stage(s) slower than the baseline" % (nRegressions))
+            exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -29,25 +29,250 @@ Date: January 24th 2016
 """
 
 import argparse
+import array
+import binascii
+import collections
+import concurrent.futures
+import contextlib
+import datetime
+import errno
+import functools
+import hashlib
+import heapq
+import io
+import json
+import logging
+import operator
 import sys
 import os
+import posixpath
+import queue
 import re
+import select
 import stat
 import shutil
+import struct
+import tempfile
+import threading
+import time
 
-import exifread
-import exiftool
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+# exifread, piexif, exiftool, asyncio, sqlite3, ctypes, zipfile and tarfile
+# are imported when first needed, so a run which does not need them does not pay for their import
 
 VERSION = "1.0"
-FILETYPE = ["jpg", "JPG", "jpeg", "png", "PNG", "MTS", "AVI", "m2ts", "mp4"]
-VIDEOTYPE = ["MTS", "AVI", "m2ts", "mp4"]
+FILETYPE = [
+    "jpg",
+    "JPG",
+    "jpeg",
+    "png",
+    "PNG",
+    "MTS",
+    "AVI",
+    "m2ts",
+    "mp4",
+    "MOV",
+    "mov",
+]
+VIDEOTYPE = ["MTS", "AVI", "m2ts", "mp4", "MOV", "mov"]
+FILETYPE_SET = frozenset(FILETYPE)
 # Verbose level:
+# 0 Quiet, used by the library (see iter_rename_files)
 # 1 Normal mode
 # 2 Full debug
+QUIET = 0
 NORMAL = 1
 VERBOSE = 2
 
 NGLOBALVERBOSITY = 1
+nGlobalVerbosity = NGLOBALVERBOSITY
+
+# Number of video files given at once to the ExifTool process
+VIDEO_BATCH_SIZE = 64
+
+# ExifTool process shared by all the video files of the run
+oGlobalExifTool = None
+
+# TIFF tags followed by the header reader
+TIFF_TAG_EXIF_IFD = 0x8769
+TIFF_TAG_DATE_TIME_ORIGINAL = 0x9003
+# Upper bound of the number of entries of a valid IFD
+TIFF_MAX_IFD_ENTRIES = 1024
+# Number of bytes read at once at the beginning of an image by the asyncio
+# workers, enough to reach the EXIF date of most of the images
+HEADER_READ_SIZE = 64 * 1024
+# Largest number of threads of the asyncio workers making the blocking calls
+ASYNC_READ_THREADS = 8
+# Origin of the times of the MP4 and QuickTime headers
+MP4_EPOCH = datetime.datetime(1904, 1, 1)
+# Number of bytes of an AVCHD video searched for its recording date, which
+# is sent with the first frames
+MTS_READ_SIZE = 1024 * 1024
+# Number of transport stream packets read at once
+MTS_READ_PACKETS = 256
+# Transport stream packets with no data
+MTS_NULL_PID = 0x1FFF
+# Upper bound of the size of a MDPM user data: up to 255 entries of 5 bytes,
+# possibly with emulation prevention bytes
+MDPM_MAX_SIZE = 2048
+# Tags of the MDPM entries holding the recording date
+MDPM_TAG_DATE = 0x18
+MDPM_TAG_TIME = 0x19
+
+# Backends reading the files of each type, in this order, when no backend is
+# chosen with --backend or when the chosen one cannot read a file
+DEFAULT_IMAGE_BACKENDS = ["native", "exifread"]
+DEFAULT_VIDEO_BACKENDS = ["native", "exiftool"]
+# Number of files of each type read by each backend to choose the fastest
+# one with --backend auto
+BACKEND_SAMPLE_SIZE = 8
+# Backends reading the EXIF date, by name, see register_backend
+BACKENDS = {}
+# Backend chosen for the files of each extension during the run, None for
+# the default backends
+dGlobalBackends = {}
+
+# Extensions of the archives whose images are read without unpacking them
+ARCHIVE_EXTENSIONS = (".zip", ".tar")
+# Archives opened by each thread, see get_archive_members
+oGlobalArchives = threading.local()
+
+# Metadata cache kept between the runs, opened with open_cache
+oGlobalCache = None
+# Path of the cache open, kept open between the runs of the library
+sGlobalCachePath = None
+# Default maximum number of files kept in the cache
+CACHE_MAX_ENTRIES = 1000000
+# Version of the way the dates are read, the dates of the files cached by
+# another version are read again
+CACHE_READER_VERSION = "2"
+# The cache is shared by the stages of the streaming mode
+oGlobalCacheLock = threading.Lock()
+
+# EXIF date stored as the integer YYYYMMDDhhmmss by encode_exif_date
+EXIF_DATE_FORMAT = re.compile(r"^(\d{4}):(\d\d):(\d\d) (\d\d):(\d\d):(\d\d)$")
+# Number of images of the default mode given at once to the EXIF extraction
+RECORD_CHUNK_SIZE = 1024
+# Number of images read together with --disk-order, sorted by their
+# position on the disk
+DISK_ORDER_CHUNK_SIZE = 64 * 1024
+
+# Name with a collision suffix: root, suffix number and extension
+COLLISION_SUFFIX = re.compile(r"^(.*)_(\d+)(\.[^.]*)$")
+
+# Fields of the layouts of the date subdirectories (see --date-layout), from
+# the largest to the smallest, and the layout used by --date-subdirs alone
+DATE_LAYOUT_FIELDS = ("YYYY", "MM", "DD", "HH")
+DATE_LAYOUT_PATTERN = re.compile("|".join(DATE_LAYOUT_FIELDS))
+DEFAULT_DATE_LAYOUT = "YYYY/MM"
+# Subdirectory of the date subdirectories where the images with no EXIF go
+NO_EXIF_DIRECTORY = "NoExif/"
+
+# Name given by the script to an image of a library (see --against): date,
+# collision suffix and extension
+LIBRARY_NAME = re.compile(r"^(\d{4}-\d\d-\d\d_\d\d-\d\d-\d\d)(?:_(\d+))?(\.[^.]*)$")
+
+# Size of the blocks copied at once by the kernel, or read and written
+COPY_BLOCK_SIZE = 8 * 1024 * 1024
+# Number of bytes read at the beginning of the files to tell if they differ,
+# before reading them completely
+DEDUPE_HEAD_SIZE = 64 * 1024
+# Limits of the run (see --max-read-mbps, --max-write-mbps and
+# --max-files-per-sec), None if it is not throttled
+oGlobalThrottle = None
+# Options of the limits in the throttle control file, with the number of
+# bytes or files per second of their unit
+THROTTLE_CONTROLS = {
+    "read": ("max_read_mbps", 1000000),
+    "write": ("max_write_mbps", 1000000),
+    "files": ("max_files_per_sec", 1),
+}
+# Seconds between two checks of the throttle control file
+THROTTLE_CONTROL_INTERVAL = 1.0
+# Size of the blocks copied when the run is throttled, so that the copies
+# are spread over time
+THROTTLE_BLOCK_SIZE = 1024 * 1024
+# Verification of the copies of the run (see --verify and open_verify):
+# None, or a dictionnary with the manifest file, or None, and its lock
+dGlobalVerify = None
+
+# Number of copies submitted in advance to each copy worker
+COPY_AHEAD = 16
+# ioctl cloning a file on the filesystems supporting it (Btrfs, XFS)
+FICLONE = 0x40049409
+# ioctl giving the physical extents of a file, with the sizes of its
+# request header and of an extent (see linux/fiemap.h)
+FS_IOC_FIEMAP = 0xC020660B
+FIEMAP_HEADER_SIZE = 32
+FIEMAP_EXTENT_SIZE = 56
+# Errors meaning that a copy method is not available for this pair of files
+COPY_UNSUPPORTED_ERRORS = (
+    errno.EXDEV,
+    errno.ENOSYS,
+    errno.EINVAL,
+    errno.EOPNOTSUPP,
+    errno.ENOTSUP,
+    errno.EBADF,
+    errno.EPERM,
+)
+
+# Seconds between two checks of the watched directories. A file is
+# processed once its size and time did not change during this delay, when
+# inotify cannot tell that it was closed.
+WATCH_POLL_INTERVAL = 1.0
+# inotify events used by the watch mode (see inotify(7))
+IN_CLOSE_WRITE = 0x8
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_Q_OVERFLOW = 0x4000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+# Statistics of the run, collected with --stats (see open_stats)
+dGlobalStats = None
+# Function receiving the events of the run (see emit_event), None if nobody
+# listens
+fGlobalEventSink = None
+# Only one run at a time uses the global state of the module
+oGlobalRunLock = threading.Lock()
+# The statistics are updated by the stages of the streaming mode
+oGlobalStatsLock = threading.Lock()
+# Percentiles of the extraction latency given in the statistics
+STATS_PERCENTILES = [50, 90, 99]
+# Minimum seconds between two updates of the progress line
+PROGRESS_INTERVAL = 0.5
+
+# Number of entries of a plan applied between two synchronizations of the
+# destination directories and of the journal on disk
+PLAN_SYNC_BATCH = 256
+# Number of conflicts listed when the plans of the shards are merged
+MERGE_MAX_CONFLICTS = 20
+
+# Number of files passed at once between the stages of the streaming mode
+STREAM_CHUNK_SIZE = 64
+# Maximum number of chunks waiting between two stages of the streaming mode
+STREAM_QUEUE_SIZE = 16
+
+
+class ExifRenameError(Exception):
+    """
+    Error stopping a run. The command line prints it and exits with the
+    status nExitCode.
+    """
+
+    def __init__(self, sMessage, nExitCode=1):
+        Exception.__init__(self, sMessage)
+        self.nExitCode = nExitCode
+
+
+class RunStopped(Exception):
+    """
+    Raised in the run when the reader of its events stopped reading them.
+    """
 
 
 def my_print(sMessage, nMessageVerbosity=NORMAL):
@@ -55,344 +280,4948 @@ def my_print(sMessage, nMessageVerbosity=NORMAL):
     Use this method to write the message in the standart output
     """
 
-    if nMessageVerbosity == NORMAL:
-        print(sMessage)
-    elif nMessageVerbosity == VERBOSE and nGlobalVerbosity == VERBOSE:
+    if nMessageVerbosity <= nGlobalVerbosity:
         print(sMessage)
 
 
-def get_images_path_directory(sDirectory, bRecursive):
+def set_verbosity(nVerbosity):
     """
-    Get the images path in target directory and stores it into a list.
+    Set the verbosity of the messages of the run: QUIET, NORMAL or VERBOSE.
     """
-    lPathImages = []
-
-    # Check if the directory exists
-    if not os.path.exists(sDirectory):
-        my_print("Directory '" + sDirectory + "' does not exists! Skipping.")
+    global nGlobalVerbosity
+    nGlobalVerbosity = nVerbosity
+    if nVerbosity != VERBOSE:
+        # exifread warns about each file it cannot read, like the empty ones
+        logging.getLogger("exifread").setLevel(logging.ERROR)
+    else:
+        logging.getLogger("exifread").setLevel(logging.NOTSET)
 
-    # If the recursivity is not asked, simply list the files in the directory
-    # Took the recipe here: http://ur1.ca/ogdez
-    my_print("Looking for image files with extension in: " + str(FILETYPE), VERBOSE)
-    if not bRecursive:
-        for file in os.listdir(sDirectory):
-            sExtension = os.path.splitext(file)[1][1:]
-            if sExtension in FILETYPE:
-                lPathImages.append(os.path.join(sDirectory, file))
-    else:  # Walk the directories
-        for root, dirs, files in os.walk(sDirectory):
-            for file in files:
-                sExtension = os.path.splitext(file)[1][1:]
-                if sExtension in FILETYPE:
-                    lPathImages.append(os.path.join(root, file))
 
-    return lPathImages
+def emit_event(sEvent, **dFields):
+    """
+    Send the event sEvent of the run, with its fields dFields, to the
+    function listening to the events, if any. See iter_rename_files.
+    """
+    if fGlobalEventSink is not None:
+        dFields["event"] = sEvent
+        fGlobalEventSink(dFields)
 
 
-def get_images_path(tOptions):
+def emit_file_event(sOldPath, sNewPath, sMode, bDryRun=False):
     """
-    Get the images path in directory and stores it into a list.
+    Send the event of an image given its new path: sMode is "Copy", "Move"
+    or "Link", and bDryRun tells if nothing was done.
     """
-    lPathImages = []
-    dPathImage = {}  # Key is the path, value is the original directory in the input
-    # Check if the directory exists
-    for sPath in tOptions.Input:
-        # If input is a directory and it does not exist, we skip it
-        if os.path.isdir(sPath):
-            lPathDirectory = get_images_path_directory(sPath, tOptions.Recursive)
-            for sImage in lPathDirectory:
-                dPathImage[sImage] = sPath
-        elif os.path.isfile(sPath):
-            sExtension = os.path.splitext(sPath)[1][1:]
-            if sExtension in FILETYPE:
-                dPathImage[sPath] = sPath
+    emit_event(
+        "file",
+        source=sOldPath,
+        destination=sNewPath,
+        action=sMode.lower(),
+        dry_run=bDryRun,
+    )
+
 
-    return dPathImage
+def open_stats():
+    """
+    Start collecting the statistics of the run: time, files and bytes of each
+    phase, extraction latency and errors.
+    """
+    global dGlobalStats
+    dGlobalStats = {
+        "start": (time.perf_counter(), time.process_time()),
+        "phases": {},
+        "latency": {"image": array.array("d"), "video": array.array("d")},
+        "errors": {},
+    }
 
 
-def get_images_with_exif(lPathImages, bCpImageNoExif=False):
+@contextlib.contextmanager
+def measure_phase(sPhase, fCpuTime=time.process_time):
     """
-    Inspect the images in list and return a dictionnary including:
-    * key: image path
-    * value: EXIF DateTimeOriginal
+    Add the wall and CPU time spent in the with block to the phase sPhase of
+    the statistics. fCpuTime gives the CPU time: the one of the process by
+    default, the one of the current thread for the stages running at the
+    same time.
     """
+    if dGlobalStats is None:
+        yield
+        return
+    nWallStart = time.perf_counter()
+    nCpuStart = fCpuTime()
+    try:
+        yield
+    finally:
+        with oGlobalStatsLock:
+            dPhase = get_stats_phase(sPhase)
+            dPhase["wall_seconds"] += time.perf_counter() - nWallStart
+            dPhase["cpu_seconds"] += fCpuTime() - nCpuStart
 
-    # Check if the image contain exif information
-    nNbrImages = len(lPathImages)
-    my_print("%s images found" % (nNbrImages), VERBOSE)
-    my_print("----", nMessageVerbosity=VERBOSE)
-    my_print("Getting EXIF information from files", VERBOSE)
 
-    lPathImages.sort()
-    dExif = {}
-    i = 1
-    for sImagePath in lPathImages:
-        my_print(
-            "Extraction EXIF from %s/%s: %s\r"
-            % (i, nNbrImages, os.path.basename(sImagePath))
-        )
-        i = i + 1
-        f = open(sImagePath, "rb")
-        try:
-            if os.path.splitext(sImagePath)[1][1:] in VIDEOTYPE:
-                with exiftool.ExifToolHelper() as et:
-                    tags = et.get_metadata(sImagePath)[0]
-            else:
-                tags = exifread.process_file(f, strict=False)
-            if "EXIF DateTimeOriginal" in tags:
-                sExifDate = str(tags["EXIF DateTimeOriginal"])
-            else:
-                sExifDate = str(tags["File:FileModifyDate"]).split("+")[0]
-            # print(sExifDate)
-            dExif[sImagePath] = sExifDate
-        except KeyError as inst:
-            my_print("No EXIF information found in file '" + sImagePath + "'", VERBOSE)
-            if bCpImageNoExif:
-                dExif[sImagePath] = None
-            else:
-                my_print("Skipping.", VERBOSE)
-        except MemoryError:
-            my_print("Unknown error reading EXIF of '" + sImagePath + "'", VERBOSE)
-            my_print("Using this image as no EXIF is present", VERBOSE)
-            if bCpImageNoExif:
-                dExif[sImagePath] = None
-            else:
-                my_print("Skipping.", VERBOSE)
+def get_stats_phase(sPhase):
+    """
+    Return the statistics of the phase sPhase, creating them if needed.
+    """
+    return dGlobalStats["phases"].setdefault(
+        sPhase, {"wall_seconds": 0.0, "cpu_seconds": 0.0, "files": 0, "bytes": 0}
+    )
 
-        my_print("----", VERBOSE)
 
-    return dExif
+def count_in_stats(sPhase, nFiles, nBytes=0):
+    """
+    Add nFiles files and nBytes bytes to those processed by the phase sPhase.
+    """
+    if dGlobalStats is None:
+        return
+    with oGlobalStatsLock:
+        dPhase = get_stats_phase(sPhase)
+        dPhase["files"] += nFiles
+        dPhase["bytes"] += nBytes
 
 
-def create_path_with_exif(sPath, sExif, bCpImageNoExif, useDateDirectory=False):
+def record_latency(sPath, nSeconds):
     """
-    Create a file path with the exif date.
+    Record the time taken to extract the date of the file sPath, with the
+    videos or with the images depending on its type, whatever read it.
+    """
+    if dGlobalStats is None:
+        return
+    if get_extension(sPath) in VIDEOTYPE:
+        sType = "video"
+    else:
+        sType = "image"
+    with oGlobalStatsLock:
+        dGlobalStats["latency"][sType].append(nSeconds)
 
-    sPath is the original image filename.
-    sExif is the exif of the image.
-    Returns the same directory as sPath, but with the filename replaced by
-    the date values of the EXIF string.
+
+def record_error(sError, sPath=None):
     """
-    sExtension = (os.path.splitext(sPath)[1]).lower()
-    if sExif is not None:
-        sNewFileName = sExif.replace(":", "-").replace(" ", "_") + sExtension
+    Count one more occurence of the error path sError, on the file sPath if
+    known.
+    """
+    emit_event("error", error=sError, path=sPath)
+    if dGlobalStats is None:
+        return
+    with oGlobalStatsLock:
+        dGlobalStats["errors"][sError] = dGlobalStats["errors"].get(sError, 0) + 1
 
-        if useDateDirectory:
-            splitFileName = re.split("-|_", sNewFileName)
-            for i in range(1, -1, -1):
-                sNewFileName = splitFileName[i] + "/" + sNewFileName
-            sPathNew = sNewFileName
-        else:
-            sPathNew = os.path.join(os.path.dirname(sPath), sNewFileName)
 
-        # Check if the file are not already been renamed correctly
-        if sPathNew == sPath:
-            my_print(
-                "Warning: File is already in the right format. Skipping '%s'" % (sPath),
-                VERBOSE,
+def get_stats_summary():
+    """
+    Return the statistics of the run as a dictionnary ready to be written in
+    JSON. The latencies are given in milliseconds.
+    """
+    nWallStart, nCpuStart = dGlobalStats["start"]
+    dLatency = {}
+    for sType, aLatency in dGlobalStats["latency"].items():
+        lSorted = sorted(aLatency)
+        dType = {"count": len(lSorted)}
+        if len(lSorted) > 0:
+            for nPercentile in STATS_PERCENTILES:
+                nRank = min(len(lSorted) - 1, len(lSorted) * nPercentile // 100)
+                dType["p%s_ms" % (nPercentile)] = round(1000 * lSorted[nRank], 3)
+            dType["max_ms"] = round(1000 * lSorted[-1], 3)
+        dLatency[sType] = dType
+
+    dPhases = {}
+    for sPhase, dPhase in dGlobalStats["phases"].items():
+        dPhases[sPhase] = dict(dPhase)
+        dPhases[sPhase]["wall_seconds"] = round(dPhase["wall_seconds"], 6)
+        dPhases[sPhase]["cpu_seconds"] = round(dPhase["cpu_seconds"], 6)
+        if dPhase["wall_seconds"] > 0:
+            dPhases[sPhase]["files_per_second"] = round(
+                dPhase["files"] / dPhase["wall_seconds"], 1
             )
-    elif bCpImageNoExif:
-        if useDateDirectory:
-            sPathNew = "NoExif/" + os.path.basename(sPath)
-        else:
-            sPathNew = sPath
 
-    return sPathNew
+    return {
+        "wall_seconds": round(time.perf_counter() - nWallStart, 6),
+        "cpu_seconds": round(time.process_time() - nCpuStart, 6),
+        "phases": dPhases,
+        "extraction_latency": dLatency,
+        "errors": dGlobalStats["errors"],
+    }
 
 
-def create_new_image_path(dExif, dInputDirectory, tOptions):
+def write_stats(sStatsPath):
     """
-    Based on the input path, the Exif information and the options, create the new path
-    for the images.
+    Write the statistics of the run in JSON in the file sStatsPath, or in the
+    standard output if sStatsPath is "-".
     """
+    sStats = json.dumps(get_stats_summary(), indent=2)
+    if sStatsPath == "-":
+        print(sStats)
+    else:
+        with open(sStatsPath, "w") as f:
+            f.write(sStats + "\n")
 
-    lPathOld = list(dExif.keys())
-    lPathOld.sort()
-    dNewPathRaw = {}
-    # If there is no destination, the images are copy/overwritten
-    # in the same directory than the input
-    if tOptions.OutputDirectory is None:
-        for sPathOld in lPathOld:
-            sPathNew = create_path_with_exif(
-                sPathOld, dExif[sPathOld], tOptions.CpNoExif
-            )
-            if sPathNew is not None:
-                dNewPathRaw[sPathOld] = sPathNew
-    elif tOptions.CopyTree:  # Recreate the same tree in the output
-        for sPathOld in lPathOld:
-            # Use the provided input directory stored in dInputDirectory
-            #  for each image file.
-            #  Remove this first part of the input directory,
-            #   leaving only the part to be created.
-            sDirToRemove = os.path.dirname(dInputDirectory[sPathOld])
-            # "1" in "[1:]" is used to remove the first "/",
-            #  so the path can be merged (see http://ur1.ca/ogdev)
-            sSubDirectory = os.path.dirname(sPathOld).replace(sDirToRemove, "")[1:]
-            sNewDirectory = os.path.join(tOptions.OutputDirectory, sSubDirectory)
-            sPathNew = create_path_with_exif(
-                os.path.join(sNewDirectory, os.path.basename(sPathOld)),
-                dExif[sPathOld],
-                tOptions.CpNoExif,
-            )
-            dNewPathRaw[sPathOld] = sPathNew
-    else:  # Output directory given, all the files will be written there
-        for sPathOld in lPathOld:
-            sFilepath = create_path_with_exif(
-                sPathOld, dExif[sPathOld], tOptions.CpNoExif, tOptions.DateDirectory
-            )
-            if tOptions.DateDirectory:
-                sFileBasename = sFilepath
-            else:
-                sFileBasename = os.path.basename(sFilepath)
-            dNewPathRaw[sPathOld] = os.path.join(
-                tOptions.OutputDirectory, sFileBasename
+
+def start_progress(sPhase, nTotal=None):
+    """
+    Return the state of a progress line for the phase sPhase, processing
+    nTotal files if known.
+    """
+    emit_event("phase", phase=sPhase, total=nTotal)
+    nNow = time.monotonic()
+    return {
+        "phase": sPhase,
+        "total": nTotal,
+        "done": 0,
+        "start": nNow,
+        "next": nNow + PROGRESS_INTERVAL,
+    }
+
+
+def print_progress(dProgress, bEnd=False):
+    """
+    Print the progress line: files processed, throughput and, if the total
+    is known, estimated time left. On a terminal the line is overwritten.
+    """
+    nElapsed = time.monotonic() - dProgress["start"]
+    nDone = dProgress["done"]
+    nRate = nDone / nElapsed if nElapsed > 0 else 0.0
+    if bEnd:
+        sLine = "%s: %s files in %.1f s (%.0f files/s)" % (
+            dProgress["phase"],
+            nDone,
+            nElapsed,
+            nRate,
+        )
+    elif dProgress["total"] is None:
+        sLine = "%s: %s files, %.0f files/s" % (dProgress["phase"], nDone, nRate)
+    else:
+        sLine = "%s: %s/%s files, %.0f files/s" % (
+            dProgress["phase"],
+            nDone,
+            dProgress["total"],
+            nRate,
+        )
+        if nRate > 0:
+            nLeft = int((dProgress["total"] - nDone) / nRate)
+            sLine += ", ETA %d:%02d:%02d" % (
+                nLeft // 3600,
+                nLeft // 60 % 60,
+                nLeft % 60,
             )
+    if sys.stdout.isatty():
+        print("\r\033[K" + sLine, end="\n" if bEnd else "", flush=True)
+    else:
+        print(sLine, flush=True)
+
 
-    return dNewPathRaw
+def update_progress(dProgress, nDone=1):
+    """
+    Add nDone files to the progress line, and print it if it was not printed
+    during the last PROGRESS_INTERVAL seconds. Nothing is printed in verbose
+    mode, where each file is already reported, nor in quiet mode.
+    """
+    dProgress["done"] += nDone
+    if nGlobalVerbosity != NORMAL:
+        return
+    nNow = time.monotonic()
+    if nNow >= dProgress["next"]:
+        dProgress["next"] = nNow + PROGRESS_INTERVAL
+        print_progress(dProgress)
 
 
-def get_unique_path_for_images(dNewPathRawWithPossibleCollision):
+def end_progress(dProgress):
     """
-    Identifying the collision for new path being the same
-    in the dictionnary dNewPathRawWithPossibleCollision
-    To avoid the collision, add "_N" before the extension.
+    Print the final progress line of a phase.
     """
+    if nGlobalVerbosity == NORMAL and dProgress["done"] > 0:
+        print_progress(dProgress, bEnd=True)
 
-    my_print("Checking uniqueness of output file name", VERBOSE)
-    dNewPathUnique = {}
-    dNewOldPath = {}
-    for k, v in dNewPathRawWithPossibleCollision.items():
-        dNewOldPath.setdefault(v, []).append(k)
 
-    lNewPath = list(dNewOldPath.keys())
-    for sNewPath in lNewPath:
-        nNbrImageWithThisExif = len(dNewOldPath[sNewPath])
-        if nNbrImageWithThisExif == 1:
-            # Ignore if origin and destination are the same
-            sOldPath = dNewOldPath[sNewPath][0]
-            if sOldPath == sNewPath:
-                my_print(
-                    "File already has the right name and is in the destination directory.\n Ignoring '%s'"
-                    % (sNewPath),
-                    VERBOSE,
-                )
-                my_print("----", VERBOSE)
-            else:
-                dNewPathUnique[sOldPath] = sNewPath
-                my_print(
-                    "EXIF date is unique, renaming\n %s --> %s"
-                    % (dNewOldPath[sNewPath], sNewPath),
-                    VERBOSE,
+def get_default_cache_path():
+    """
+    Return the default location of the metadata cache.
+    """
+    sCacheHome = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    return os.path.join(sCacheHome, "exif_rename_files", "cache.sqlite")
+
+
+def open_cache(sCachePath, bClear=False):
+    """
+    Open the metadata cache stored in the SQLite database sCachePath.
+    The cache maps the identity of a file (device, inode, size, mtime) to its
+    EXIF date, and a directory to the image files and subdirectories it held
+    the last time it was listed, or to its files and subdirectories for a
+    directory of a library (see --against). If bClear is True, the cache is emptied.
+    The cache left open by the previous run of the library is reused if it
+    has the same path.
+    """
+    global oGlobalCache, sGlobalCachePath
+    if oGlobalCache is not None and sGlobalCachePath != sCachePath:
+        close_cache()
+    if oGlobalCache is None:
+        import sqlite3
+
+        sDirectory = os.path.dirname(sCachePath)
+        if sDirectory != "" and not os.path.exists(sDirectory):
+            os.makedirs(sDirectory)
+
+        my_print("Using metadata cache '%s'" % (sCachePath), VERBOSE)
+        oGlobalCache = sqlite3.connect(sCachePath, check_same_thread=False)
+        sGlobalCachePath = sCachePath
+    oGlobalCache.executescript("""
+        CREATE TABLE IF NOT EXISTS files (
+            device INTEGER, inode INTEGER, size INTEGER, mtime_ns INTEGER,
+            date TEXT, error TEXT, last_used INTEGER,
+            PRIMARY KEY (device, inode, size, mtime_ns));
+        CREATE INDEX IF NOT EXISTS files_last_used ON files (last_used);
+        CREATE TABLE IF NOT EXISTS directories (
+            path TEXT PRIMARY KEY, device INTEGER, inode INTEGER,
+            mtime_ns INTEGER, files TEXT, subdirectories TEXT);
+        CREATE TABLE IF NOT EXISTS library_directories (
+            path TEXT PRIMARY KEY, device INTEGER, inode INTEGER,
+            mtime_ns INTEGER, files TEXT, subdirectories TEXT);
+        CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+        """)
+    # The directory listings only hold the files with an extension of FILETYPE
+    sFileType = ",".join(FILETYPE)
+    row = oGlobalCache.execute(
+        "SELECT value FROM meta WHERE key = 'filetype'"
+    ).fetchone()
+    if bClear or row is None or row[0] != sFileType:
+        oGlobalCache.execute("DELETE FROM directories")
+        oGlobalCache.execute(
+            "INSERT OR REPLACE INTO meta VALUES ('filetype', ?)", (sFileType,)
+        )
+    row = oGlobalCache.execute("SELECT value FROM meta WHERE key = 'reader'").fetchone()
+    if bClear or row is None or row[0] != CACHE_READER_VERSION:
+        if not bClear and row is not None:
+            my_print("Dates read by a previous version, clearing them", VERBOSE)
+        oGlobalCache.execute("DELETE FROM files")
+        oGlobalCache.execute(
+            "INSERT OR REPLACE INTO meta VALUES ('reader', ?)",
+            (CACHE_READER_VERSION,),
+        )
+    if bClear:
+        my_print("Clearing metadata cache", VERBOSE)
+        oGlobalCache.execute("DELETE FROM library_directories")
+    oGlobalCache.commit()
+
+
+def close_cache(nMaxEntries=CACHE_MAX_ENTRIES, bKeepOpen=False):
+    """
+    Evict the least recently used files to keep at most nMaxEntries files in
+    the cache, none if nMaxEntries is None, then close it unless bKeepOpen is
+    True.
+    """
+    global oGlobalCache, sGlobalCachePath
+    if oGlobalCache is None:
+        return
+
+    (nEntries,) = oGlobalCache.execute("SELECT COUNT(*) FROM files").fetchone()
+    if nMaxEntries is not None and nEntries > nMaxEntries:
+        my_print("Evicting %s files from cache" % (nEntries - nMaxEntries), VERBOSE)
+        oGlobalCache.execute(
+            "DELETE FROM files WHERE rowid IN "
+            "(SELECT rowid FROM files ORDER BY last_used LIMIT ?)",
+            (nEntries - nMaxEntries,),
+        )
+    oGlobalCache.commit()
+    if not bKeepOpen:
+        oGlobalCache.close()
+        oGlobalCache = None
+        sGlobalCachePath = None
+
+
+def get_stat_key(st):
+    """
+    Return the identity of a file used as key in the cache from its stat
+    result: tuple (device, inode, size, modification time in ns).
+    """
+    return (st.st_dev, st.st_ino, st.st_size, st.st_mtime_ns)
+
+
+def get_file_key(sPath, dKeys=None):
+    """
+    Return the identity of a file used as key in the cache, or None if the
+    file cannot be reached. The key is taken from dKeys if it is there.
+    """
+    if dKeys is not None and sPath in dKeys:
+        return dKeys[sPath]
+    try:
+        return get_stat_key(os.stat(sPath))
+    except OSError:
+        return None
+
+
+def get_files_size(lPaths, dKeys=None):
+    """
+    Return the total size of the files of lPaths, taken from their file keys
+    (see get_file_key). The files which cannot be reached, like the images
+    of the archives, count for nothing.
+    """
+    nBytes = 0
+    for sPath in lPaths:
+        tKey = get_file_key(sPath, dKeys)
+        if tKey is not None:
+            nBytes = nBytes + tKey[2]
+    return nBytes
+
+
+def get_cached_exif(dFileKeys):
+    """
+    Look for the files of dFileKeys (key: path, value: file key) in the cache
+    and return a dictionnary including:
+    * key: path of the files found in the cache
+    * value: tuple (date, error) as returned by read_image_exif
+    """
+    dCached = {}
+    lUsed = []
+    nNow = int(time.time())
+    with oGlobalCacheLock:
+        for sPath, tKey in dFileKeys.items():
+            row = oGlobalCache.execute(
+                "SELECT date, error FROM files WHERE device = ? AND inode = ? "
+                "AND size = ? AND mtime_ns = ?",
+                tKey,
+            ).fetchone()
+            if row is not None:
+                dCached[sPath] = (row[0], row[1])
+                lUsed.append((nNow,) + tKey)
+        oGlobalCache.executemany(
+            "UPDATE files SET last_used = ? WHERE device = ? AND inode = ? "
+            "AND size = ? AND mtime_ns = ?",
+            lUsed,
+        )
+        oGlobalCache.commit()
+    my_print("%s files found in cache" % (len(dCached)), VERBOSE)
+
+    return dCached
+
+
+def set_cached_exif(dFileKeys, dResults):
+    """
+    Store in the cache the results (key: path, value: tuple (date, error)) of
+    the files of dFileKeys.
+    """
+    nNow = int(time.time())
+    with oGlobalCacheLock:
+        oGlobalCache.executemany(
+            "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [
+                dFileKeys[sPath] + tResult + (nNow,)
+                for sPath, tResult in dResults.items()
+                if sPath in dFileKeys
+            ],
+        )
+        oGlobalCache.commit()
+
+
+def get_cached_directory(sDirectory, st, sTable="directories"):
+    """
+    Return the tuple (image files, subdirectories) stored in the cache for
+    sDirectory if the directory did not change since, None otherwise. The
+    directories of the libraries are in the table "library_directories".
+    """
+    with oGlobalCacheLock:
+        row = oGlobalCache.execute(
+            "SELECT files, subdirectories FROM " + sTable + " WHERE path = ? "
+            "AND device = ? AND inode = ? AND mtime_ns = ?",
+            (sDirectory, st.st_dev, st.st_ino, st.st_mtime_ns),
+        ).fetchone()
+    if row is None:
+        return None
+    return (
+        [s for s in row[0].split("\0") if s != ""],
+        [s for s in row[1].split("\0") if s != ""],
+    )
+
+
+def set_cached_directory(sDirectory, st, lFiles, lSubdirectories, sTable="directories"):
+    """
+    Store in the cache the image files and subdirectories of sDirectory, in
+    the table sTable.
+    """
+    with oGlobalCacheLock:
+        oGlobalCache.execute(
+            "INSERT OR REPLACE INTO " + sTable + " VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                sDirectory,
+                st.st_dev,
+                st.st_ino,
+                st.st_mtime_ns,
+                "\0".join(lFiles),
+                "\0".join(lSubdirectories),
+            ),
+        )
+
+
+def get_extension(sPath):
+    """
+    Return the extension of a file, without the dot.
+    """
+    return os.path.splitext(sPath)[1][1:]
+
+
+def scan_directory(sDirectory):
+    """
+    List sDirectory and return a tuple including:
+    * the list of tuples (image path, stat result) of its image files
+    * the list of its subdirectories path (symlinks excluded, as in os.walk)
+    The stat results come for free with os.scandir on most systems, they are
+    None when the image cannot be reached. With the cache, the listing of a
+    directory which did not change since the last run is read from the cache,
+    without the stat results.
+    """
+    lImages = []
+    lSubdirectories = []
+    try:
+        if oGlobalCache is not None:
+            stDirectory = os.stat(sDirectory)
+            tListing = get_cached_directory(sDirectory, stDirectory)
+            if tListing is not None:
+                for sFile in tListing[0]:
+                    lImages.append((os.path.join(sDirectory, sFile), None))
+                for sSubdirectory in tListing[1]:
+                    lSubdirectories.append(os.path.join(sDirectory, sSubdirectory))
+                return lImages, lSubdirectories
+
+        with os.scandir(sDirectory) as it:
+            for entry in it:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        lSubdirectories.append(entry.path)
+                elif get_extension(entry.name) in FILETYPE_SET:
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        st = None
+                    lImages.append((entry.path, st))
+    except OSError as inst:
+        my_print("Cannot list directory '%s': %s" % (sDirectory, inst), VERBOSE)
+        return [], []
+
+    if oGlobalCache is not None:
+        set_cached_directory(
+            sDirectory,
+            stDirectory,
+            [os.path.basename(sImage) for sImage, st in lImages],
+            [os.path.basename(sSubdirectory) for sSubdirectory in lSubdirectories],
+        )
+
+    return lImages, lSubdirectories
+
+
+def iter_images_path_directory(sDirectory, bRecursive, nJobs=1):
+    """
+    Yield the tuples (image path, stat result) of the images in target
+    directory, and in its subdirectories if bRecursive is True.
+    With nJobs greater than 1, the subdirectories are listed in parallel by
+    nJobs threads, and the images are yielded in no particular order.
+    """
+    if nJobs <= 1:
+        lDirectories = [sDirectory]
+        while len(lDirectories) > 0:
+            lImages, lSubdirectories = scan_directory(lDirectories.pop())
+            yield from lImages
+            if bRecursive:
+                lDirectories.extend(reversed(lSubdirectories))
+    else:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=nJobs) as executor:
+            setPending = {executor.submit(scan_directory, sDirectory)}
+            while len(setPending) > 0:
+                setDone, setPending = concurrent.futures.wait(
+                    setPending, return_when=concurrent.futures.FIRST_COMPLETED
                 )
-                my_print("----", VERBOSE)
+                for future in setDone:
+                    lImages, lSubdirectories = future.result()
+                    if bRecursive:
+                        for sSubdirectory in lSubdirectories:
+                            setPending.add(
+                                executor.submit(scan_directory, sSubdirectory)
+                            )
+                    yield from lImages
+
+    if oGlobalCache is not None:
+        with oGlobalCacheLock:
+            oGlobalCache.commit()
+
+
+def is_archive(sPath):
+    """
+    Tell if sPath has the extension of a zip or tar archive.
+    """
+    return sPath.lower().endswith(ARCHIVE_EXTENSIONS)
+
+
+def get_archive_members(sArchivePath):
+    """
+    Return the tuple (archive, members) of the zip or tar archive
+    sArchivePath, archive being its zipfile.ZipFile or tarfile.TarFile and
+    members a dictionnary with key: normalized name of a regular file of the
+    archive, value: its ZipInfo or TarInfo. The names going out of the
+    archive are left out. The archive is opened once by each thread and each
+    process, as the readers of an archive share its file offset.
+    Raise OSError if the archive cannot be read.
+    """
+    if getattr(oGlobalArchives, "nPid", None) != os.getpid():
+        oGlobalArchives.nPid = os.getpid()
+        oGlobalArchives.dArchives = {}
+    dArchives = oGlobalArchives.dArchives
+    if sArchivePath not in dArchives:
+        if sArchivePath.lower().endswith(".zip"):
+            import zipfile
+
+            try:
+                oArchive = zipfile.ZipFile(sArchivePath)
+            except zipfile.BadZipFile as inst:
+                raise OSError("Invalid zip archive: %s" % (inst))
+            lMembers = [(o.filename, o) for o in oArchive.infolist() if not o.is_dir()]
         else:
-            my_print(
-                "File %s is not unique! There is %s occurences"
-                % (sNewPath, nNbrImageWithThisExif),
-                VERBOSE,
-            )
-            nNumberDigit = len(str(nNbrImageWithThisExif))
-            # Update each image path by adding a numbe of digit before the extension.
-            i = 0
-            lNewPath = dNewOldPath[sNewPath]
-            lNewPath.sort()
-            for sOldImagePathWithSameExif in lNewPath:
-                sNewImagePathSame = sNewPath
-                sExtension = os.path.splitext(sNewImagePathSame)[1]
-                j = "_" + str(i).zfill(nNumberDigit)
-                sNewImagePathUnique = re.sub(
-                    sExtension + "$", j + sExtension, sNewImagePathSame
-                )
-                if sOldImagePathWithSameExif == sNewImagePathUnique:
-                    my_print(
-                        "File already has the right name and is in the destination directory.\n Ignoring '%s'"
-                        % (sNewImagePathUnique),
+            import tarfile
+
+            # Only the members of an uncompressed archive can be read directly
+            try:
+                oArchive = tarfile.open(sArchivePath, "r:")
+                lMembers = [(o.name, o) for o in oArchive.getmembers() if o.isfile()]
+            except tarfile.TarError as inst:
+                raise OSError("Invalid tar archive: %s" % (inst))
+        dMembers = {}
+        for sName, oInfo in lMembers:
+            sName = posixpath.normpath(sName)
+            if not (sName.startswith("/") or sName == ".." or sName.startswith("../")):
+                dMembers[sName] = oInfo
+        dArchives[sArchivePath] = (oArchive, dMembers)
+
+    return dArchives[sArchivePath]
+
+
+def close_archives():
+    """
+    Close the archives opened by the current thread.
+    """
+    dArchives = getattr(oGlobalArchives, "dArchives", {})
+    for oArchive, _ in dArchives.values():
+        oArchive.close()
+    dArchives.clear()
+
+
+def iter_archive_images(sArchivePath, bRecursive):
+    """
+    Yield the paths of the images of the archive sArchivePath, read as a
+    directory: the path of the archive followed by the name of the image in
+    the archive. The images in the directories of the archive are yielded if
+    bRecursive is True.
+    """
+    try:
+        _, dMembers = get_archive_members(sArchivePath)
+    except OSError as inst:
+        my_print("Cannot read archive '%s': %s" % (sArchivePath, inst), VERBOSE)
+        record_error("archive_error", sArchivePath)
+        return
+    for sName in dMembers:
+        if (bRecursive or "/" not in sName) and get_extension(sName) in FILETYPE_SET:
+            yield os.path.join(sArchivePath, *sName.split("/"))
+
+
+def split_archive_path(sPath):
+    """
+    Return the tuple (archive path, name in the archive) of the path of an
+    image in an archive (see iter_archive_images), or None if sPath is not
+    in an archive.
+    """
+    sArchivePath = sPath
+    lNames = []
+    while True:
+        sArchivePath, sName = os.path.split(sArchivePath)
+        if sName == "":
+            return None
+        lNames.append(sName)
+        if is_archive(sArchivePath) and os.path.isfile(sArchivePath):
+            return sArchivePath, "/".join(reversed(lNames))
+
+
+def open_archive_member(sArchivePath, sName):
+    """
+    Open the file sName of the archive sArchivePath for reading in binary
+    mode, without unpacking the archive. Return the tuple (file, modification
+    time of the file).
+    Raise FileNotFoundError if the archive has no such file.
+    """
+    oArchive, dMembers = get_archive_members(sArchivePath)
+    if sName not in dMembers:
+        raise FileNotFoundError(
+            errno.ENOENT, "No such file in archive", os.path.join(sArchivePath, sName)
+        )
+    oInfo = dMembers[sName]
+    if sArchivePath.lower().endswith(".zip"):
+        return oArchive.open(oInfo), time.mktime(oInfo.date_time + (0, 0, -1))
+    else:
+        return oArchive.extractfile(oInfo), oInfo.mtime
+
+
+class Throttle:
+    """
+    Limits of the reads, writes and files opened by the run, in bytes or
+    files per second, shared by all the threads of the process as token
+    buckets: dRates holds the rate of "read", "write" and "files", None for
+    no limit. A bucket keeps up to one second of its rate, and a thread
+    taking more than what is left waits until the debt is paid, so the
+    largest requests are not starved. The rates are read again from the
+    JSON control file sControlPath, if given, when it changes. In the worker
+    processes, each of the nShare processes gets its share of the rates.
+    """
+
+    def __init__(self, dRates, sControlPath=None, nShare=1):
+        self.dRates = dict(dRates)
+        self.sControlPath = sControlPath
+        self.nShare = nShare
+        self.oLock = threading.Lock()
+        self.dTokens = {}
+        self.dLast = {}
+        self.nNextCheck = 0
+        self.nControlTime = None
+
+    def check_control(self):
+        """
+        Read the rates from the control file if it changed. An invalid
+        control file is ignored, the rates are kept.
+        """
+        if self.sControlPath is None or time.monotonic() < self.nNextCheck:
+            return
+        self.nNextCheck = time.monotonic() + THROTTLE_CONTROL_INTERVAL
+        try:
+            nTime = os.stat(self.sControlPath).st_mtime_ns
+            if nTime == self.nControlTime:
+                return
+            self.nControlTime = nTime
+            with open(self.sControlPath) as f:
+                dControl = json.load(f)
+            dRates = dict(self.dRates)
+            for sKind, (sOption, nUnit) in THROTTLE_CONTROLS.items():
+                if sOption in dControl:
+                    if dControl[sOption] is None:
+                        dRates[sKind] = None
+                    elif float(dControl[sOption]) > 0:
+                        dRates[sKind] = float(dControl[sOption]) * nUnit
+        except (OSError, ValueError, TypeError, AttributeError):
+            return
+        with self.oLock:
+            self.dRates = dRates
+
+    def take(self, sKind, nAmount):
+        """
+        Take nAmount bytes or files of the rate sKind, waiting if needed.
+        """
+        self.check_control()
+        with self.oLock:
+            if self.dRates.get(sKind) is None:
+                return
+            nRate = self.dRates[sKind] / self.nShare
+            nNow = time.monotonic()
+            nTokens = self.dTokens.get(sKind, nRate)
+            nTokens += (nNow - self.dLast.get(sKind, nNow)) * nRate
+            nTokens = min(nTokens, nRate) - nAmount
+            self.dTokens[sKind] = nTokens
+            self.dLast[sKind] = nNow
+        if nTokens < 0:
+            time.sleep(-nTokens / nRate)
+
+
+def get_throttle_rates(tOptions):
+    """
+    Return the rates of the Throttle given by the options, or None if the run
+    is not throttled.
+    """
+    dRates = {
+        "read": tOptions.MaxReadMbps,
+        "write": tOptions.MaxWriteMbps,
+        "files": tOptions.MaxFilesPerSec,
+    }
+    if all(n is None for n in dRates.values()) and tOptions.ThrottleControl is None:
+        return None
+    for sKind, (_, nUnit) in THROTTLE_CONTROLS.items():
+        if dRates[sKind] is not None:
+            dRates[sKind] = dRates[sKind] * nUnit
+    return dRates
+
+
+def init_throttle(dRates, sControlPath=None, nShare=1):
+    """
+    Throttle the current process with the rates dRates, see Throttle. Also
+    run by the worker processes when they start.
+    """
+    global oGlobalThrottle
+    if dRates is None:
+        oGlobalThrottle = None
+    else:
+        oGlobalThrottle = Throttle(dRates, sControlPath, nShare)
+
+
+def throttle(sKind, nAmount=1):
+    """
+    Wait until the limit of sKind ("read", "write" or "files") allows
+    nAmount more bytes or files, if the run is throttled.
+    """
+    if oGlobalThrottle is not None:
+        oGlobalThrottle.take(sKind, nAmount)
+
+
+class ThrottledFile:
+    """
+    File object whose reads are limited by the throttle of the run.
+    """
+
+    def __init__(self, f):
+        self.f = f
+
+    def read(self, nSize=-1):
+        sData = self.f.read(nSize)
+        throttle("read", len(sData))
+        return sData
+
+    def __getattr__(self, sName):
+        return getattr(self.f, sName)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *lExcInfo):
+        self.f.close()
+
+
+def open_image_file(sPath):
+    """
+    Open the image sPath for reading in binary mode. An image in an archive
+    is read from the archive. The reads are limited by the throttle of the
+    run, if any.
+    """
+    try:
+        f = open(sPath, "rb")
+    except (FileNotFoundError, NotADirectoryError):
+        tArchivePath = split_archive_path(sPath)
+        if tArchivePath is None:
+            raise
+        f = open_archive_member(*tArchivePath)[0]
+    if oGlobalThrottle is None:
+        return f
+    throttle("files")
+    return ThrottledFile(f)
+
+
+def iter_images_path(tOptions):
+    """
+    Yield the tuples (image path, original directory in the input, stat
+    result or None) of the images found in the input. The zip and tar
+    archives of the input are read as directories.
+    """
+    my_print("Looking for image files with extension in: " + str(FILETYPE), VERBOSE)
+    for sPath in tOptions.Input:
+        try:
+            st = os.stat(sPath)
+        except OSError:
+            # If input does not exist, we skip it
+            my_print("Input '" + sPath + "' does not exists! Skipping.", VERBOSE)
+            record_error("missing_input", sPath)
+            continue
+        if stat.S_ISDIR(st.st_mode):
+            for sImage, stImage in iter_images_path_directory(
+                sPath, tOptions.Recursive, tOptions.Jobs
+            ):
+                yield sImage, sPath, stImage
+        elif stat.S_ISREG(st.st_mode):
+            if get_extension(sPath) in FILETYPE_SET:
+                yield sPath, sPath, st
+            elif is_archive(sPath):
+                for sImage in iter_archive_images(sPath, tOptions.Recursive):
+                    yield sImage, sPath, None
+
+
+class ImageRecord:
+    """
+    Compact description of an image, shared by all the stages of the default
+    mode instead of dictionnaries of paths:
+    * sDirectory: beginning of the image path up to its file name, a single
+      string for all the images of a directory (see split_path)
+    * sName: file name of the image
+    * sInputPath: input path where the image was found
+    * tKey: file key of the image (see get_stat_key), or None if unknown
+    * date: EXIF date of the image (see encode_exif_date), None if no EXIF
+    * sNewDirectory, sNewName: the same as sDirectory and sName for the new
+      path of the image, None until it is known
+    * oOriginal: record of an identical image, whose new path is hard linked
+      instead of copying this one (see --dedupe), None otherwise
+    """
+
+    __slots__ = (
+        "sDirectory",
+        "sName",
+        "sInputPath",
+        "tKey",
+        "date",
+        "sNewDirectory",
+        "sNewName",
+        "oOriginal",
+    )
+
+    def __init__(self, sDirectory, sName, sInputPath, tKey=None):
+        self.sDirectory = sDirectory
+        self.sName = sName
+        self.sInputPath = sInputPath
+        self.tKey = tKey
+        self.date = None
+        self.sNewDirectory = None
+        self.sNewName = None
+        self.oOriginal = None
+
+
+class RecordPaths:
+    """
+    Read-only view of a list of records as the dictionnary (key: old path,
+    value: new path) used by duplicate_images. The paths are built when they
+    are read, they are not kept.
+    """
+
+    __slots__ = ("lRecords",)
+
+    def __init__(self, lRecords):
+        self.lRecords = lRecords
+
+    def __len__(self):
+        return len(self.lRecords)
+
+    def __iter__(self):
+        return self.keys()
+
+    def keys(self):
+        return (get_record_path(oRecord) for oRecord in self.lRecords)
+
+    def values(self):
+        return (get_record_new_path(oRecord) for oRecord in self.lRecords)
+
+    def items(self):
+        return (
+            (get_record_path(oRecord), get_record_new_path(oRecord))
+            for oRecord in self.lRecords
+        )
+
+
+def split_path(sPath):
+    """
+    Split sPath in the tuple (beginning of the path up to the file name, file
+    name), the path being their concatenation. The beginning is interned, so
+    all the paths of a directory share the same string.
+    """
+    sName = os.path.basename(sPath)
+    return sys.intern(sPath[: len(sPath) - len(sName)]), sName
+
+
+def get_record_path(oRecord):
+    """
+    Return the path of the image of oRecord.
+    """
+    return oRecord.sDirectory + oRecord.sName
+
+
+def get_record_new_path(oRecord):
+    """
+    Return the new path of the image of oRecord.
+    """
+    return oRecord.sNewDirectory + oRecord.sNewName
+
+
+def get_prefix_directory(sPrefix, dDirectories):
+    """
+    Return the directory, as given by os.path.dirname, of the paths starting
+    with sPrefix as returned by split_path. dDirectories keeps the result
+    for each prefix.
+    """
+    if sPrefix not in dDirectories:
+        dDirectories[sPrefix] = os.path.dirname(sPrefix + "_")
+    return dDirectories[sPrefix]
+
+
+def encode_exif_date(sExif):
+    """
+    Return the EXIF date sExif in its compact form: the integer
+    YYYYMMDDhhmmss for a date of the form "YYYY:MM:DD hh:mm:ss", sExif
+    itself otherwise.
+    """
+    if sExif is None:
+        return None
+    oMatch = EXIF_DATE_FORMAT.match(sExif)
+    if oMatch is None:
+        return sExif
+    return int("".join(oMatch.groups()))
+
+
+def decode_exif_date(date):
+    """
+    Return the EXIF date string of a date returned by encode_exif_date.
+    """
+    if not isinstance(date, int):
+        return date
+    s = "%014d" % (date)
+    return "%s:%s:%s %s:%s:%s" % (s[:4], s[4:6], s[6:8], s[8:10], s[10:12], s[12:])
+
+
+def get_image_records(tOptions):
+    """
+    Get the records of the images found in the input, in the order of the
+    scan. An image found twice is kept once, with the last input where it
+    was found.
+    """
+    lRecords = []
+    # An image can only be found twice with several inputs, the records are
+    # then kept by directory and name
+    if len(tOptions.Input) > 1:
+        dSeen = {}
+    else:
+        dSeen = None
+    nBytes = 0
+    for sImage, sPath, st in iter_images_path(tOptions):
+        sDirectory, sName = split_path(sImage)
+        if st is None:
+            tKey = None
+        else:
+            tKey = get_stat_key(st)
+            nBytes = nBytes + st.st_size
+        if dSeen is not None:
+            dNames = dSeen.setdefault(sDirectory, {})
+            if sName in dNames:
+                dNames[sName].sInputPath = sPath
+                dNames[sName].tKey = tKey
+                continue
+        oRecord = ImageRecord(sDirectory, sName, sPath, tKey)
+        if dSeen is not None:
+            dNames[sName] = oRecord
+        lRecords.append(oRecord)
+    count_in_stats("scan", len(lRecords), nBytes)
+
+    return lRecords
+
+
+def get_disk_position(sPath):
+    """
+    Return the position of the file sPath on its disk, as a tuple sorting the
+    files in the order of the disk: its device, then its first physical
+    extent when the filesystem gives it with FIEMAP, else its inode number.
+    The files which cannot be opened, like the images of the archives, are
+    after all the others.
+    """
+    try:
+        fd = os.open(sPath, os.O_RDONLY)
+    except OSError:
+        return (1,)
+    try:
+        st = os.fstat(fd)
+        if fcntl is not None and sys.platform.startswith("linux"):
+            # Ask for the first extent only
+            sRequest = struct.pack(
+                "=QQLLLL", 0, 0xFFFFFFFFFFFFFFFF, 0, 0, 1, 0
+            ) + bytes(FIEMAP_EXTENT_SIZE)
+            try:
+                sResult = fcntl.ioctl(fd, FS_IOC_FIEMAP, sRequest)
+                (nMapped,) = struct.unpack_from("=L", sResult, 20)
+                if nMapped > 0:
+                    (nPhysical,) = struct.unpack_from(
+                        "=Q", sResult, FIEMAP_HEADER_SIZE + 8
+                    )
+                    return (0, st.st_dev, 0, nPhysical)
+            except OSError:
+                pass
+        return (0, st.st_dev, 1, st.st_ino)
+    finally:
+        os.close(fd)
+
+
+def sort_on_disk(lItems, fPath=None):
+    """
+    Return the items of lItems sorted by the position on the disk of their
+    file, given by fPath(item), or by the item itself if fPath is None. The
+    files at the same position keep their order.
+    """
+    if fPath is None:
+        return sorted(lItems, key=get_disk_position)
+    return sorted(lItems, key=lambda item: get_disk_position(fPath(item)))
+
+
+def sort_records(lRecords):
+    """
+    Return the records sorted by image path. The records are sorted by name
+    in each directory, then the directories are merged, so that the paths
+    are only built for the merge.
+    """
+    dDirectories = {}
+    for oRecord in lRecords:
+        dDirectories.setdefault(oRecord.sDirectory, []).append(oRecord)
+    for lDirectory in dDirectories.values():
+        lDirectory.sort(key=operator.attrgetter("sName"))
+    if len(dDirectories) == 1:
+        return lDirectory
+    return list(heapq.merge(*dDirectories.values(), key=get_record_path))
+
+
+def get_exiftool():
+    """
+    Return the ExifTool process of the run, starting it on the first call.
+    """
+    global oGlobalExifTool
+    if oGlobalExifTool is None:
+        import exiftool
+
+        my_print("Starting ExifTool", VERBOSE)
+        oGlobalExifTool = exiftool.ExifToolHelper()
+        oGlobalExifTool.run()
+
+    return oGlobalExifTool
+
+
+def stop_exiftool():
+    """
+    Terminate the ExifTool process, if one was started.
+    """
+    global oGlobalExifTool
+    if oGlobalExifTool is not None:
+        my_print("Stopping ExifTool", VERBOSE)
+        oGlobalExifTool.terminate()
+        oGlobalExifTool = None
+
+
+def get_videos_tags(lPathVideos):
+    """
+    Read the metadata of the videos by batches of VIDEO_BATCH_SIZE files with
+    the shared ExifTool process. Return a dictionnary including:
+    * key: video path
+    * value: tags returned by ExifTool
+    If a batch fails, its files are read one by one so that only the faulty
+    files are missing from the dictionnary.
+    If ExifTool is not installed, the tags only hold the modification date of
+    the files, which ExifTool would give for a video with no date.
+    """
+    dTags = {}
+    if len(lPathVideos) == 0:
+        return dTags
+
+    if oGlobalExifTool is None and shutil.which("exiftool") is None:
+        my_print(
+            "ExifTool not found, using the modification date of the videos", VERBOSE
+        )
+        for sPathVideo in lPathVideos:
+            try:
+                nTime = os.stat(sPathVideo).st_mtime
+            except OSError:
+                record_error("stat_failure", sPathVideo)
+                continue
+            dTags[sPathVideo] = {
+                "File:FileModifyDate": time.strftime(
+                    "%Y:%m:%d %H:%M:%S", time.localtime(nTime)
+                )
+            }
+        return dTags
+
+    et = get_exiftool()
+    import exiftool
+
+    for i in range(0, len(lPathVideos), VIDEO_BATCH_SIZE):
+        lBatch = lPathVideos[i : i + VIDEO_BATCH_SIZE]
+        throttle("files", len(lBatch))
+        nStart = time.perf_counter()
+        try:
+            lTags = et.get_metadata(lBatch)
+        except exiftool.exceptions.ExifToolException:
+            my_print("ExifTool failed on a batch, reading files one by one", VERBOSE)
+            record_error("exiftool_batch_failure")
+            lTags = []
+            for sPathVideo in lBatch:
+                try:
+                    lTags.extend(et.get_metadata(sPathVideo))
+                except exiftool.exceptions.ExifToolException:
+                    my_print("ExifTool failed on '" + sPathVideo + "'", VERBOSE)
+                    record_error("exiftool_file_failure", sPathVideo)
+                    lTags.append(None)
+        # The files of a batch are read together, they share its time
+        nLatency = (time.perf_counter() - nStart) / len(lBatch)
+        for sPathVideo in lBatch:
+            record_latency(sPathVideo, nLatency)
+        for sPathVideo, tags in zip(lBatch, lTags):
+            if tags is not None:
+                dTags[sPathVideo] = tags
+
+    return dTags
+
+
+def read_exactly(f, nSize):
+    """
+    Read nSize bytes from f. Raise ValueError if the file is too short.
+    """
+    sData = f.read(nSize)
+    if len(sData) != nSize:
+        raise ValueError("Unexpected end of file")
+    return sData
+
+
+def find_ifd_entry(f, nTiffOffset, sEndian, nIfdOffset, nTag):
+    """
+    Look for the tag nTag in the IFD at nIfdOffset of the TIFF structure
+    starting at nTiffOffset. Return the tuple (type, count, value) of the
+    entry, value being the 4 raw bytes of its value/offset field, or None if
+    the tag is not in the IFD.
+    """
+    f.seek(nTiffOffset + nIfdOffset)
+    (nEntries,) = struct.unpack(sEndian + "H", read_exactly(f, 2))
+    if nEntries > TIFF_MAX_IFD_ENTRIES:
+        raise ValueError("Too many entries in IFD")
+    sEntries = read_exactly(f, 12 * nEntries)
+    for i in range(nEntries):
+        nEntryTag, nType, nCount = struct.unpack_from(sEndian + "HHI", sEntries, 12 * i)
+        if nEntryTag == nTag:
+            return nType, nCount, sEntries[12 * i + 8 : 12 * i + 12]
+
+    return None
+
+
+def read_tiff_date(f, nTiffOffset):
+    """
+    Read the DateTimeOriginal tag of the TIFF structure starting at
+    nTiffOffset in f, following IFD0 to the Exif IFD only.
+    Return the date string, or None if there is no such tag.
+    Raise ValueError if the structure is malformed.
+    """
+    f.seek(nTiffOffset)
+    sHeader = read_exactly(f, 8)
+    if sHeader[:4] == b"II*\x00":
+        sEndian = "<"
+    elif sHeader[:4] == b"MM\x00*":
+        sEndian = ">"
+    else:
+        raise ValueError("Not a TIFF header")
+    (nIfd0Offset,) = struct.unpack(sEndian + "I", sHeader[4:8])
+
+    tEntry = find_ifd_entry(f, nTiffOffset, sEndian, nIfd0Offset, TIFF_TAG_EXIF_IFD)
+    if tEntry is None:
+        return None
+    (nExifIfdOffset,) = struct.unpack(sEndian + "I", tEntry[2])
+
+    tEntry = find_ifd_entry(
+        f, nTiffOffset, sEndian, nExifIfdOffset, TIFF_TAG_DATE_TIME_ORIGINAL
+    )
+    if tEntry is None:
+        return None
+    nType, nCount, sValue = tEntry
+    if nType != 2:  # ASCII
+        raise ValueError("DateTimeOriginal is not an ASCII field")
+    if nCount > 4:
+        (nValueOffset,) = struct.unpack(sEndian + "I", sValue)
+        f.seek(nTiffOffset + nValueOffset)
+        sValue = read_exactly(f, nCount)
+    # Drop any garbage after a null, as exifread does
+    return sValue[:nCount].split(b"\x00", 1)[0].decode("utf-8")
+
+
+def read_jpeg_date(f):
+    """
+    Walk the JPEG segments up to the APP1 Exif segment and read its date.
+    Return None if the image has no EXIF date.
+    """
+    f.seek(2)
+    while True:
+        sMarker = read_exactly(f, 2)
+        if sMarker[0] != 0xFF:
+            raise ValueError("Invalid JPEG marker")
+        # Start of scan or end of image: there is no more metadata
+        if sMarker[1] in (0xDA, 0xD9):
+            return None
+        (nLength,) = struct.unpack(">H", read_exactly(f, 2))
+        if nLength < 2:
+            raise ValueError("Invalid JPEG segment length")
+        nSegmentOffset = f.tell()
+        if sMarker[1] == 0xE1 and nLength >= 8:
+            if read_exactly(f, 6) == b"Exif\x00\x00":
+                return read_tiff_date(f, nSegmentOffset + 6)
+        f.seek(nSegmentOffset + nLength - 2)
+
+
+def read_png_date(f):
+    """
+    Walk the PNG chunks up to the eXIf chunk, or to the tEXt chunk holding a
+    raw EXIF profile, and read its date.
+    Return None if the image has no EXIF date.
+    """
+    f.seek(8)
+    while True:
+        sChunkHeader = f.read(8)
+        if len(sChunkHeader) < 8 or sChunkHeader[4:8] in (b"IEND", b"IDAT"):
+            return None
+        (nLength,) = struct.unpack(">I", sChunkHeader[:4])
+        nChunkOffset = f.tell()
+        if sChunkHeader[4:8] == b"eXIf":
+            return read_tiff_date(f, nChunkOffset)
+        elif sChunkHeader[4:8] == b"tEXt":
+            sData = read_exactly(f, nLength)
+            if sData.startswith(b"Raw profile type exif\x00"):
+                # ImageMagick profile: "\nexif\n    <length>\n<hexadecimal data>"
+                lLines = sData.split(b"\x00", 1)[1].split(b"\n", 3)
+                if len(lLines) < 4:
+                    raise ValueError("Invalid raw EXIF profile")
+                sExif = binascii.unhexlify(b"".join(lLines[3].split()))
+                if sExif.startswith(b"Exif\x00\x00"):
+                    sExif = sExif[6:]
+                return read_tiff_date(io.BytesIO(sExif), 0)
+        f.seek(nChunkOffset + nLength + 4)
+
+
+def read_header_date(f):
+    """
+    Read the EXIF date of a JPEG or PNG image by reading only the headers
+    needed to reach the DateTimeOriginal tag.
+    Return the date string, or None if the image has no EXIF date.
+    Raise ValueError if the file is not a JPEG or PNG, or is malformed.
+    """
+    sSignature = f.read(8)
+    if sSignature[:2] == b"\xff\xd8":
+        return read_jpeg_date(f)
+    elif sSignature == b"\x89PNG\r\n\x1a\n":
+        return read_png_date(f)
+    else:
+        raise ValueError("Unknown image format")
+
+
+def find_mp4_box(f, nStart, nEnd, sType):
+    """
+    Walk the MP4 boxes between the offsets nStart and nEnd of f, reading only
+    their headers. Return the tuple (offset, size) of the content of the
+    first box of type sType, or None if there is none.
+    Raise ValueError if a box header is malformed.
+    """
+    nOffset = nStart
+    while nOffset + 8 <= nEnd:
+        f.seek(nOffset)
+        nSize, sBoxType = struct.unpack(">I4s", read_exactly(f, 8))
+        nHeaderSize = 8
+        if nSize == 1:
+            (nSize,) = struct.unpack(">Q", read_exactly(f, 8))
+            nHeaderSize = 16
+        elif nSize == 0:  # The last box extends to the end of the file
+            nSize = nEnd - nOffset
+        if nSize < nHeaderSize or nOffset + nSize > nEnd:
+            raise ValueError("Invalid MP4 box size")
+        if sBoxType == sType:
+            return nOffset + nHeaderSize, nSize - nHeaderSize
+        nOffset += nSize
+
+    return None
+
+
+def read_mp4_date(f):
+    """
+    Read the creation time of the movie header box moov/mvhd of a MP4 or
+    QuickTime video, seeking over the other boxes, including the media data.
+    The time is given as written, like ExifTool does.
+    Return the date string, or None if the video has no creation time.
+    Raise ValueError if the file is malformed.
+    """
+    nEnd = f.seek(0, os.SEEK_END)
+    tMoov = find_mp4_box(f, 0, nEnd, b"moov")
+    if tMoov is None:
+        return None
+    tMvhd = find_mp4_box(f, tMoov[0], tMoov[0] + tMoov[1], b"mvhd")
+    if tMvhd is None:
+        return None
+    f.seek(tMvhd[0])
+    sHeader = read_exactly(f, 12)
+    if sHeader[0] == 1:  # Version 1: 64-bit times
+        (nCreationTime,) = struct.unpack(">Q", sHeader[4:12])
+    else:
+        (nCreationTime,) = struct.unpack(">I", sHeader[4:8])
+    if nCreationTime == 0:
+        return None
+    try:
+        date = MP4_EPOCH + datetime.timedelta(seconds=nCreationTime)
+    except OverflowError:
+        raise ValueError("Invalid MP4 creation time")
+    return "%04d:%02d:%02d %02d:%02d:%02d" % (
+        date.year,
+        date.month,
+        date.day,
+        date.hour,
+        date.minute,
+        date.second,
+    )
+
+
+def read_mdpm_date(sData):
+    """
+    Read the recording date of the MDPM user data sData of an AVCHD video,
+    following its "MDPM" tag: a number of entries, then the entries of a tag
+    byte and 4 bytes of value. The date is in the BCD values of the tags
+    MDPM_TAG_DATE (time zone, year, month) and MDPM_TAG_TIME (day, hour,
+    minute, second).
+    Return the date string, or None if the entries are incomplete or hold no
+    date.
+    """
+    # Remove the emulation prevention bytes of the H.264 stream
+    sData = re.sub(b"\x00\x00\x03([\x00-\x03])", b"\x00\x00\\1", bytes(sData))
+    if len(sData) == 0 or len(sData) < 1 + 5 * sData[0]:
+        return None
+    dValues = {}
+    for i in range(1, 1 + 5 * sData[0], 5):
+        dValues.setdefault(sData[i], sData[i + 1 : i + 5])
+    if MDPM_TAG_DATE not in dValues or MDPM_TAG_TIME not in dValues:
+        return None
+    sDate = "%02x%02x:%02x:%02x %02x:%02x:%02x" % (
+        tuple(dValues[MDPM_TAG_DATE][1:]) + tuple(dValues[MDPM_TAG_TIME])
+    )
+    if EXIF_DATE_FORMAT.match(sDate) is None:  # Not BCD
+        return None
+    return sDate
+
+
+def read_mts_date(f):
+    """
+    Read the recording date of an AVCHD video, in the MDPM user data of its
+    H.264 stream. The payloads of the packets of the MPEG-2 transport stream
+    are gathered by stream, in the first MTS_READ_SIZE bytes of the file.
+    Return the date string, or None if it is not found.
+    Raise ValueError if the file is not a transport stream.
+    """
+    sStart = f.read(2 * 192)
+    if len(sStart) == 2 * 192 and sStart[4] == 0x47 and sStart[196] == 0x47:
+        # BDAV stream: a 4-byte timestamp before each packet
+        nPacketSize, nSyncOffset = 192, 4
+    elif len(sStart) >= 2 * 188 and sStart[0] == 0x47 and sStart[188] == 0x47:
+        nPacketSize, nSyncOffset = 188, 0
+    else:
+        raise ValueError("Not a MPEG-2 transport stream")
+
+    f.seek(0)
+    dPayloads = {}
+    nRead = 0
+    while nRead < MTS_READ_SIZE:
+        sBlock = f.read(nPacketSize * MTS_READ_PACKETS)
+        nRead += len(sBlock)
+        for i in range(nSyncOffset, len(sBlock) - 187, nPacketSize):
+            if sBlock[i] != 0x47:
+                raise ValueError("Lost transport stream synchronization")
+            nPid = ((sBlock[i + 1] & 0x1F) << 8) | sBlock[i + 2]
+            nControl = (sBlock[i + 3] >> 4) & 3
+            if nPid == MTS_NULL_PID or not nControl & 1:
+                continue
+            nPayload = i + 4
+            if nControl & 2:  # Adaptation field before the payload
+                nPayload += 1 + sBlock[i + 4]
+            if nPayload < i + 188:
+                dPayloads.setdefault(nPid, bytearray()).extend(
+                    sBlock[nPayload : i + 188]
+                )
+        for baPayload in dPayloads.values():
+            nPosition = baPayload.find(b"MDPM")
+            while nPosition >= 0:
+                sDate = read_mdpm_date(
+                    baPayload[nPosition + 4 : nPosition + 4 + MDPM_MAX_SIZE]
+                )
+                if sDate is not None:
+                    return sDate
+                nPosition = baPayload.find(b"MDPM", nPosition + 4)
+        if len(sBlock) < nPacketSize * MTS_READ_PACKETS:
+            break
+
+    return None
+
+
+def read_video_exif(sVideoPath):
+    """
+    Read the date of a MP4, QuickTime or AVCHD video from its headers.
+    Return the tuple (date, error) of read_image_exif, the error being
+    "Unsupported" if the date has to be read by ExifTool: the format is not
+    handled, or the video is malformed or has no date.
+    """
+    sExtension = get_extension(sVideoPath).lower()
+    if sExtension in ("mp4", "mov"):
+        fRead = read_mp4_date
+    elif sExtension in ("mts", "m2ts"):
+        fRead = read_mts_date
+    else:
+        return None, "Unsupported"
+    with open_image_file(sVideoPath) as f:
+        try:
+            sExifDate = fRead(f)
+        except ValueError:
+            sExifDate = None
+    if sExifDate is None:
+        return None, "Unsupported"
+    return sExifDate, None
+
+
+def get_date_from_tags(tags, bFileDate=True):
+    """
+    Return the date string found in the tags of a file, given by exifread or
+    ExifTool. Without EXIF date, the modification date of the file given by
+    ExifTool is used if bFileDate is True.
+    Raise KeyError if the tags contain no date.
+    """
+    if "EXIF DateTimeOriginal" in tags:
+        return str(tags["EXIF DateTimeOriginal"])
+    elif "EXIF:DateTimeOriginal" in tags:
+        return str(tags["EXIF:DateTimeOriginal"])
+    elif bFileDate:
+        return str(tags["File:FileModifyDate"]).split("+")[0]
+    else:
+        raise KeyError("DateTimeOriginal")
+
+
+class ExifBackend:
+    """
+    Reader of the EXIF date of some types of files, registered in BACKENDS
+    with register_backend and chosen with --backend. A backend has:
+    * sName: its name, given to --backend
+    * setTypes: the extensions of the files it reads
+    * probe(): tell if it can be used, its module or program being installed
+    * read_date(sPath, f=None): return the tuple (date, error) of
+      read_image_exif for a file, the error being "Unsupported" if the
+      backend cannot read it. f is the file already open, if any, which is
+      read again from its beginning and left open
+    """
+
+    sName = None
+    setTypes = frozenset()
+
+    def probe(self):
+        return True
+
+    def read_date(self, sPath, f=None):
+        raise NotImplementedError
+
+
+@contextlib.contextmanager
+def open_or_rewind(sPath, f=None):
+    """
+    Context manager giving the file f rewound to its beginning, left open, if
+    it is provided, or the image sPath opened with open_image_file otherwise.
+    """
+    if f is not None:
+        f.seek(0)
+        yield f
+    else:
+        with open_image_file(sPath) as f:
+            yield f
+
+
+def register_backend(cBackend):
+    """
+    Register the backend class cBackend in BACKENDS, used as a decorator.
+    """
+    BACKENDS[cBackend.sName] = cBackend()
+    return cBackend
+
+
+def is_module_available(sModule):
+    """
+    Tell if the module sModule can be imported, without importing it.
+    """
+    import importlib.util
+
+    return importlib.util.find_spec(sModule) is not None
+
+
+@register_backend
+class NativeBackend(ExifBackend):
+    """
+    Headers of the JPEG and PNG images, and of the MP4, QuickTime and AVCHD
+    videos, read by the script itself (see read_header_date and
+    read_video_exif).
+    """
+
+    sName = "native"
+    setTypes = frozenset(FILETYPE) - {"AVI"}
+
+    def read_date(self, sPath, f=None):
+        if get_extension(sPath) in VIDEOTYPE:
+            return read_video_exif(sPath)
+        with open_or_rewind(sPath, f) as f:
+            try:
+                sExifDate = read_header_date(f)
+            except ValueError:
+                return None, "Unsupported"
+        if sExifDate is None:
+            return None, "KeyError"
+        return sExifDate, None
+
+
+@register_backend
+class ExifReadBackend(ExifBackend):
+    """
+    Images read by the exifread module.
+    """
+
+    sName = "exifread"
+    setTypes = frozenset(FILETYPE) - frozenset(VIDEOTYPE)
+
+    def probe(self):
+        return is_module_available("exifread")
+
+    def read_date(self, sPath, f=None):
+        import exifread
+
+        with open_or_rewind(sPath, f) as f:
+            try:
+                tags = exifread.process_file(f, strict=False)
+                return get_date_from_tags(tags, False), None
+            except KeyError:
+                return None, "KeyError"
+            except MemoryError:
+                return None, "MemoryError"
+
+
+@register_backend
+class PiexifBackend(ExifBackend):
+    """
+    JPEG images read by the piexif module, which reads the whole file.
+    """
+
+    sName = "piexif"
+    setTypes = frozenset(["jpg", "JPG", "jpeg"])
+
+    def probe(self):
+        return is_module_available("piexif")
+
+    def read_date(self, sPath, f=None):
+        import piexif
+
+        with open_or_rewind(sPath, f) as f:
+            sData = f.read()
+        # piexif takes any other data for a file name
+        if not sData.startswith(b"\xff\xd8"):
+            return None, "Unsupported"
+        try:
+            dExif = piexif.load(sData)
+        except (piexif.InvalidImageDataError, ValueError, IndexError, struct.error):
+            return None, "Unsupported"
+        if piexif.ExifIFD.DateTimeOriginal not in dExif["Exif"]:
+            return None, "KeyError"
+        sExifDate = dExif["Exif"][piexif.ExifIFD.DateTimeOriginal]
+        return sExifDate.split(b"\x00", 1)[0].decode("utf-8"), None
+
+
+@register_backend
+class ExifToolBackend(ExifBackend):
+    """
+    Files read by the ExifTool process shared by the run. During the run,
+    the files are given to ExifTool by batches (see get_videos_tags), not by
+    read_date.
+    """
+
+    sName = "exiftool"
+    setTypes = frozenset(FILETYPE)
+
+    def probe(self):
+        return shutil.which("exiftool") is not None and is_module_available("exiftool")
+
+    def read_date(self, sPath, f=None):
+        dTags = get_videos_tags([sPath])
+        if sPath not in dTags:
+            return None, "Unsupported"
+        try:
+            sExifDate = get_date_from_tags(
+                dTags[sPath], get_extension(sPath) in VIDEOTYPE
+            )
+        except KeyError:
+            return None, "KeyError"
+        return sExifDate, None
+
+
+def get_backend_chain(sPath, dBackends=None):
+    """
+    Return the names of the backends reading the file sPath, in the order
+    they are tried: the backend chosen in dBackends (key: extension, value:
+    backend name or None) for its extension, then the default backends.
+    """
+    sExtension = get_extension(sPath)
+    if sExtension in VIDEOTYPE:
+        lChain = DEFAULT_VIDEO_BACKENDS
+    else:
+        lChain = DEFAULT_IMAGE_BACKENDS
+    if dBackends is not None and dBackends.get(sExtension) is not None:
+        sBackend = dBackends[sExtension]
+        lChain = [sBackend] + [s for s in lChain if s != sBackend]
+    return lChain
+
+
+def read_image_exif(sImagePath, dBackends=None, f=None):
+    """
+    Read the EXIF date of an image file with the backends of
+    get_backend_chain, each one trying the file only if the previous ones
+    cannot read it. f is the image already open, if any, left open.
+    Return a tuple (date, error) where error is None, "KeyError",
+    "MemoryError", or "Unsupported" if the file is left to ExifTool, which
+    reads the files by batches. This function is run by the extraction
+    workers, hence it does not print anything and only returns picklable
+    values.
+    """
+    for sBackend in get_backend_chain(sImagePath, dBackends):
+        if sBackend == "exiftool":
+            break
+        tResult = BACKENDS[sBackend].read_date(sImagePath, f)
+        if tResult[1] != "Unsupported":
+            return tResult
+
+    return None, "Unsupported"
+
+
+def read_sample_date(sImagePath, dBackends=None):
+    """
+    Return the tuple (date, error) of read_image_exif for a file, the files
+    left to ExifTool being read by ExifTool.
+    """
+    tResult = read_image_exif(sImagePath, dBackends)
+    if tResult[1] == "Unsupported":
+        tResult = BACKENDS["exiftool"].read_date(sImagePath)
+        if tResult[1] == "Unsupported":
+            tResult = None, "KeyError"
+    return tResult
+
+
+def choose_backend(sExtension, lPathSample):
+    """
+    Choose the backend reading the files with the extension sExtension, for
+    --backend auto. The files of lPathSample are read by the default backends,
+    then by each available backend reading this type of file, and the
+    fastest backend giving the same dates as the default backends is chosen.
+    A backend stops reading the sample as soon as it is slower than one
+    already measured. Return the tuple (backend name or None for the default backends,
+    dictionnary with key: path of a file of lPathSample, value: its tuple
+    (date, error) given by the chosen backend).
+    """
+    lCandidates = [None] + [
+        sName
+        for sName, oBackend in BACKENDS.items()
+        if sExtension in oBackend.setTypes and oBackend.probe()
+    ]
+    dSeconds = {}
+    dResults = {}
+    for sBackend in lCandidates:
+        dBackends = {sExtension: sBackend}
+        # The first file also loads the modules and starts the programs
+        # needed, it is not timed
+        lResults = [read_sample_date(lPathSample[0], dBackends)]
+        nBest = min(dSeconds.values(), default=None)
+        nStart = time.perf_counter()
+        for sImagePath in lPathSample[1:]:
+            lResults.append(read_sample_date(sImagePath, dBackends))
+            if nBest is not None and time.perf_counter() - nStart > nBest:
+                break
+        nSeconds = time.perf_counter() - nStart
+        if len(lResults) < len(lPathSample):
+            my_print(
+                "Backend %s is slower for the '.%s' files"
+                % (sBackend or "default", sExtension),
+                VERBOSE,
+            )
+            continue
+        if sBackend is not None and lResults != dResults[None]:
+            my_print(
+                "Backend %s gives other dates for the '.%s' files"
+                % (sBackend, sExtension),
+                VERBOSE,
+            )
+            continue
+        dSeconds[sBackend] = nSeconds
+        dResults[sBackend] = lResults
+    sBackend = min(dSeconds, key=dSeconds.get)
+    my_print(
+        "Backend for the '.%s' files: %s (%.3f ms per file)"
+        % (
+            sExtension,
+            sBackend or "default",
+            1000 * dSeconds[sBackend] / max(1, len(lPathSample) - 1),
+        ),
+        VERBOSE,
+    )
+
+    return sBackend, dict(zip(lPathSample, dResults[sBackend]))
+
+
+def update_backends(lPathImages, sBackend):
+    """
+    Choose the backend of the types of files of lPathImages which have none
+    in dGlobalBackends yet: sBackend for the types it reads, the default
+    backends for the others. With sBackend "auto", the backend of a type is
+    chosen with choose_backend on the first files of this type. Return the
+    results of the files read to choose the backends, see choose_backend.
+    """
+    dSamples = {}
+    for sImagePath in lPathImages:
+        sExtension = get_extension(sImagePath)
+        if sExtension in dGlobalBackends:
+            continue
+        if sBackend != "auto":
+            if sExtension in BACKENDS[sBackend].setTypes:
+                dGlobalBackends[sExtension] = sBackend
+            else:
+                dGlobalBackends[sExtension] = None
+            continue
+        lSample = dSamples.setdefault(sExtension, [])
+        if len(lSample) < BACKEND_SAMPLE_SIZE:
+            lSample.append(sImagePath)
+
+    dResults = {}
+    if len(dSamples) > 0:
+        with measure_phase("calibration"):
+            for sExtension, lSample in dSamples.items():
+                dGlobalBackends[sExtension], dSampleResults = choose_backend(
+                    sExtension, lSample
+                )
+                dResults.update(dSampleResults)
+                count_in_stats("calibration", len(lSample), get_files_size(lSample))
+
+    return dResults
+
+
+def open_image_prefetched(sImagePath, nSize=HEADER_READ_SIZE):
+    """
+    Open the image sPath for reading, and ask the system to read its first
+    nSize bytes in the background when it allows it, so that they are read
+    while other files are handled.
+    """
+    f = open_image_file(sImagePath)
+    if hasattr(os, "posix_fadvise"):
+        try:
+            os.posix_fadvise(f.fileno(), 0, nSize, os.POSIX_FADV_WILLNEED)
+        except (OSError, ValueError):
+            # Images of the archives
+            pass
+    return f
+
+
+def read_opened_image_exif(sImagePath, f, dBackends=None):
+    """
+    Return the tuple (date, error) of read_image_exif for the image sImagePath
+    open in f, then close f. The first HEADER_READ_SIZE bytes of the image
+    are read at once and parsed, the image is only read further, from the
+    same file, if the date is not in them.
+    """
+    with f:
+        tResult = parse_header_date(f.read(HEADER_READ_SIZE))
+        if tResult is None:
+            tResult = read_image_exif(sImagePath, dBackends, f)
+    return tResult
+
+
+def close_abandoned_file(oFuture):
+    """
+    Close the file returned by the future oFuture of an abandoned call.
+    """
+    if not oFuture.cancelled() and oFuture.exception() is None:
+        oFuture.result().close()
+
+
+def parse_header_date(sHead, nHeadSize=HEADER_READ_SIZE):
+    """
+    Return the tuple (date, error) of read_image_exif for an image from its
+    first nHeadSize bytes sHead, or None if the image has to be read further
+    to tell.
+    """
+    try:
+        sExifDate = read_header_date(io.BytesIO(sHead))
+    except ValueError:
+        return None
+    if sExifDate is not None:
+        return sExifDate, None
+    elif len(sHead) < nHeadSize:
+        return None, "KeyError"
+    else:
+        # The EXIF may be after the bytes read
+        return None
+
+
+class AsyncExifReader:
+    """
+    Reader of the EXIF date of the images keeping nInFlight reads in flight,
+    for the filesystems with a high latency. asyncio waits for the reads, and
+    parses the header of each image as soon as it arrives. The standard
+    library has no asynchronous read of regular files: the blocking calls
+    are made by a pool of at most ASYNC_READ_THREADS threads, and the system
+    is asked to read the first bytes of each image in the background as soon
+    as it is opened, so that many reads are in flight with a few threads.
+    A blocking call taking more than nTimeout seconds from its start is
+    abandoned and the image reported with the error "TimeoutError". Its
+    thread and its read in flight stay busy until the call returns.
+    """
+
+    def __init__(self, nInFlight=1, nTimeout=None):
+        import asyncio
+
+        self.nInFlight = nInFlight
+        self.nTimeout = nTimeout
+        self.nThreads = min(nInFlight, ASYNC_READ_THREADS)
+        self.oLoop = asyncio.new_event_loop()
+        self.oExecutor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self.nThreads
+        )
+        # Reads in flight and threads available, created in the loop and
+        # kept from a call of read to the next
+        self.oInFlight = None
+        self.oThreads = None
+
+    def read(self, lPathImages, dBackends=None):
+        """
+        Read the EXIF date of the image files with the backends of dBackends
+        and return the list of tuples ((date, error) of read_image_exif,
+        seconds taken), in the order of lPathImages.
+        """
+        return self.oLoop.run_until_complete(self.read_all(lPathImages, dBackends))
+
+    async def read_all(self, lPathImages, dBackends=None):
+        """
+        Coroutine reading the images of lPathImages, see read.
+        """
+        import asyncio
+
+        if self.oInFlight is None:
+            self.oInFlight = asyncio.Semaphore(self.nInFlight)
+            self.oThreads = asyncio.Semaphore(self.nThreads)
+        return await asyncio.gather(
+            *(self.read_with_timeout(s, dBackends) for s in lPathImages)
+        )
+
+    async def run_in_thread(self, fFunction, *args):
+        """
+        Coroutine calling fFunction(*args) in a thread of the reader as soon
+        as one is available, and returning the future of its result. The
+        call starts at once, it never waits in the queue of the pool, and its
+        thread is available again when it returns.
+        """
+        await self.oThreads.acquire()
+        oFuture = self.oLoop.run_in_executor(self.oExecutor, fFunction, *args)
+        oFuture.add_done_callback(lambda _: self.oThreads.release())
+        return oFuture
+
+    async def read_with_timeout(self, sImagePath, dBackends=None):
+        """
+        Coroutine reading an image once a read in flight is available. The
+        images read first by the native backend are opened, then their
+        header is read and parsed, the others are read by read_image_exif.
+        The timeout of each blocking call starts with the call.
+        """
+        import asyncio
+
+        await self.oInFlight.acquire()
+        nStart = time.perf_counter()
+        oPending = None  # Call in progress
+        try:
+            if (
+                get_extension(sImagePath) not in VIDEOTYPE
+                and get_backend_chain(sImagePath, dBackends)[0] == "native"
+            ):
+                oPending = await self.run_in_thread(open_image_prefetched, sImagePath)
+                try:
+                    f = await asyncio.wait_for(asyncio.shield(oPending), self.nTimeout)
+                except asyncio.TimeoutError:
+                    oPending.add_done_callback(close_abandoned_file)
+                    raise
+                oPending = await self.run_in_thread(
+                    read_opened_image_exif, sImagePath, f, dBackends
+                )
+            else:
+                oPending = await self.run_in_thread(
+                    read_image_exif, sImagePath, dBackends
+                )
+            tResult = await asyncio.wait_for(asyncio.shield(oPending), self.nTimeout)
+        except asyncio.TimeoutError:
+            tResult = None, "TimeoutError"
+        finally:
+            # An abandoned call keeps its read in flight until it returns
+            if oPending is None or oPending.done():
+                self.oInFlight.release()
+            else:
+                oPending.add_done_callback(lambda _: self.oInFlight.release())
+        return tResult, time.perf_counter() - nStart
+
+    def shutdown(self):
+        """
+        Stop the reader. The calls abandoned after a timeout are not waited
+        for.
+        """
+        self.oExecutor.shutdown(wait=False, cancel_futures=True)
+        self.oLoop.close()
+
+
+def create_executor(nJobs=1, sJobsBackend="thread", nReadTimeout=None):
+    """
+    Return a pool of nJobs workers of type sJobsBackend ("thread" or
+    "process") reading the EXIF information, or None if nJobs is 1. For the
+    "asyncio" type, return an AsyncExifReader keeping nJobs reads in flight,
+    each abandoned after nReadTimeout seconds.
+    """
+    if sJobsBackend == "asyncio":
+        return AsyncExifReader(nJobs, nReadTimeout)
+    elif nJobs <= 1:
+        return None
+    elif sJobsBackend == "process":
+        if oGlobalThrottle is None:
+            return concurrent.futures.ProcessPoolExecutor(max_workers=nJobs)
+        # The worker processes share the limits of the run
+        return concurrent.futures.ProcessPoolExecutor(
+            max_workers=nJobs,
+            initializer=init_throttle,
+            initargs=(oGlobalThrottle.dRates, oGlobalThrottle.sControlPath, nJobs),
+        )
+    else:
+        return concurrent.futures.ThreadPoolExecutor(max_workers=nJobs)
+
+
+def read_image_exif_timed(sImagePath, dBackends=None):
+    """
+    Return the tuple of read_image_exif for the image and the seconds taken
+    to read it.
+    """
+    nStart = time.perf_counter()
+    tResult = read_image_exif(sImagePath, dBackends)
+    return tResult, time.perf_counter() - nStart
+
+
+def read_images_exif(lPathImages, oExecutor=None, dBackends=None):
+    """
+    Read the EXIF date of the image files with the backends of dBackends (see
+    get_backend_chain), with the workers of oExecutor if provided. Yield the
+    (date, error) tuples of read_image_exif in the order of lPathImages. The
+    time taken by each file is recorded in the statistics if they are
+    collected, except for the files left to ExifTool, which records them.
+    """
+    if isinstance(oExecutor, AsyncExifReader):
+        for sImagePath, (tResult, nSeconds) in zip(
+            lPathImages, oExecutor.read(lPathImages, dBackends)
+        ):
+            if tResult[1] != "Unsupported":
+                record_latency(sImagePath, nSeconds)
+            yield tResult
+        return
+    if dGlobalStats is None:
+        fRead = read_image_exif
+    else:
+        fRead = read_image_exif_timed
+    if dBackends:
+        fRead = functools.partial(fRead, dBackends=dBackends)
+    if oExecutor is None or len(lPathImages) <= 1:
+        iResults = map(fRead, lPathImages)
+    else:
+        # Send the files by chunks to limit the inter-process communication,
+        # the threads ignore it
+        nChunkSize = max(1, min(64, len(lPathImages) // 64))
+        iResults = oExecutor.map(fRead, lPathImages, chunksize=nChunkSize)
+    if dGlobalStats is None:
+        yield from iResults
+    else:
+        for sImagePath, (tResult, nSeconds) in zip(lPathImages, iResults):
+            if tResult[1] != "Unsupported":
+                record_latency(sImagePath, nSeconds)
+            yield tResult
+
+
+def iter_images_with_exif(
+    iChunks,
+    bCpImageNoExif=False,
+    nJobs=1,
+    sJobsBackend="thread",
+    nNbrImages=None,
+    dKeys=None,
+    bProgress=True,
+    nReadTimeout=None,
+    sBackend=None,
+    bDiskOrder=False,
+):
+    """
+    Inspect the images of each list of iChunks and yield for each of them
+    the tuple (image path, EXIF DateTimeOriginal), in the order of the lists.
+    Images with no EXIF are yielded with None if bCpImageNoExif is True,
+    skipped otherwise. nNbrImages is the total number of images, if known.
+    dKeys holds the file keys already known of the images.
+    The images are read by nJobs workers, the result does not depend on it.
+    With the "asyncio" workers, an image taken more than nReadTimeout seconds
+    to read is handled as an image with no EXIF.
+    The images are read by the backend sBackend, chosen for each type of
+    file if it is "auto", or by the default backends if it is None.
+    If bDiskOrder is True, the images of each list are read in the order of
+    their position on the disk, see get_disk_position.
+    A progress line is printed if bProgress is True.
+    """
+    oExecutor = create_executor(nJobs, sJobsBackend, nReadTimeout)
+    dProgress = start_progress("Extraction EXIF", nNbrImages)
+    try:
+        i = 1
+        for lPathImages in iChunks:
+            # Files already read in a previous run are taken from the cache
+            dFileKeys = {}
+            dCached = {}
+            if oGlobalCache is not None:
+                for sImagePath in lPathImages:
+                    tKey = get_file_key(sImagePath, dKeys)
+                    if tKey is not None:
+                        dFileKeys[sImagePath] = tKey
+                dCached = get_cached_exif(dFileKeys)
+            dResults = {}  # Results to store in the cache
+            if sBackend is not None:
+                # The files read to choose the backends are not read again
+                dResults = update_backends(
+                    [s for s in lPathImages if s not in dCached], sBackend
+                )
+                dCached.update(dResults)
+            dBackends = dict(dGlobalBackends)
+            # The videos, and the images read by ExifTool, are read before
+            # the others so that the files left to ExifTool are given to it
+            # at once
+            lPathVideos = [
+                s
+                for s in lPathImages
+                if s not in dCached
+                and (
+                    get_extension(s) in VIDEOTYPE
+                    or dBackends.get(get_extension(s)) == "exiftool"
+                )
+            ]
+            setPathVideos = set(lPathVideos)
+            lPathPictures = [
+                s for s in lPathImages if s not in dCached and s not in setPathVideos
+            ]
+            if bDiskOrder:
+                lPathVideos = sort_on_disk(lPathVideos)
+                lPathPictures = sort_on_disk(lPathPictures)
+            # The videos are read from their headers when possible, the
+            # others are all given to the same ExifTool process
+            dVideoResults = dict(
+                zip(
+                    lPathVideos,
+                    read_images_exif(lPathVideos, oExecutor, dBackends),
+                )
+            )
+            dVideoTags = get_videos_tags(
+                [s for s in lPathVideos if dVideoResults[s][1] == "Unsupported"]
+            )
+            # The results of the pictures read before their turn are kept
+            # until it comes
+            iPictures = zip(
+                lPathPictures,
+                read_images_exif(lPathPictures, oExecutor, dBackends),
+            )
+            dPictureResults = {}
+            for sImagePath in lPathImages:
+                if nNbrImages is None:
+                    sCount = str(i)
+                else:
+                    sCount = "%s/%s" % (i, nNbrImages)
+                my_print(
+                    "Extraction EXIF from %s: %s"
+                    % (sCount, os.path.basename(sImagePath)),
+                    VERBOSE,
+                )
+                if bProgress:
+                    update_progress(dProgress)
+                i = i + 1
+                if sImagePath in dCached:
+                    sExifDate, sError = dCached[sImagePath]
+                elif sImagePath in dVideoResults:
+                    sExifDate, sError = dVideoResults[sImagePath]
+                    if sError == "Unsupported":
+                        try:
+                            sExifDate = get_date_from_tags(
+                                dVideoTags.get(sImagePath, {}),
+                                get_extension(sImagePath) in VIDEOTYPE,
+                            )
+                            sError = None
+                        except KeyError:
+                            sExifDate, sError = None, "KeyError"
+                        # Failures of ExifTool are not kept, they may not
+                        # happen again
+                        if sImagePath in dVideoTags:
+                            dResults[sImagePath] = (sExifDate, sError)
+                    elif sError != "TimeoutError":
+                        dResults[sImagePath] = (sExifDate, sError)
+                else:
+                    while sImagePath not in dPictureResults:
+                        sPath, tResult = next(iPictures)
+                        dPictureResults[sPath] = tResult
+                    sExifDate, sError = dPictureResults.pop(sImagePath)
+                    # A timeout may not happen again
+                    if sError != "TimeoutError":
+                        dResults[sImagePath] = (sExifDate, sError)
+
+                if sError is None:
+                    yield sImagePath, sExifDate
+                elif sError == "KeyError":
+                    my_print(
+                        "No EXIF information found in file '" + sImagePath + "'",
+                        VERBOSE,
+                    )
+                    record_error("no_exif", sImagePath)
+                    if bCpImageNoExif:
+                        yield sImagePath, None
+                    else:
+                        my_print("Skipping.", VERBOSE)
+                elif sError == "TimeoutError":
+                    my_print("Timeout reading EXIF of '" + sImagePath + "'", VERBOSE)
+                    record_error("exif_read_timeout", sImagePath)
+                    my_print("Using this image as no EXIF is present", VERBOSE)
+                    if bCpImageNoExif:
+                        yield sImagePath, None
+                    else:
+                        my_print("Skipping.", VERBOSE)
+                else:
+                    my_print(
+                        "Unknown error reading EXIF of '" + sImagePath + "'", VERBOSE
+                    )
+                    record_error("exif_read_error", sImagePath)
+                    my_print("Using this image as no EXIF is present", VERBOSE)
+                    if bCpImageNoExif:
+                        yield sImagePath, None
+                    else:
+                        my_print("Skipping.", VERBOSE)
+
+                my_print("----", VERBOSE)
+
+            if oGlobalCache is not None:
+                set_cached_exif(dFileKeys, dResults)
+            if dGlobalStats is not None:
+                count_in_stats(
+                    "extraction", len(lPathImages), get_files_size(lPathImages, dKeys)
+                )
+    finally:
+        if bProgress:
+            end_progress(dProgress)
+        if oExecutor is not None:
+            oExecutor.shutdown()
+
+
+def get_images_with_exif(
+    lPathImages,
+    bCpImageNoExif=False,
+    nJobs=1,
+    sJobsBackend="thread",
+    dKeys=None,
+    bProgress=True,
+    sBackend=None,
+):
+    """
+    Inspect the images in list and return a dictionnary including:
+    * key: image path
+    * value: EXIF DateTimeOriginal
+    The images are read by nJobs workers, the result does not depend on it.
+    dKeys holds the file keys already known of the images.
+    A progress line is printed if bProgress is True.
+    sBackend is the backend reading the images, see iter_images_with_exif.
+    """
+
+    # Check if the image contain exif information
+    nNbrImages = len(lPathImages)
+    my_print("%s images found" % (nNbrImages), VERBOSE)
+    my_print("----", nMessageVerbosity=VERBOSE)
+    my_print("Getting EXIF information from files", VERBOSE)
+
+    lPathImages.sort()
+    dExif = {}
+    for sImagePath, sExifDate in iter_images_with_exif(
+        [lPathImages],
+        bCpImageNoExif,
+        nJobs,
+        sJobsBackend,
+        nNbrImages,
+        dKeys,
+        bProgress,
+        sBackend=sBackend,
+    ):
+        dExif[sImagePath] = sExifDate
+
+    return dExif
+
+
+def read_records_exif(lRecords, tOptions):
+    """
+    Read the EXIF date of the images of lRecords, sorted by path, and return
+    the list of the records kept: those with an EXIF date, and those without
+    if requested in the options. The images are read by chunks of
+    RECORD_CHUNK_SIZE, or DISK_ORDER_CHUNK_SIZE with --disk-order, their
+    paths are only built for their chunk.
+    """
+    nNbrImages = len(lRecords)
+    my_print("%s images found" % (nNbrImages), VERBOSE)
+    my_print("----", nMessageVerbosity=VERBOSE)
+    my_print("Getting EXIF information from files", VERBOSE)
+
+    dKeys = {}  # File keys of the images of the current chunk
+    if tOptions.DiskOrder:
+        nChunkSize = DISK_ORDER_CHUNK_SIZE
+    else:
+        nChunkSize = RECORD_CHUNK_SIZE
+
+    def iter_chunks():
+        for i in range(0, nNbrImages, nChunkSize):
+            dKeys.clear()
+            lPathImages = []
+            for oRecord in lRecords[i : i + nChunkSize]:
+                sImagePath = get_record_path(oRecord)
+                lPathImages.append(sImagePath)
+                if oRecord.tKey is not None:
+                    dKeys[sImagePath] = oRecord.tKey
+            yield lPathImages
+
+    # The images are yielded in the order of the records, less those skipped
+    lKept = []
+    iRecords = iter(lRecords)
+    for sImagePath, sExifDate in iter_images_with_exif(
+        iter_chunks(),
+        tOptions.CpNoExif,
+        tOptions.Jobs,
+        tOptions.JobsBackend,
+        nNbrImages,
+        dKeys,
+        nReadTimeout=tOptions.ReadTimeout,
+        sBackend=tOptions.Backend,
+        bDiskOrder=tOptions.DiskOrder,
+    ):
+        oRecord = next(iRecords)
+        while get_record_path(oRecord) != sImagePath:
+            oRecord = next(iRecords)
+        oRecord.date = encode_exif_date(sExifDate)
+        lKept.append(oRecord)
+
+    return lKept
+
+
+def get_date_layout(tOptions):
+    """
+    Return the layout of the date subdirectories given by the options, or
+    None if the images are not written in date subdirectories.
+    """
+    if tOptions.DateLayout is not None:
+        return tOptions.DateLayout
+    if tOptions.DateDirectory:
+        return DEFAULT_DATE_LAYOUT
+    return None
+
+
+def format_date_layout(sDateLayout, sExif):
+    """
+    Return the layout sDateLayout with its fields (YYYY, MM, DD, HH) replaced
+    by those of the EXIF date sExif. A field missing in the date is "00".
+    """
+    lFields = re.split("[-:/ _]", sExif.strip()) + ["00"] * len(DATE_LAYOUT_FIELDS)
+    dFields = dict(zip(DATE_LAYOUT_FIELDS, lFields))
+    return DATE_LAYOUT_PATTERN.sub(lambda oMatch: dFields[oMatch.group(0)], sDateLayout)
+
+
+def create_path_with_exif(sPath, sExif, bCpImageNoExif, sDateLayout=None):
+    """
+    Create a file path with the exif date.
+
+    sPath is the original image filename.
+    sExif is the exif of the image.
+    Returns the same directory as sPath, but with the filename replaced by
+    the date values of the EXIF string. If sDateLayout is given, returns
+    instead the file name in the date subdirectories of this layout (see
+    format_date_layout), or in "NoExif" for an image with no EXIF.
+    """
+    sExtension = (os.path.splitext(sPath)[1]).lower()
+    if sExif is not None:
+        sNewFileName = sExif.replace(":", "-").replace(" ", "_") + sExtension
+
+        if sDateLayout is not None:
+            sPathNew = format_date_layout(sDateLayout, sExif) + "/" + sNewFileName
+        else:
+            sPathNew = os.path.join(os.path.dirname(sPath), sNewFileName)
+
+        # Check if the file are not already been renamed correctly
+        if sPathNew == sPath:
+            my_print(
+                "Warning: File is already in the right format. Skipping '%s'" % (sPath),
+                VERBOSE,
+            )
+    elif bCpImageNoExif:
+        if sDateLayout is not None:
+            sPathNew = NO_EXIF_DIRECTORY + os.path.basename(sPath)
+        else:
+            sPathNew = sPath
+
+    return sPathNew
+
+
+def create_new_path_for_image(sPathOld, sExif, sInputPath, tOptions):
+    """
+    Based on the input path sInputPath where the image sPathOld was found, its
+    Exif information and the options, create the new path for the image.
+    Returns None if the image has no new path.
+    """
+
+    # If there is no destination, the images are copy/overwritten
+    # in the same directory than the input
+    if tOptions.OutputDirectory is None:
+        return create_path_with_exif(sPathOld, sExif, tOptions.CpNoExif)
+    elif tOptions.CopyTree:  # Recreate the same tree in the output
+        # Use the provided input directory for the image file.
+        #  Remove this first part of the input directory,
+        #   leaving only the part to be created.
+        sDirToRemove = os.path.dirname(sInputPath)
+        # "1" in "[1:]" is used to remove the first "/",
+        #  so the path can be merged (see http://ur1.ca/ogdev)
+        sSubDirectory = os.path.dirname(sPathOld).replace(sDirToRemove, "")[1:]
+        sNewDirectory = os.path.join(tOptions.OutputDirectory, sSubDirectory)
+        sDateLayout = get_date_layout(tOptions)
+        if sDateLayout is not None:
+            # The date subdirectories are in the copied directory
+            return os.path.join(
+                sNewDirectory,
+                create_path_with_exif(sPathOld, sExif, tOptions.CpNoExif, sDateLayout),
+            )
+        return create_path_with_exif(
+            os.path.join(sNewDirectory, os.path.basename(sPathOld)),
+            sExif,
+            tOptions.CpNoExif,
+        )
+    else:  # Output directory given, all the files will be written there
+        sDateLayout = get_date_layout(tOptions)
+        sFilepath = create_path_with_exif(
+            sPathOld, sExif, tOptions.CpNoExif, sDateLayout
+        )
+        if sDateLayout is not None:
+            sFileBasename = sFilepath
+        else:
+            sFileBasename = os.path.basename(sFilepath)
+        return os.path.join(tOptions.OutputDirectory, sFileBasename)
+
+
+def create_records_new_path(lRecords, tOptions):
+    """
+    Based on the input path, the Exif information and the options, create the
+    new path of the images of lRecords. Return the list of the records having
+    a new path.
+    """
+    lRecordsNewPath = []
+    for oRecord in lRecords:
+        sPathNew = create_new_path_for_image(
+            get_record_path(oRecord),
+            decode_exif_date(oRecord.date),
+            oRecord.sInputPath,
+            tOptions,
+        )
+        if sPathNew is not None:
+            oRecord.sNewDirectory, oRecord.sNewName = split_path(sPathNew)
+            lRecordsNewPath.append(oRecord)
+
+    return lRecordsNewPath
+
+
+def split_date_directories(lRecords, sDateLayout, nMaxEntries):
+    """
+    Move the images of lRecords having an EXIF date to a subdirectory of the
+    next date field of sDateLayout (the day after the month, the hour after
+    the day) when their date directory would hold more than nMaxEntries
+    entries, counting those already there, until no directory is too large
+    or the hours are reached. The images of the same date stay together, and
+    those whose name is already used in their directory stay in it, so that
+    their collision suffixes continue. The files already in the destination
+    are not moved. The subdirectories of a date directory split are not
+    counted in its entries: a month holds up to 31 days, a day 24 hours.
+    The images with no EXIF are split by split_no_exif_directories.
+    """
+    nField = max(
+        (DATE_LAYOUT_FIELDS.index(s) for s in DATE_LAYOUT_PATTERN.findall(sDateLayout)),
+        default=-1,
+    )
+    dDirectories = {}
+    for oRecord in lRecords:
+        if oRecord.date is not None:
+            dDirectories.setdefault(oRecord.sNewDirectory, []).append(oRecord)
+    dPrefixDirectories = {}
+    # Index of the destination directories, without ignoring the images
+    # about to be renamed as get_unique_records_path does
+    dDestination = {}
+    for sField in DATE_LAYOUT_FIELDS[nField + 1 :]:
+        dSplit = {}
+        for sPrefix, lDirectoryRecords in dDirectories.items():
+            sDirectory = get_prefix_directory(sPrefix, dPrefixDirectories)
+            tDirectoryIndex = get_destination_index(sDirectory, dDestination)
+            nEntries = len(lDirectoryRecords) + len(tDirectoryIndex[0])
+            if nEntries <= nMaxEntries:
+                continue
+            my_print(
+                "Directory '%s' would hold %s entries, split by %s"
+                % (sDirectory, nEntries, sField),
+                VERBOSE,
+            )
+            for oRecord in lDirectoryRecords:
+                if os.path.splitext(oRecord.sNewName) in tDirectoryIndex[1]:
+                    continue
+                sSubDirectory = format_date_layout(
+                    sField, decode_exif_date(oRecord.date)
+                )
+                oRecord.sNewDirectory = sys.intern(sPrefix + sSubDirectory + "/")
+                dSplit.setdefault(oRecord.sNewDirectory, []).append(oRecord)
+        dDirectories = dSplit
+
+    split_no_exif_directories(lRecords, nMaxEntries, dDestination)
+
+
+def split_no_exif_directories(lRecords, nMaxEntries, dDestination):
+    """
+    Move the images of lRecords having no EXIF date to numbered subdirectories
+    "001", "002"... of their "NoExif" directory when it would hold more than
+    nMaxEntries entries, counting those already there. Each subdirectory
+    holds at most nMaxEntries entries, those already there included, in the
+    order of lRecords. As in split_date_directories, the images whose name is
+    already used in the "NoExif" directory, or in one of its subdirectories,
+    go there so that their collision suffixes continue. dDestination is the
+    index of the destination directories, see get_destination_index.
+    """
+    dDirectories = {}
+    for oRecord in lRecords:
+        if oRecord.date is None and oRecord.sNewDirectory.endswith(NO_EXIF_DIRECTORY):
+            dDirectories.setdefault(oRecord.sNewDirectory, []).append(oRecord)
+    dPrefixDirectories = {}
+    for sPrefix, lDirectoryRecords in dDirectories.items():
+        sDirectory = get_prefix_directory(sPrefix, dPrefixDirectories)
+        tDirectoryIndex = get_destination_index(sDirectory, dDestination)
+        nEntries = len(lDirectoryRecords) + len(tDirectoryIndex[0])
+        if nEntries <= nMaxEntries:
+            continue
+        my_print(
+            "Directory '%s' would hold %s entries, split in numbered subdirectories"
+            % (sDirectory, nEntries),
+            VERBOSE,
+        )
+        # Subdirectory of each name already used in a numbered subdirectory
+        dUsed = {}
+        lSubdirectories = sorted(
+            (s for s in tDirectoryIndex[0] if s.isdigit()), key=int
+        )
+        for sSubDirectory in lSubdirectories:
+            for tName in get_destination_index(
+                os.path.join(sDirectory, sSubDirectory), dDestination
+            )[1]:
+                dUsed.setdefault(tName, sSubDirectory)
+        # Number of entries of each numbered subdirectory
+        dCount = {
+            s: len(get_destination_index(os.path.join(sDirectory, s), dDestination)[0])
+            for s in lSubdirectories
+        }
+        nSubDirectory = 1
+        for oRecord in lDirectoryRecords:
+            tName = os.path.splitext(oRecord.sNewName)
+            if tName in tDirectoryIndex[1]:
+                continue
+            sSubDirectory = dUsed.get(tName)
+            if sSubDirectory is None:
+                while True:
+                    sSubDirectory = "%03d" % (nSubDirectory)
+                    if dCount.get(sSubDirectory, 0) < nMaxEntries:
+                        break
+                    nSubDirectory = nSubDirectory + 1
+                dUsed[tName] = sSubDirectory
+            dCount[sSubDirectory] = dCount.get(sSubDirectory, 0) + 1
+            oRecord.sNewDirectory = sys.intern(sPrefix + sSubDirectory + "/")
+
+
+def add_to_destination_index(sName, tDirectoryIndex):
+    """
+    Add the file name sName to the index of its destination directory.
+    """
+    setNames, dSuffix = tDirectoryIndex
+    setNames.add(sName)
+    lKeys = [(os.path.splitext(sName), 0, 1)]
+    oMatch = COLLISION_SUFFIX.match(sName)
+    if oMatch is not None:
+        lKeys.append(
+            (
+                (oMatch.group(1), oMatch.group(3)),
+                int(oMatch.group(2)),
+                len(oMatch.group(2)),
+            )
+        )
+    for tKey, nSuffix, nNumberDigit in lKeys:
+        nLast, nLastDigit = dSuffix.get(tKey, (0, 1))
+        dSuffix[tKey] = (max(nLast, nSuffix), max(nLastDigit, nNumberDigit))
+
+
+def get_destination_index(sDirectory, dIndex, dIgnored=None):
+    """
+    Return the index of the destination directory sDirectory, listing it only
+    the first time. dIndex holds the index of each directory already listed
+    (key: directory, value: tuple (names, suffixes)) where:
+    * names is the set of the file names in the directory
+    * suffixes is a dictionnary with key: tuple (root, extension) of a name
+      which exists, alone or with a collision suffix, and value: tuple
+      (largest suffix, largest number of digits), the name alone counting as
+      suffix 0.
+    The images about to be renamed are not indexed: dIgnored gives their
+    names (key: directory, value: set of names).
+    """
+    if sDirectory not in dIndex:
+        tDirectoryIndex = (set(), {})
+        try:
+            lNames = os.listdir(sDirectory or ".")
+        except OSError:
+            lNames = []
+        setIgnored = ()
+        if dIgnored is not None:
+            setIgnored = dIgnored.get(sDirectory, ())
+        for sName in lNames:
+            if sName not in setIgnored:
+                add_to_destination_index(sName, tDirectoryIndex)
+        dIndex[sDirectory] = tDirectoryIndex
+
+    return dIndex[sDirectory]
+
+
+def get_existing_suffix(sNewPath, dIndex, dIgnored=None):
+    """
+    Return the tuple (largest suffix, number of digits) of the files already
+    named sNewPath, alone or with a collision suffix, in the destination
+    directory, or None if there is no such file.
+    """
+    tDirectoryIndex = get_destination_index(os.path.dirname(sNewPath), dIndex, dIgnored)
+    return tDirectoryIndex[1].get(os.path.splitext(os.path.basename(sNewPath)))
+
+
+def is_in_destination(sNewPath, dIndex):
+    """
+    Return True if the file sNewPath exists, according to the destination
+    index dIndex.
+    """
+    tDirectoryIndex = get_destination_index(os.path.dirname(sNewPath), dIndex)
+    return os.path.basename(sNewPath) in tDirectoryIndex[0]
+
+
+def get_source_names(lRecords, setDirectories):
+    """
+    Return the names of the images of lRecords which are in one of the
+    directories of setDirectories (key: directory, value: set of names).
+    """
+    dSourceNames = {}
+    dDirectories = {}
+    for oRecord in lRecords:
+        sDirectory = get_prefix_directory(oRecord.sDirectory, dDirectories)
+        if sDirectory in setDirectories:
+            dSourceNames.setdefault(sDirectory, set()).add(oRecord.sName)
+    return dSourceNames
+
+
+def has_chained_records(lRecords):
+    """
+    Return True if the new path of an image of lRecords is the path of
+    another image of lRecords, in which case the order of the copies matters.
+    """
+    dDirectories = {}
+    setNewDirectories = set(
+        get_prefix_directory(oRecord.sNewDirectory, dDirectories)
+        for oRecord in lRecords
+    )
+    dSourceNames = get_source_names(lRecords, setNewDirectories)
+    for oRecord in lRecords:
+        sDirectory = get_prefix_directory(oRecord.sNewDirectory, dDirectories)
+        if oRecord.sNewName in dSourceNames.get(sDirectory, ()):
+            return True
+    return False
+
+
+def get_existing_names(sNewPath, dIndex, dIgnored=None):
+    """
+    Return the names of the files already named sNewPath, alone or with a
+    collision suffix, in the destination directory, according to the
+    destination index dIndex.
+    """
+    setNames, dSuffix = get_destination_index(
+        os.path.dirname(sNewPath), dIndex, dIgnored
+    )
+    sName = os.path.basename(sNewPath)
+    sRoot, sExtension = os.path.splitext(sName)
+    tExistingSuffix = dSuffix.get((sRoot, sExtension))
+    if tExistingSuffix is None:
+        return []
+    lNames = []
+    if sName in setNames:
+        lNames.append(sName)
+    nLast, nNumberDigit = tExistingSuffix
+    for i in range(nLast + 1):
+        for nDigit in range(1, nNumberDigit + 1):
+            sSuffixName = "%s_%s%s" % (sRoot, str(i).zfill(nDigit), sExtension)
+            if sSuffixName in setNames and sSuffixName not in lNames:
+                lNames.append(sSuffixName)
+    return lNames
+
+
+def get_file_digest(sPath, nSize=None):
+    """
+    Return the BLAKE2 digest of the first nSize bytes of the file sPath, or
+    of all its content if nSize is None.
+    """
+    oHash = hashlib.blake2b()
+    with open_image_file(sPath) as f:
+        if nSize is not None:
+            oHash.update(f.read(nSize))
+        else:
+            for block in iter(lambda: f.read(COPY_BLOCK_SIZE), b""):
+                oHash.update(block)
+    return oHash.digest()
+
+
+def find_identical_files(lFiles):
+    """
+    Find the files of lFiles, list of tuples (path, size), identical to a
+    file before them in the list. The files are compared by size, then by the
+    digest of their first DEDUPE_HEAD_SIZE bytes, then by the digest of their
+    whole content, so a file with a unique size is not read and a file with
+    a unique beginning is not read completely. A file which cannot be read is
+    not identical to any other. Return a dictionnary with key: index in
+    lFiles of a file, value: index of the first file identical to it.
+    """
+    dBySize = {}
+    for i, (sPath, nSize) in enumerate(lFiles):
+        dBySize.setdefault(nSize, []).append(i)
+
+    dIdentical = {}
+    for nSize, lSameSize in dBySize.items():
+        if len(lSameSize) < 2:
+            continue
+        lGroups = [lSameSize]
+        for nHeadSize in (DEDUPE_HEAD_SIZE, None):
+            # The beginning of a small file is all the file
+            if nHeadSize is None and nSize <= DEDUPE_HEAD_SIZE:
+                break
+            lNextGroups = []
+            for lGroup in lGroups:
+                dByDigest = {}
+                for i in lGroup:
+                    try:
+                        digest = get_file_digest(lFiles[i][0], nHeadSize)
+                    except OSError:
+                        continue
+                    dByDigest.setdefault(digest, []).append(i)
+                lNextGroups.extend(l for l in dByDigest.values() if len(l) > 1)
+            lGroups = lNextGroups
+        for lGroup in lGroups:
+            for i in lGroup[1:]:
+                dIdentical[i] = lGroup[0]
+
+    return dIdentical
+
+
+def scan_library_directory(sDirectory):
+    """
+    List the directory sDirectory of a library and return a tuple including:
+    * the list of the "name/size" strings of its files named by the script
+    * the list of its subdirectories names (symlinks excluded)
+    With the cache, the listing of a directory which did not change since the
+    last run is read from the cache.
+    """
+    lFiles = []
+    lSubdirectories = []
+    try:
+        stDirectory = os.stat(sDirectory)
+        if oGlobalCache is not None:
+            tListing = get_cached_directory(
+                sDirectory, stDirectory, "library_directories"
+            )
+            if tListing is not None:
+                return tListing
+
+        with os.scandir(sDirectory) as it:
+            for entry in it:
+                if entry.is_dir():
+                    if not entry.is_symlink():
+                        lSubdirectories.append(entry.name)
+                elif LIBRARY_NAME.match(entry.name) and not entry.is_symlink():
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    lFiles.append("%s/%s" % (entry.name, st.st_size))
+    except OSError as inst:
+        my_print("Cannot list directory '%s': %s" % (sDirectory, inst), VERBOSE)
+        return [], []
+
+    if oGlobalCache is not None:
+        set_cached_directory(
+            sDirectory, stDirectory, lFiles, lSubdirectories, "library_directories"
+        )
+
+    return lFiles, lSubdirectories
+
+
+def get_library_index(sLibrary):
+    """
+    Return the index of the images of the library sLibrary, the files of its
+    tree named by the script, as a dictionnary including:
+    * key: tuple (root, extension) of a name without collision suffix, the
+      root being the date "YYYY-MM-DD_HH-MM-SS"
+    * value: list of the tuples (size, suffix, number of digits, path) of the
+      files with this name, alone (suffix 0) or with a collision suffix
+    The names and sizes are only read again for the directories which
+    changed since the last run when the cache is used.
+    """
+    my_print("Indexing library '%s'" % (sLibrary), VERBOSE)
+    dLibrary = {}
+    lDirectories = [sLibrary]
+    nFiles = 0
+    while len(lDirectories) > 0:
+        sDirectory = lDirectories.pop()
+        lFiles, lSubdirectories = scan_library_directory(sDirectory)
+        for sFile in lFiles:
+            sName, sSize = sFile.rsplit("/", 1)
+            oMatch = LIBRARY_NAME.match(sName)
+            if oMatch.group(2) is None:
+                nSuffix, nNumberDigit = 0, 1
+            else:
+                nSuffix, nNumberDigit = int(oMatch.group(2)), len(oMatch.group(2))
+            dLibrary.setdefault((oMatch.group(1), oMatch.group(3).lower()), []).append(
+                (int(sSize), nSuffix, nNumberDigit, os.path.join(sDirectory, sName))
+            )
+        nFiles = nFiles + len(lFiles)
+        for sSubdirectory in lSubdirectories:
+            lDirectories.append(os.path.join(sDirectory, sSubdirectory))
+    my_print("%s images found in the library" % (nFiles), VERBOSE)
+    count_in_stats("library", nFiles)
+
+    return dLibrary
+
+
+def get_image_size(sPath):
+    """
+    Return the size of the image sPath, which may be in an archive, or None
+    if it cannot be read.
+    """
+    try:
+        return os.stat(sPath).st_size
+    except OSError:
+        pass
+    try:
+        with open_image_file(sPath) as f:
+            return f.seek(0, os.SEEK_END)
+    except (OSError, KeyError):
+        return None
+
+
+def find_library_original(sPath, lLibraryPaths):
+    """
+    Return the first file of lLibraryPaths identical to the image sPath, or
+    None if there is none or if sPath cannot be read. The files are first
+    compared by the digest of their first DEDUPE_HEAD_SIZE bytes, and only
+    those having the same beginning by the digest of their whole content.
+    """
+    try:
+        sDigest = get_file_digest(sPath, DEDUPE_HEAD_SIZE)
+    except (OSError, KeyError):
+        return None
+    sFullDigest = None
+    for sLibraryPath in lLibraryPaths:
+        try:
+            if get_file_digest(sLibraryPath, DEDUPE_HEAD_SIZE) != sDigest:
+                continue
+            if sFullDigest is None:
+                sFullDigest = get_file_digest(sPath)
+            if get_file_digest(sLibraryPath) == sFullDigest:
+                return sLibraryPath
+        except (OSError, KeyError):
+            continue
+    return None
+
+
+def skip_library_records(lRecords, dLibrary):
+    """
+    Return the records of lRecords which are not already in the library
+    index dLibrary (see get_library_index): an image with an EXIF date is in
+    the library if a file of the library has its new name, alone or with a
+    collision suffix, and the same content (see find_library_original).
+    Only the images whose name and size are in the library are read.
+    """
+    lKept = []
+    for oRecord in lRecords:
+        lFiles = None
+        if oRecord.date is not None:
+            sRoot, sExtension = os.path.splitext(oRecord.sNewName)
+            lFiles = dLibrary.get((sRoot, sExtension.lower()))
+        if lFiles:
+            sPath = get_record_path(oRecord)
+            if oRecord.tKey is not None:
+                nSize = oRecord.tKey[2]
+            else:
+                nSize = get_image_size(sPath)
+            sOriginal = None
+            lSameSize = [t[3] for t in lFiles if t[0] == nSize]
+            if len(lSameSize) > 0:
+                with measure_phase("library"):
+                    sOriginal = find_library_original(sPath, lSameSize)
+            if sOriginal is not None:
+                my_print(
+                    "File '%s' is already in the library as '%s'. Skipping."
+                    % (sPath, sOriginal),
+                    VERBOSE,
+                )
+                emit_event("duplicate", path=sPath, original=sOriginal)
+                continue
+        lKept.append(oRecord)
+    my_print("%s images already in the library" % (len(lRecords) - len(lKept)), VERBOSE)
+
+    return lKept
+
+
+def get_library_suffix(sNewName, dLibrary, tExistingSuffix=None):
+    """
+    Return the tuple (largest suffix, number of digits) of the files named
+    sNewName, alone or with a collision suffix, in the library index dLibrary
+    and in the destination, whose suffix is tExistingSuffix. Return None if
+    there is no such file.
+    """
+    sRoot, sExtension = os.path.splitext(sNewName)
+    for _, nSuffix, nNumberDigit, _ in dLibrary.get((sRoot, sExtension.lower()), ()):
+        if tExistingSuffix is None:
+            tExistingSuffix = (nSuffix, nNumberDigit)
+        else:
+            tExistingSuffix = (
+                max(tExistingSuffix[0], nSuffix),
+                max(tExistingSuffix[1], nNumberDigit),
+            )
+    return tExistingSuffix
+
+
+def dedupe_records(lNewPath, sNewPath, sDedupe, dIndex=None, dIgnored=None):
+    """
+    Look for identical files among the records of lNewPath, sorted by path,
+    which all have the new path sNewPath, and the files already in the
+    destination with this name or a collision suffix. An image identical to
+    a file already in the destination is skipped. An image identical to
+    another image is skipped if sDedupe is "skip", or hard linked to it if
+    sDedupe is "link" (see ImageRecord.oOriginal). Return the records to
+    keep. A symbolic link is compared by the file it points to, and is the
+    original of identical images only if they all are symbolic links.
+    """
+    lExisting = []
+    if dIndex is not None:
+        sDirectory = os.path.dirname(sNewPath)
+        lExisting = [
+            os.path.join(sDirectory, sName)
+            for sName in get_existing_names(sNewPath, dIndex, dIgnored)
+        ]
+    if len(lExisting) + len(lNewPath) < 2:
+        return lNewPath
+
+    with measure_phase("dedupe"):
+        # The files already in the destination are the originals, then the
+        # images which are not symbolic links
+        lFiles = []
+        lCandidates = []
+        lLinks = []
+        for candidate in lExisting + lNewPath:
+            if isinstance(candidate, str):
+                sPath = candidate
+            else:
+                sPath = get_record_path(candidate)
+            try:
+                st = os.lstat(sPath)
+                if stat.S_ISLNK(st.st_mode):
+                    st = os.stat(sPath)
+                    if not isinstance(candidate, str):
+                        lLinks.append((candidate, (sPath, st.st_size)))
+                        continue
+            except OSError:
+                # Dangling symbolic links included
+                continue
+            lFiles.append((sPath, st.st_size))
+            lCandidates.append(candidate)
+        for candidate, tFile in lLinks:
+            lFiles.append(tFile)
+            lCandidates.append(candidate)
+        dIdentical = find_identical_files(lFiles)
+
+    if len(dIdentical) == 0:
+        return lNewPath
+    lKept = []
+    setSkipped = set()
+    for i, candidate in enumerate(lCandidates):
+        # The files already in the destination are left as they are
+        if i not in dIdentical or isinstance(candidate, str):
+            continue
+        original = lCandidates[dIdentical[i]]
+        if isinstance(original, str):
+            my_print(
+                "File '%s' is identical to '%s', already in the destination. Skipping."
+                % (lFiles[i][0], original),
+                VERBOSE,
+            )
+            emit_event("duplicate", path=lFiles[i][0], original=original)
+            setSkipped.add(id(candidate))
+        elif sDedupe == "link":
+            candidate.oOriginal = original
+            my_print(
+                "File '%s' is identical to '%s', its new path will be a hard link."
+                % (lFiles[i][0], lFiles[dIdentical[i]][0]),
+                VERBOSE,
+            )
+        else:
+            my_print(
+                "File '%s' is identical to '%s'. Skipping."
+                % (lFiles[i][0], lFiles[dIdentical[i]][0]),
+                VERBOSE,
+            )
+            emit_event(
+                "duplicate", path=lFiles[i][0], original=lFiles[dIdentical[i]][0]
+            )
+            setSkipped.add(id(candidate))
+        count_in_stats("dedupe", 1, lFiles[i][1])
+    for oRecord in lNewPath:
+        if id(oRecord) not in setSkipped:
+            lKept.append(oRecord)
+
+    return lKept
+
+
+def get_unique_records_path(
+    lRecords, dIndex=None, sDedupe=None, dLibrary=None, bIndexNewNames=True
+):
+    """
+    Identifying the collision for new path being the same
+    in the records of lRecords
+    To avoid the collision, add "_N" before the extension.
+    If the destination index dIndex is provided, the files already in the
+    destination directories are also taken into account: the numbering
+    continues after the largest suffix already used. So are the files of the
+    library index dLibrary, if provided, wherever they are in the library.
+    If sDedupe is provided, the identical files having the same new path are
+    found before numbering them, see dedupe_records.
+    The new names are added to dIndex, unless bIndexNewNames is False.
+    Return the list of the records to copy, with their unique new name.
+    """
+
+    my_print("Checking uniqueness of output file name", VERBOSE)
+    # Records having the same new path (key: new directory, then new name),
+    # a single record or the list of the records
+    dNewOldPath = {}
+    # First record of each new path, in the order of lRecords
+    lFirstRecords = []
+    for oRecord in lRecords:
+        dNames = dNewOldPath.setdefault(oRecord.sNewDirectory, {})
+        group = dNames.get(oRecord.sNewName)
+        if group is None:
+            dNames[oRecord.sNewName] = oRecord
+            lFirstRecords.append(oRecord)
+        elif isinstance(group, list):
+            group.append(oRecord)
+        else:
+            dNames[oRecord.sNewName] = [group, oRecord]
+    # The images themselves are not collisions
+    dIgnored = None
+    if dIndex is not None:
+        dDirectories = {}
+        dIgnored = get_source_names(
+            lRecords,
+            set(get_prefix_directory(s, dDirectories) for s in dNewOldPath),
+        )
+
+    lRecordsUnique = []
+    for oRecord in lFirstRecords:
+        group = dNewOldPath[oRecord.sNewDirectory][oRecord.sNewName]
+        if isinstance(group, list):
+            lNewPath = group
+        else:
+            lNewPath = [group]
+        sNewPath = get_record_new_path(oRecord)
+        lNewPath.sort(key=get_record_path)
+        tExistingSuffix = None
+        if dIndex is not None:
+            tExistingSuffix = get_existing_suffix(sNewPath, dIndex, dIgnored)
+        if dLibrary is not None:
+            tExistingSuffix = get_library_suffix(
+                oRecord.sNewName, dLibrary, tExistingSuffix
+            )
+        if sDedupe is not None and (len(lNewPath) > 1 or tExistingSuffix is not None):
+            lNewPath = dedupe_records(lNewPath, sNewPath, sDedupe, dIndex, dIgnored)
+            if len(lNewPath) == 0:
+                continue
+            oRecord = lNewPath[0]
+        nNbrImageWithThisExif = len(lNewPath)
+        if nNbrImageWithThisExif == 1 and tExistingSuffix is None:
+            # Ignore if origin and destination are the same
+            sOldPath = get_record_path(oRecord)
+            if sOldPath == sNewPath:
+                my_print(
+                    "File already has the right name and is in the destination directory.\n Ignoring '%s'"
+                    % (sNewPath),
+                    VERBOSE,
+                )
+                my_print("----", VERBOSE)
+            else:
+                lRecordsUnique.append(oRecord)
+                my_print(
+                    "EXIF date is unique, renaming\n %s --> %s"
+                    % ([sOldPath], sNewPath),
+                    VERBOSE,
+                )
+                my_print("----", VERBOSE)
+        else:
+            if tExistingSuffix is None:
+                my_print(
+                    "File %s is not unique! There is %s occurences"
+                    % (sNewPath, nNbrImageWithThisExif),
+                    VERBOSE,
+                )
+                nFirst = 0
+                nNumberDigit = len(str(nNbrImageWithThisExif))
+            else:
+                my_print(
+                    "File %s already exists in the destination directory, numbering continues after suffix %s"
+                    % (sNewPath, tExistingSuffix[0]),
+                    VERBOSE,
+                )
+                nFirst = tExistingSuffix[0] + 1
+                nNumberDigit = max(
+                    tExistingSuffix[1], len(str(nFirst + nNbrImageWithThisExif - 1))
+                )
+            # Update each image path by adding a numbe of digit before the extension.
+            i = nFirst
+            for oRecordWithSameExif in lNewPath:
+                sNewName = oRecordWithSameExif.sNewName
+                sExtension = os.path.splitext(sNewName)[1]
+                j = "_" + str(i).zfill(nNumberDigit)
+                oRecordWithSameExif.sNewName = re.sub(
+                    sExtension + "$", j + sExtension, sNewName
+                )
+                sOldImagePathWithSameExif = get_record_path(oRecordWithSameExif)
+                sNewImagePathUnique = get_record_new_path(oRecordWithSameExif)
+                if sOldImagePathWithSameExif == sNewImagePathUnique:
+                    my_print(
+                        "File already has the right name and is in the destination directory.\n Ignoring '%s'"
+                        % (sNewImagePathUnique),
+                        VERBOSE,
+                    )
+                    my_print("----", VERBOSE)
+                else:
+                    lRecordsUnique.append(oRecordWithSameExif)
+                i = i + 1
+                my_print(
+                    "Associating\n %s --> %s"
+                    % (sOldImagePathWithSameExif, sNewImagePathUnique),
+                    VERBOSE,
+                )
+            my_print("----", VERBOSE)
+
+    # The new names are taken for the next images
+    if dIndex is not None and bIndexNewNames:
+        for oRecord in lRecordsUnique:
+            add_to_destination_index(
+                oRecord.sNewName,
+                get_destination_index(
+                    get_prefix_directory(oRecord.sNewDirectory, dDirectories),
+                    dIndex,
+                    dIgnored,
+                ),
+            )
+
+    return lRecordsUnique
+
+
+def get_unique_path_for_images(dNewPathRawWithPossibleCollision, dIndex=None):
+    """
+    Identifying the collision for new path being the same
+    in the dictionnary dNewPathRawWithPossibleCollision
+    To avoid the collision, add "_N" before the extension.
+    Return the dictionnary (key: old path, value: unique new path) of the
+    images to copy. See get_unique_records_path.
+    """
+    lRecords = []
+    for sOldPath, sNewPath in dNewPathRawWithPossibleCollision.items():
+        oRecord = ImageRecord(*split_path(sOldPath), None)
+        oRecord.sNewDirectory, oRecord.sNewName = split_path(sNewPath)
+        lRecords.append(oRecord)
+
+    return dict(RecordPaths(get_unique_records_path(lRecords, dIndex)).items())
+
+
+def copy_file_data(fdIn, fdOut):
+    """
+    Copy the content of the file fdIn in the empty file fdOut. The file is
+    cloned when the filesystem supports it, else copied by the kernel with
+    copy_file_range or sendfile, and only read and written by Python as a last
+    resort. A method copying nothing, or less than the size of fdIn, is
+    followed by the next one, from where it stopped. The blocks copied are
+    limited by the throttle of the run, if any, a cloned file copying no data.
+    """
+    if fcntl is not None:
+        try:
+            fcntl.ioctl(fdOut, FICLONE, fdIn)
+            return
+        except OSError:
+            pass
+
+    nBlockSize = get_copy_block_size()
+    lKernelCopies = []
+    if hasattr(os, "copy_file_range"):
+        lKernelCopies.append(lambda: os.copy_file_range(fdIn, fdOut, nBlockSize))
+    if sys.platform.startswith("linux"):
+        lKernelCopies.append(lambda: os.sendfile(fdOut, fdIn, None, nBlockSize))
+    nSize = os.fstat(fdIn).st_size
+    nTotal = 0
+    for fCopyBlock in lKernelCopies:
+        nCopied = 0
+        try:
+            while True:
+                n = fCopyBlock()
+                if n == 0:
+                    break
+                nCopied = nCopied + n
+                throttle("read", n)
+                throttle("write", n)
+        except OSError as inst:
+            if nCopied > 0 or inst.errno not in COPY_UNSUPPORTED_ERRORS:
+                raise
+        # Some filesystems return 0 at once instead of an error, as files of
+        # /proc whose size is 0
+        nTotal = nTotal + nCopied
+        if nTotal > 0 and nTotal >= nSize:
+            return
+
+    while True:
+        sBlock = os.read(fdIn, nBlockSize)
+        if len(sBlock) == 0:
+            return
+        throttle("read", len(sBlock))
+        oView = memoryview(sBlock)
+        while len(oView) > 0:
+            oView = oView[os.write(fdOut, oView) :]
+        throttle("write", len(sBlock))
+
+
+def open_verify(sManifestPath=""):
+    """
+    Verify the copies of the run, and append their digests to the manifest
+    sManifestPath, one JSON line per copy, if it is not empty.
+    """
+    global dGlobalVerify
+    fManifest = None
+    if sManifestPath:
+        fManifest = open(sManifestPath, "a")
+    dGlobalVerify = {"manifest": fManifest, "lock": threading.Lock()}
+
+
+def close_verify():
+    """
+    Stop verifying the copies and close the manifest.
+    """
+    global dGlobalVerify
+    if dGlobalVerify is not None and dGlobalVerify["manifest"] is not None:
+        dGlobalVerify["manifest"].close()
+    dGlobalVerify = None
+
+
+def get_copy_block_size():
+    """
+    Return the size of the blocks copied at once.
+    """
+    if oGlobalThrottle is None:
+        return COPY_BLOCK_SIZE
+    return THROTTLE_BLOCK_SIZE
+
+
+def copy_file_object(fIn, fdOut, oHash=None):
+    """
+    Copy the content of the file object fIn in the empty file fdOut through
+    Python, updating oHash with it if provided. Return the number of bytes
+    copied.
+    """
+    nBlockSize = get_copy_block_size()
+    nSize = 0
+    while True:
+        sBlock = fIn.read(nBlockSize)
+        if len(sBlock) == 0:
+            return nSize
+        throttle("read", len(sBlock))
+        if oHash is not None:
+            oHash.update(sBlock)
+        nSize = nSize + len(sBlock)
+        oView = memoryview(sBlock)
+        while len(oView) > 0:
+            oView = oView[os.write(fdOut, oView) :]
+        throttle("write", len(sBlock))
+
+
+def copy_file_data_verified(fIn, fdOut):
+    """
+    Copy the content of the file object fIn in the empty file fdOut through
+    Python, computing its digest on the way, then write it to the disk.
+    Return the digest and the number of bytes copied.
+    """
+    oHash = hashlib.blake2b()
+    nSize = copy_file_object(fIn, fdOut, oHash)
+    os.fsync(fdOut)
+
+    return oHash.hexdigest(), nSize
+
+
+def get_disk_digest(sPath):
+    """
+    Return the digest of the file sPath, written to the disk, and its size.
+    Its pages are dropped from the page cache first when the system allows
+    it, so that it is read from the disk.
+    """
+    fd = os.open(sPath, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+    try:
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        oHash = hashlib.blake2b()
+        nSize = 0
+        while True:
+            sBlock = os.read(fd, COPY_BLOCK_SIZE)
+            if len(sBlock) == 0:
+                break
+            throttle("read", len(sBlock))
+            oHash.update(sBlock)
+            nSize = nSize + len(sBlock)
+    finally:
+        os.close(fd)
+
+    return oHash.hexdigest(), nSize
+
+
+def check_copy(sOldPath, sNewPath, sDigest, nSize):
+    """
+    Verify that the copy sNewPath of sOldPath, whose data had the digest
+    sDigest and the size nSize when copied, is the same on the disk, and
+    record it in the manifest.
+    Raise ExifRenameError if it is not, after removing the copy.
+    """
+    if get_disk_digest(sNewPath) != (sDigest, nSize):
+        os.remove(sNewPath)
+        record_error("verify_mismatch", sOldPath)
+        raise ExifRenameError(
+            "the copy of '%s' to '%s' differs from the original, the original is kept."
+            % (sOldPath, sNewPath),
+            9,
+        )
+    count_in_stats("verify", 1, nSize)
+    if dGlobalVerify["manifest"] is not None:
+        sEntry = json.dumps(
+            {
+                "source": sOldPath,
+                "destination": sNewPath,
+                "size": nSize,
+                "blake2b": sDigest,
+            }
+        )
+        with dGlobalVerify["lock"]:
+            dGlobalVerify["manifest"].write(sEntry + "\n")
+            dGlobalVerify["manifest"].flush()
+
+
+def create_new_file(sNewPath, bNoClobber=False):
+    """
+    Open sNewPath for writing and return its file descriptor. If bNoClobber
+    is True, sNewPath is created only if it does not exist, in a single
+    operation, and None is returned if it exists.
+    """
+    nFlags = os.O_WRONLY | os.O_CREAT | getattr(os, "O_BINARY", 0)
+    if bNoClobber:
+        nFlags = nFlags | os.O_EXCL
+    else:
+        nFlags = nFlags | os.O_TRUNC
+    try:
+        return os.open(sNewPath, nFlags, 0o666)
+    except FileExistsError:
+        return None
+
+
+def copy_archive_member(sArchivePath, sName, sNewPath, bNoClobber=False):
+    """
+    Copy the file sName of the archive sArchivePath to sNewPath with its
+    modification time, reading it from the archive.
+    Returns False if sNewPath exists and bNoClobber is True.
+    """
+    fIn, nTime = open_archive_member(sArchivePath, sName)
+    with fIn:
+        fdOut = create_new_file(sNewPath, bNoClobber)
+        if fdOut is None:
+            return False
+        try:
+            if dGlobalVerify is not None:
+                tDigest = copy_file_data_verified(fIn, fdOut)
+            else:
+                copy_file_object(fIn, fdOut)
+        except BaseException:
+            os.close(fdOut)
+            os.remove(sNewPath)
+            raise
+        os.close(fdOut)
+    os.utime(sNewPath, (nTime, nTime))
+    if dGlobalVerify is not None:
+        check_copy(os.path.join(sArchivePath, sName), sNewPath, *tDigest)
+
+    return True
+
+
+def copy_file(sOldPath, sNewPath, bNoClobber=False):
+    """
+    Copy the file sOldPath to sNewPath with its permissions and times, as
+    shutil.copy2 does. If bNoClobber is True, sNewPath is created only if it
+    does not exist, in a single operation. An image in an archive is copied
+    from the archive. With --verify, the data is copied through Python to
+    compute its digest, and the copy is read again from the disk to compare
+    it (see check_copy).
+    Returns False if sNewPath exists and bNoClobber is True.
+    """
+    try:
+        fIn = open(sOldPath, "rb")
+    except (FileNotFoundError, NotADirectoryError):
+        tArchivePath = split_archive_path(sOldPath)
+        if tArchivePath is None:
+            raise
+        return copy_archive_member(*tArchivePath, sNewPath, bNoClobber)
+    with fIn:
+        fdOut = create_new_file(sNewPath, bNoClobber)
+        if fdOut is None:
+            return False
+        try:
+            if dGlobalVerify is not None:
+                tDigest = copy_file_data_verified(fIn, fdOut)
+            else:
+                copy_file_data(fIn.fileno(), fdOut)
+        except BaseException:
+            os.close(fdOut)
+            os.remove(sNewPath)
+            raise
+        os.close(fdOut)
+    shutil.copystat(sOldPath, sNewPath)
+    if dGlobalVerify is not None:
+        check_copy(sOldPath, sNewPath, *tDigest)
+
+    return True
+
+
+def rename_file(sOldPath, sNewPath, bNoClobber=False):
+    """
+    Rename sOldPath to sNewPath on the same filesystem. If bNoClobber is True,
+    sNewPath is created only if it does not exist, with a hard link when the
+    filesystem supports it.
+    Returns False if sNewPath exists and bNoClobber is True.
+    Raise OSError with errno.EXDEV if the paths are on different filesystems.
+    """
+    if not bNoClobber:
+        os.replace(sOldPath, sNewPath)
+        return True
+
+    try:
+        os.link(sOldPath, sNewPath, follow_symlinks=False)
+    except FileExistsError:
+        return False
+    except OSError as inst:
+        if inst.errno == errno.EXDEV:
+            raise
+        # No hard link on this filesystem
+        if os.path.lexists(sNewPath):
+            return False
+        os.rename(sOldPath, sNewPath)
+        return True
+    os.remove(sOldPath)
+
+    return True
+
+
+def copy_image(sOldPath, sNewPath, bMove=False, bNoClobber=False):
+    """
+    Copy, or move, an image to its new path. A move is a rename when both
+    paths are on the same filesystem, a copy followed by a removal otherwise,
+    the removal happening only once the copy is verified with --verify.
+    Returns False if sNewPath exists and bNoClobber is True.
+    """
+    throttle("files")
+    if not bMove:
+        return copy_file(sOldPath, sNewPath, bNoClobber)
+
+    try:
+        return rename_file(sOldPath, sNewPath, bNoClobber)
+    except OSError as inst:
+        if inst.errno != errno.EXDEV:
+            raise
+    if os.path.islink(sOldPath):
+        if bNoClobber and os.path.lexists(sNewPath):
+            return False
+        shutil.move(sOldPath, sNewPath)
+        return True
+    if not copy_file(sOldPath, sNewPath, bNoClobber):
+        return False
+    os.remove(sOldPath)
+
+    return True
+
+
+def link_image(sOriginalPath, sOldPath, sNewPath, bMove=False, bNoClobber=False):
+    """
+    Give to an image identical to the file sOriginalPath its new path as a
+    hard link to sOriginalPath, and remove the image if it is moved. The
+    image is copied, or moved, if the filesystem has no hard links.
+    Returns False if sNewPath exists and bNoClobber is True.
+    """
+    if os.path.lexists(sNewPath):
+        if bNoClobber:
+            return False
+        os.remove(sNewPath)
+    throttle("files")
+    try:
+        os.link(sOriginalPath, sNewPath)
+    except OSError:
+        return copy_image(sOldPath, sNewPath, bMove, bNoClobber)
+    if bMove:
+        os.remove(sOldPath)
+
+    return True
+
+
+def iter_copy_images(dPath, bMove=False, bNoClobber=False, nCopyJobs=1, bChained=None):
+    """
+    Copy, or move, the images of dPath (key: old path, value: new path) with
+    nCopyJobs threads and yield the result of copy_image for each of them, in
+    the order of dPath. bChained tells if a new path is also the old path of
+    another image, in which case the order of the copies matters and they are
+    done one by one. It is found from dPath if not given.
+    """
+    if nCopyJobs > 1 and bChained is None:
+        bChained = len(set(dPath.keys()) & set(dPath.values())) > 0
+    if nCopyJobs > 1 and not bChained:
+        # Only a few copies are submitted in advance, not all the images
+        with concurrent.futures.ThreadPoolExecutor(max_workers=nCopyJobs) as executor:
+            dqFutures = collections.deque()
+            for sOldPath, sNewPath in dPath.items():
+                dqFutures.append(
+                    executor.submit(copy_image, sOldPath, sNewPath, bMove, bNoClobber)
+                )
+                if len(dqFutures) >= nCopyJobs * COPY_AHEAD:
+                    yield dqFutures.popleft().result()
+            while len(dqFutures) > 0:
+                yield dqFutures.popleft().result()
+    else:
+        for sOldPath, sNewPath in dPath.items():
+            yield copy_image(sOldPath, sNewPath, bMove, bNoClobber)
+
+
+def duplicate_images(dPath, tOptions, dIndex=None, bChained=None):
+    """
+    Here is the place where the images file are duplicated, copied or moved.
+    The destination index dIndex, if provided, is used to tell if a file
+    exists in dry-run mode. bChained is given to iter_copy_images.
+    With --disk-order, the images are copied in the order of their position
+    on the disk, unless the order of the copies matters.
+    """
+
+    # If requested, copy the input tree in the output directory
+    if tOptions.CopyTree or get_date_layout(tOptions) is not None:
+        for sDirectory in set(os.path.dirname(s) for s in dPath.values()):
+            if not os.path.exists(sDirectory):
+                os.makedirs(sDirectory)
+
+    i = 1
+    nNbrImages = len(dPath)
+    if tOptions.Move:
+        sMode = "Move"
+    else:
+        sMode = "Copy"
+
+    if tOptions.DryRun and dIndex is not None:
+        iDone = (
+            not (tOptions.NoClobber and is_in_destination(sNewPath, dIndex))
+            for sNewPath in dPath.values()
+        )
+    elif tOptions.DryRun:
+        iDone = (
+            not (tOptions.NoClobber and os.path.exists(sNewPath))
+            for sNewPath in dPath.values()
+        )
+    else:
+        if tOptions.DiskOrder:
+            if bChained is None:
+                bChained = len(set(dPath.keys()) & set(dPath.values())) > 0
+            if not bChained:
+                dPath = dict(sort_on_disk(dPath.items(), operator.itemgetter(0)))
+        iDone = iter_copy_images(
+            dPath, tOptions.Move, tOptions.NoClobber, tOptions.CopyJobs, bChained
+        )
+    dProgress = start_progress(sMode, nNbrImages)
+    for (sOldPath, sNewPath), bDone in zip(dPath.items(), iDone):
+        report_copy(
+            sOldPath,
+            sNewPath,
+            bDone,
+            "%s/%s" % (i, nNbrImages),
+            sMode,
+            tOptions.DryRun,
+            dProgress,
+        )
+        i = i + 1
+    end_progress(dProgress)
+
+
+def report_copy(sOldPath, sNewPath, bDone, sCount, sMode, bDryRun, dProgress=None):
+    """
+    Print the copy, or move, of the image sOldPath to sNewPath, number sCount,
+    which was done if bDone is True or skipped by --no-clobber, and count it
+    in the progress line dProgress, if any, and in the statistics.
+    """
+    if not bDone:
+        my_print(
+            "File '%s' already exists and --no-clobber option activated. Skipping renaming of '%s'."
+            % (sNewPath, sOldPath),
+            True,
+        )
+        record_error("no_clobber_skip", sOldPath)
+    elif bDryRun:
+        sProcessing = "----\nProcessing [%s]:" % (sCount)
+        my_print(sProcessing + sMode + " %s ---> %s" % (sOldPath, sNewPath))
+        my_print("Dry-run mode is activated: no operation is done")
+        emit_file_event(sOldPath, sNewPath, sMode, True)
+    else:
+        sProcessing = "----\nProcessing [%s]:" % (sCount)
+        my_print(sProcessing + sMode + " %s ---> %s" % (sOldPath, sNewPath), VERBOSE)
+        if dProgress is not None:
+            update_progress(dProgress)
+        if dGlobalStats is not None:
+            count_in_stats("copy", 1, os.lstat(sNewPath).st_size)
+        emit_file_event(sOldPath, sNewPath, sMode)
+    my_print("----", VERBOSE)
+
+
+def link_duplicate_images(lRecords, tOptions, dIndex=None):
+    """
+    Give their new path to the images of lRecords identical to another image
+    already copied, or moved, as a hard link to the new path of that image.
+    The destination index dIndex, if provided, is used to tell if a file
+    exists in dry-run mode.
+    """
+    i = 1
+    nNbrImages = len(lRecords)
+    dProgress = start_progress("Link", nNbrImages)
+    for oRecord in lRecords:
+        sOldPath = get_record_path(oRecord)
+        sNewPath = get_record_new_path(oRecord)
+        sOriginalPath = get_record_new_path(oRecord.oOriginal)
+        if tOptions.DryRun:
+            if dIndex is not None:
+                bDone = not (tOptions.NoClobber and is_in_destination(sNewPath, dIndex))
+            else:
+                bDone = not (tOptions.NoClobber and os.path.exists(sNewPath))
+        else:
+            bDone = link_image(
+                sOriginalPath, sOldPath, sNewPath, tOptions.Move, tOptions.NoClobber
+            )
+        sProcessing = "----\nProcessing [%s/%s]:" % (i, nNbrImages)
+        sLink = sProcessing + "Link %s ---> %s (identical to %s)" % (
+            sOldPath,
+            sNewPath,
+            sOriginalPath,
+        )
+        if not bDone:
+            my_print(
+                "File '%s' already exists and --no-clobber option activated. Skipping renaming of '%s'."
+                % (sNewPath, sOldPath),
+                True,
+            )
+            record_error("no_clobber_skip", sOldPath)
+        elif tOptions.DryRun:
+            my_print(sLink)
+            my_print("Dry-run mode is activated: no operation is done")
+            emit_file_event(sOldPath, sNewPath, "Link", True)
+        else:
+            my_print(sLink, VERBOSE)
+            update_progress(dProgress)
+            emit_file_event(sOldPath, sNewPath, "Link")
+        my_print("----", VERBOSE)
+        i = i + 1
+    end_progress(dProgress)
+
+
+def put_in_stream(qStream, item, evStop):
+    """
+    Put item in the bounded queue qStream, waiting for some room unless the
+    pipeline is stopped. Return False if the pipeline is stopped.
+    """
+    while not evStop.is_set():
+        try:
+            qStream.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+
+def iter_stream(qStream, evStop):
+    """
+    Yield the items of the queue qStream up to the None marking its end, or
+    until the pipeline is stopped.
+    """
+    while not evStop.is_set():
+        try:
+            item = qStream.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if item is None:
+            return
+        yield item
+
+
+def start_stream_stage(fStage, lErrors, evStop, *args):
+    """
+    Run fStage(*args) in a thread. An exception raised by fStage is stored
+    in lErrors and stops the pipeline.
+    """
+
+    def run_stage():
+        try:
+            fStage(*args)
+        except BaseException as inst:
+            lErrors.append(inst)
+            evStop.set()
+
+    thread = threading.Thread(target=run_stage, daemon=True)
+    thread.start()
+    return thread
+
+
+def scan_images_path_stream(tOptions, qPaths, evStop):
+    """
+    Scanning stage of the streaming mode: put in qPaths the tuples of
+    iter_images_path by chunks of STREAM_CHUNK_SIZE, then None.
+    """
+    try:
+        with measure_phase("scan", time.thread_time):
+            lChunk = []
+            for tImage in iter_images_path(tOptions):
+                lChunk.append(tImage)
+                if tImage[2] is None:
+                    count_in_stats("scan", 1)
+                else:
+                    count_in_stats("scan", 1, tImage[2].st_size)
+                if len(lChunk) == STREAM_CHUNK_SIZE:
+                    if not put_in_stream(qPaths, lChunk, evStop):
+                        return
+                    lChunk = []
+            if len(lChunk) > 0:
+                put_in_stream(qPaths, lChunk, evStop)
+    finally:
+        put_in_stream(qPaths, None, evStop)
+
+
+def copy_images_stream(qCopy, bMove, nCopyJobs, evStop):
+    """
+    Copying stage of the streaming mode: copy, or move, each image of the
+    chunks of tuples (image path, temporary path) of qCopy to its temporary
+    path, in the destination directory.
+    """
+    setDirectories = set()
+    for lChunk in iter_stream(qCopy, evStop):
+        with measure_phase("copy", time.thread_time):
+            for sOldPath, sTemporaryPath in lChunk:
+                sDirectory = os.path.dirname(sTemporaryPath)
+                if sDirectory not in setDirectories:
+                    if sDirectory != "" and not os.path.exists(sDirectory):
+                        os.makedirs(sDirectory)
+                    setDirectories.add(sDirectory)
+            for bDone in iter_copy_images(dict(lChunk), bMove, False, nCopyJobs):
+                pass
+            if dGlobalStats is not None:
+                for sOldPath, sTemporaryPath in lChunk:
+                    count_in_stats("copy", 1, os.lstat(sTemporaryPath).st_size)
+
+
+def discard_temporary_image(sOldPath, sTemporaryPath, bMove):
+    """
+    Remove the temporary copy of an image, or move the image back to its
+    original path if it was moved.
+    """
+    if not os.path.lexists(sTemporaryPath):
+        return
+    if not bMove:
+        os.remove(sTemporaryPath)
+    elif not os.path.lexists(sOldPath):
+        copy_image(sTemporaryPath, sOldPath, bMove=True)
+
+
+def get_stream_temporary_path(sNewDirectory, nTemporary):
+    """
+    Return the temporary path of the image number nTemporary of the streaming
+    mode, in its destination directory, whose path up to the file names is
+    sNewDirectory (see split_path).
+    """
+    return sNewDirectory + ".exif_rename_files.%s.%s.tmp" % (os.getpid(), nTemporary)
+
+
+def open_stream_images():
+    """
+    Return the tuple (connection, path) of a new SQLite database in a
+    temporary file, where the streaming mode lists the images it copies under
+    a temporary name, so that the memory used does not depend on their
+    number. The paths are stored as bytes (see os.fsencode):
+    * temporary: number of the image, giving its temporary path
+    * old_path, old_directory: path of the image, and its directory
+    * new_directory, new_name: new path of the image, see split_path
+    """
+    import sqlite3
+
+    fd, sPath = tempfile.mkstemp(prefix="exif_rename_files.", suffix=".sqlite")
+    os.close(fd)
+    oImages = sqlite3.connect(sPath)
+    oImages.executescript("""
+        PRAGMA journal_mode = OFF;
+        PRAGMA synchronous = OFF;
+        CREATE TABLE images (
+            temporary INTEGER PRIMARY KEY, old_path BLOB UNIQUE,
+            old_directory BLOB, new_directory BLOB, new_name BLOB);
+        CREATE INDEX images_old_directory ON images (old_directory);
+        """)
+    return oImages, sPath
+
+
+def iter_stream_groups(oImages):
+    """
+    Yield the images of the database oImages (see open_stream_images) having
+    the same new path, as lists of tuples (number of the image, record), by
+    destination directory.
+    """
+    lGroup = []
+    tGroupPath = None
+    for nTemporary, sOldPath, sNewDirectory, sNewName in oImages.execute(
+        "SELECT temporary, old_path, new_directory, new_name FROM images"
+        " ORDER BY new_directory, new_name"
+    ):
+        if (sNewDirectory, sNewName) != tGroupPath:
+            if len(lGroup) > 0:
+                yield lGroup
+            lGroup = []
+            tGroupPath = (sNewDirectory, sNewName)
+        oRecord = ImageRecord(*split_path(os.fsdecode(sOldPath)), None)
+        oRecord.sNewDirectory = sys.intern(os.fsdecode(sNewDirectory))
+        oRecord.sNewName = os.fsdecode(sNewName)
+        lGroup.append((nTemporary, oRecord))
+    if len(lGroup) > 0:
+        yield lGroup
+
+
+def discard_temporary_images(oImages, bMove):
+    """
+    Remove the temporary copies of the images of the database oImages, see
+    discard_temporary_image.
+    """
+    for nTemporary, sOldPath, sNewDirectory in oImages.execute(
+        "SELECT temporary, old_path, new_directory FROM images"
+    ):
+        discard_temporary_image(
+            os.fsdecode(sOldPath),
+            get_stream_temporary_path(os.fsdecode(sNewDirectory), nTemporary),
+            bMove,
+        )
+
+
+def finalize_images_stream(oImages, tOptions):
+    """
+    Give their final name to the images of the database oImages (see
+    open_stream_images), copied under a temporary name by the streaming
+    mode, with the same messages as duplicate_images. The images having the
+    same new path are named together by get_unique_records_path, so the names
+    are the same as in the default mode, and the destination directories are
+    indexed one at a time. Return the number of images renamed.
+    """
+    i = 1
+    nNbrImages = oImages.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+    if tOptions.Move:
+        sMode = "Move"
+    else:
+        sMode = "Copy"
+    dIndex = {}
+    sIndexDirectory = None
+    dProgress = start_progress("Rename", nNbrImages)
+    for lGroup in iter_stream_groups(oImages):
+        sNewDirectory = lGroup[0][1].sNewDirectory
+        sDirectory = get_prefix_directory(sNewDirectory, {})
+        if sDirectory != sIndexDirectory:
+            # The images of the run in this directory are not indexed, as
+            # get_unique_records_path does for all the images
+            dIndex.clear()
+            setSources = set(
+                os.fsdecode(row[0])
+                for row in oImages.execute(
+                    "SELECT old_path FROM images WHERE old_directory = ?",
+                    (os.fsencode(sDirectory),),
+                )
+            )
+            get_destination_index(
+                sDirectory,
+                dIndex,
+                {sDirectory: set(os.path.basename(s) for s in setSources)},
+            )
+            sIndexDirectory = sDirectory
+        dTemporary = {id(oRecord): nTemporary for nTemporary, oRecord in lGroup}
+        with measure_phase("planning"):
+            lRecordsUnique = get_unique_records_path(
+                [oRecord for _, oRecord in lGroup], dIndex, bIndexNewNames=False
+            )
+        count_in_stats("planning", len(lGroup))
+        for oRecord in lRecordsUnique:
+            sOldPath = get_record_path(oRecord)
+            sNewPath = get_record_new_path(oRecord)
+            sCount = "%s/%s" % (i, nNbrImages)
+            i = i + 1
+            if tOptions.DryRun:
+                bDone = not (tOptions.NoClobber and is_in_destination(sNewPath, dIndex))
+                report_copy(sOldPath, sNewPath, bDone, sCount, sMode, True)
+                continue
+            sTemporaryPath = get_stream_temporary_path(
+                sNewDirectory, dTemporary.pop(id(oRecord))
+            )
+            if not rename_file(sTemporaryPath, sNewPath, tOptions.NoClobber):
+                my_print(
+                    "File '%s' already exists and --no-clobber option activated. Skipping renaming of '%s'."
+                    % (sNewPath, sOldPath),
+                    True,
+                )
+                record_error("no_clobber_skip", sOldPath)
+                discard_temporary_image(sOldPath, sTemporaryPath, tOptions.Move)
+            else:
+                sProcessing = "----\nProcessing [%s]:" % (sCount)
+                my_print(
+                    sProcessing + sMode + " %s ---> %s" % (sOldPath, sNewPath), VERBOSE
+                )
+                update_progress(dProgress)
+                emit_file_event(sOldPath, sNewPath, sMode)
+            my_print("----", VERBOSE)
+        if not tOptions.DryRun:
+            # Images which already have the right name
+            for nTemporary, oRecord in lGroup:
+                if id(oRecord) in dTemporary:
+                    discard_temporary_image(
+                        get_record_path(oRecord),
+                        get_stream_temporary_path(sNewDirectory, nTemporary),
+                        tOptions.Move,
+                    )
+    end_progress(dProgress)
+
+    return i - 1
+
+
+def exif_rename_files_stream(tOptions):
+    """
+    Streaming version of exif_rename_files: the input is scanned, the EXIF
+    information extracted and the images copied by stages running at the same
+    time, connected by bounded queues.
+    The images are copied under a temporary name in their destination
+    directory as soon as their EXIF is read, and listed in a database on the
+    disk (see open_stream_images). Since the collision suffix of an image
+    depends on all the images having the same destination, the final names
+    are given once all the images are read, with a rename in the same
+    directory. They are the same as in the default mode.
+    """
+    evStop = threading.Event()
+    lErrors = []
+    qPaths = queue.Queue(STREAM_QUEUE_SIZE)
+    qCopy = queue.Queue(STREAM_QUEUE_SIZE)
+    dInputDirectory = {}  # Input path of the images read but not listed yet
+    dKeys = {}  # File keys of the images read but not listed yet
+    oImages, sImagesPath = open_stream_images()
+
+    def iter_chunks():
+        for lChunk in iter_stream(qPaths, evStop):
+            lPathImages = []
+            for sImage, sPath, st in lChunk:
+                # Keep only the first occurence of an image given twice
+                if sImage in dInputDirectory or (
+                    oImages.execute(
+                        "SELECT 1 FROM images WHERE old_path = ?",
+                        (os.fsencode(sImage),),
+                    ).fetchone()
+                    is not None
+                ):
+                    continue
+                dInputDirectory[sImage] = sPath
+                if st is not None:
+                    dKeys[sImage] = get_stat_key(st)
+                lPathImages.append(sImage)
+            yield lPathImages
+
+    try:
+        my_print("Getting EXIF information from files", VERBOSE)
+        threadScan = start_stream_stage(
+            scan_images_path_stream, lErrors, evStop, tOptions, qPaths, evStop
+        )
+        threadCopy = None
+        if not tOptions.DryRun:
+            threadCopy = start_stream_stage(
+                copy_images_stream,
+                lErrors,
+                evStop,
+                qCopy,
+                tOptions.Move,
+                tOptions.CopyJobs,
+                evStop,
+            )
+        try:
+            with measure_phase("extraction", time.thread_time):
+                lChunk = []
+                for sPathOld, sExif in iter_images_with_exif(
+                    iter_chunks(),
+                    tOptions.CpNoExif,
+                    tOptions.Jobs,
+                    tOptions.JobsBackend,
+                    dKeys=dKeys,
+                    nReadTimeout=tOptions.ReadTimeout,
+                    sBackend=tOptions.Backend,
+                    bDiskOrder=tOptions.DiskOrder,
+                ):
+                    dKeys.pop(sPathOld, None)
+                    sPathNew = create_new_path_for_image(
+                        sPathOld, sExif, dInputDirectory.pop(sPathOld), tOptions
+                    )
+                    if sPathNew is None:
+                        continue
+                    sNewDirectory, sNewName = split_path(sPathNew)
+                    nTemporary = oImages.execute(
+                        "INSERT INTO images (old_path, old_directory, new_directory,"
+                        " new_name) VALUES (?, ?, ?, ?)",
+                        (
+                            os.fsencode(sPathOld),
+                            os.fsencode(os.path.dirname(sPathOld)),
+                            os.fsencode(sNewDirectory),
+                            os.fsencode(sNewName),
+                        ),
+                    ).lastrowid
+                    if threadCopy is not None:
+                        lChunk.append(
+                            (
+                                sPathOld,
+                                get_stream_temporary_path(sNewDirectory, nTemporary),
+                            )
+                        )
+                        if len(lChunk) == STREAM_CHUNK_SIZE:
+                            put_in_stream(qCopy, lChunk, evStop)
+                            lChunk = []
+            if len(lChunk) > 0:
+                put_in_stream(qCopy, lChunk, evStop)
+            put_in_stream(qCopy, None, evStop)
+
+            threadScan.join()
+            if threadCopy is not None:
+                threadCopy.join()
+            if len(lErrors) > 0:
+                raise lErrors[0]
+        except BaseException:
+            evStop.set()
+            threadScan.join()
+            if threadCopy is not None:
+                threadCopy.join()
+            discard_temporary_images(oImages, tOptions.Move)
+            raise
+
+        nImages = oImages.execute("SELECT COUNT(*) FROM images").fetchone()[0]
+        if nImages == 0 and len(dInputDirectory) == 0:
+            my_print("No image file identified.")
+            return
+
+        # Remove any possible collision by adding a suffix in the file name of image having the same Exif and destination
+        if tOptions.DryRun:
+            with measure_phase("copy"):
+                finalize_images_stream(oImages, tOptions)
+        else:
+            with measure_phase("rename"):
+                nRenamed = finalize_images_stream(oImages, tOptions)
+            count_in_stats("rename", nRenamed)
+    finally:
+        oImages.close()
+        os.remove(sImagesPath)
+
+
+def get_free_path(sNewPathRaw, dIndex):
+    """
+    Return a path for an image which should be written to sNewPathRaw without
+    overwriting the files already there, according to the destination index
+    dIndex. If sNewPathRaw or one of its collision suffixes "_N" exists, the
+    suffix following the largest one is used, so the numbering continues
+    after the files already placed.
+    """
+    tExistingSuffix = get_existing_suffix(sNewPathRaw, dIndex)
+    if tExistingSuffix is None:
+        return sNewPathRaw
+
+    sRoot, sExtension = os.path.splitext(sNewPathRaw)
+    return (
+        sRoot + "_" + str(tExistingSuffix[0] + 1).zfill(tExistingSuffix[1]) + sExtension
+    )
+
+
+def get_file_signature(sPath):
+    """
+    Return the tuple (size, mtime) of a file, None if it cannot be reached.
+    """
+    try:
+        st = os.stat(sPath)
+    except OSError:
+        return None
+    return (st.st_size, st.st_mtime_ns)
+
+
+def open_inotify():
+    """
+    Return the tuple (libc, inotify file descriptor), or None if inotify is
+    not available on this system.
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        import ctypes
+        import ctypes.util
+
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(IN_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+
+    return libc, fd
+
+
+def add_inotify_watch(tInotify, sDirectory, sInputPath, dWatches, bRecursive):
+    """
+    Watch sDirectory, and its subdirectories if bRecursive is True, with
+    inotify. dWatches is updated with key: watch descriptor, value: tuple
+    (directory, input path). Returns the list of tuples (image path, input
+    path) of the images already in the directories.
+    """
+    libc, fd = tInotify
+    nMask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    lDirectories = [sDirectory]
+    lImages = []
+    while len(lDirectories) > 0:
+        sCurrent = lDirectories.pop()
+        wd = libc.inotify_add_watch(fd, os.fsencode(sCurrent), nMask)
+        if wd < 0:
+            my_print("Cannot watch directory '%s'" % (sCurrent), VERBOSE)
+            continue
+        dWatches[wd] = (sCurrent, sInputPath)
+        # Images written before the watch started
+        lImagesCurrent, lSubdirectories = scan_directory(sCurrent)
+        lImages.extend((sImage, sInputPath) for sImage, st in lImagesCurrent)
+        if bRecursive:
+            lDirectories.extend(lSubdirectories)
+
+    return lImages
+
+
+def read_inotify_events(fd):
+    """
+    Read the pending inotify events and return a list of tuples
+    (watch descriptor, mask, name).
+    """
+    lEvents = []
+    sData = os.read(fd, 65536)
+    nOffset = 0
+    while nOffset < len(sData):
+        wd, nMask, nCookie, nLength = struct.unpack_from("iIII", sData, nOffset)
+        nOffset = nOffset + 16
+        sName = os.fsdecode(sData[nOffset : nOffset + nLength].rstrip(b"\0"))
+        nOffset = nOffset + nLength
+        lEvents.append((wd, nMask, sName))
+
+    return lEvents
+
+
+def rename_image_watch(sImagePath, sInputPath, tOptions, setProduced, dIndex):
+    """
+    Rename, or copy, one image found by the watch mode. A collision with a
+    file already in the destination gets the next collision suffix, the
+    existing files are never overwritten. dIndex is the destination index.
+    """
+    # Each file is reported by its own line, not by a progress line
+    dExif = get_images_with_exif(
+        [sImagePath], tOptions.CpNoExif, bProgress=False, sBackend=tOptions.Backend
+    )
+    if sImagePath not in dExif:
+        return
+    sNewPathRaw = create_new_path_for_image(
+        sImagePath, dExif[sImagePath], sInputPath, tOptions
+    )
+    if sNewPathRaw is None or sNewPathRaw == sImagePath:
+        return
+    sDirectory = os.path.dirname(sNewPathRaw)
+    if sDirectory != "" and not os.path.exists(sDirectory) and not tOptions.DryRun:
+        os.makedirs(sDirectory)
+
+    if tOptions.Move:
+        sMode = "Move"
+    else:
+        sMode = "Copy"
+    while True:
+        sNewPath = get_free_path(sNewPathRaw, dIndex)
+        if sNewPath == sImagePath:
+            return
+        if tOptions.DryRun or copy_image(sImagePath, sNewPath, tOptions.Move, True):
+            break
+        # Another process took the name in the meantime, list the directory again
+        del dIndex[os.path.dirname(sNewPath)]
+    add_to_destination_index(
+        os.path.basename(sNewPath), get_destination_index(sDirectory, dIndex)
+    )
+    my_print("----\nProcessing:" + sMode + " %s ---> %s" % (sImagePath, sNewPath))
+    if tOptions.DryRun:
+        my_print("Dry-run mode is activated: no operation is done")
+    else:
+        count_in_stats("watch", 1, os.lstat(sNewPath).st_size)
+    emit_file_event(sImagePath, sNewPath, sMode, tOptions.DryRun)
+    setProduced.add(sNewPath)
+
+
+def watch_images(tOptions):
+    """
+    Watch mode: process the images in the input directories, then wait for
+    new images and process each of them once it is completely written. With
+    inotify, an image is complete when it is closed or moved in the
+    directory. Otherwise, the directories are listed every
+    WATCH_POLL_INTERVAL seconds and an image is complete once its size and
+    time did not change between two listings.
+    """
+    lInputDirectories = [s for s in tOptions.Input if os.path.isdir(s)]
+    dProcessed = {}  # Signature of the images processed, by path
+    for sImagePath, sInputPath, st in iter_images_path(tOptions):
+        dProcessed[sImagePath] = get_file_signature(sImagePath)
+    dIndex = {}
+    setProduced = set(exif_rename_files_batch(tOptions, dIndex).values())
+
+    tInotify = open_inotify()
+    dWatches = {}
+    dPending = {}  # Images being written, key: path, value: (signature, input)
+
+    def add_pending(lImages):
+        for sImagePath, sInputPath in lImages:
+            if sImagePath in setProduced or sImagePath in dPending:
+                continue
+            tSignature = get_file_signature(sImagePath)
+            if tSignature is not None and dProcessed.get(sImagePath) != tSignature:
+                dPending[sImagePath] = (tSignature, sInputPath)
+
+    def list_inputs():
+        lImages = []
+        for sInputPath in lInputDirectories:
+            for sImagePath, st in iter_images_path_directory(
+                sInputPath, tOptions.Recursive
+            ):
+                lImages.append((sImagePath, sInputPath))
+        return lImages
+
+    if tInotify is not None:
+        my_print("Watching the input directories with inotify", VERBOSE)
+        for sInputPath in lInputDirectories:
+            add_pending(
+                add_inotify_watch(
+                    tInotify, sInputPath, sInputPath, dWatches, tOptions.Recursive
+                )
+            )
+    else:
+        my_print("Watching the input directories by polling", VERBOSE)
+    my_print("Waiting for new files. Press Ctrl-C to stop.")
+
+    try:
+        while True:
+            lReady = []
+            if tInotify is not None:
+                fd = tInotify[1]
+                if len(select.select([fd], [], [], WATCH_POLL_INTERVAL)[0]) > 0:
+                    for wd, nMask, sName in read_inotify_events(fd):
+                        if nMask & IN_Q_OVERFLOW:
+                            my_print(
+                                "Too many events, listing the directories", VERBOSE
+                            )
+                            add_pending(list_inputs())
+                            continue
+                        if wd not in dWatches:
+                            continue
+                        sDirectory, sInputPath = dWatches[wd]
+                        sPath = os.path.join(sDirectory, sName)
+                        if nMask & IN_ISDIR:
+                            if tOptions.Recursive and nMask & (IN_CREATE | IN_MOVED_TO):
+                                add_pending(
+                                    add_inotify_watch(
+                                        tInotify, sPath, sInputPath, dWatches, True
+                                    )
+                                )
+                        elif nMask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                            if get_extension(sName) in FILETYPE_SET:
+                                dPending.pop(sPath, None)
+                                lReady.append((sPath, sInputPath))
+            else:
+                time.sleep(WATCH_POLL_INTERVAL)
+                add_pending(list_inputs())
+
+            # Images which did not change since the last check are complete
+            for sImagePath, (tSignature, sInputPath) in list(dPending.items()):
+                tCurrent = get_file_signature(sImagePath)
+                if tCurrent is None:
+                    del dPending[sImagePath]
+                elif tCurrent == tSignature:
+                    del dPending[sImagePath]
+                    lReady.append((sImagePath, sInputPath))
+                else:
+                    dPending[sImagePath] = (tCurrent, sInputPath)
+
+            for sImagePath, sInputPath in sorted(lReady):
+                tSignature = get_file_signature(sImagePath)
+                if (
+                    tSignature is None
+                    or sImagePath in setProduced
+                    or dProcessed.get(sImagePath) == tSignature
+                ):
+                    continue
+                rename_image_watch(
+                    sImagePath, sInputPath, tOptions, setProduced, dIndex
+                )
+                dProcessed[sImagePath] = tSignature
+    except KeyboardInterrupt:
+        my_print("Stopped watching.")
+    finally:
+        if tInotify is not None:
+            os.close(tInotify[1])
+
+
+def write_plan(lRecords, sPlanPath, sShard=None):
+    """
+    Write the plan of the records lRecords in the JSON Lines file sPlanPath,
+    one entry per image with the size and the modification time of the
+    image, so that the plan can be applied later with apply_plan. The paths
+    are absolute, so the plan does not depend on the current directory. The
+    entries of the plan of a shard also give the shard sShard, "i/N".
+    """
+
+    def iter_entries():
+        for oRecord in lRecords:
+            sOldPath = get_record_path(oRecord)
+            tKey = oRecord.tKey
+            if tKey is None:
+                tKey = get_stat_key(os.stat(sOldPath))
+            dEntry = {
+                "source": os.path.abspath(sOldPath),
+                "destination": os.path.abspath(get_record_new_path(oRecord)),
+                "size": tKey[2],
+                "mtime_ns": tKey[3],
+            }
+            if sShard is not None:
+                dEntry["shard"] = sShard
+            yield dEntry
+
+    write_plan_entries(iter_entries(), sPlanPath)
+    my_print("Plan of %s files written in '%s'" % (len(lRecords), sPlanPath))
+
+
+def write_plan_entries(iEntries, sPlanPath):
+    """
+    Write the entries of iEntries in the plan sPlanPath, one JSON line each.
+    The plan is written in a temporary file renamed at the end, and the
+    journal of a previous plan with the same name is removed.
+    """
+    sTemporaryPath = sPlanPath + ".tmp"
+    with open(sTemporaryPath, "w") as f:
+        for dEntry in iEntries:
+            f.write(json.dumps(dEntry) + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(sTemporaryPath, sPlanPath)
+    if os.path.exists(get_journal_path(sPlanPath)):
+        os.remove(get_journal_path(sPlanPath))
+
+
+def read_plan(sPlanPath):
+    """
+    Return the list of the entries of the plan sPlanPath.
+    Raise ExifRenameError if the plan cannot be read.
+    """
+    try:
+        with open(sPlanPath) as f:
+            return [json.loads(sLine) for sLine in f if sLine.strip()]
+    except (OSError, ValueError) as inst:
+        raise ExifRenameError("plan '%s' cannot be read: %s." % (sPlanPath, inst), 5)
+
+
+def merge_plans(tOptions):
+    """
+    Verify that the plans of tOptions.MergePlans, written by the shards of a
+    run, do not overlap: no image and no new path in two plans, and no shard
+    in two plans. The plans are merged in tOptions.WritePlan if provided.
+    Raise ExifRenameError if they overlap.
+    """
+    lEntries = []
+    dSources = {}  # Plan of each image
+    dDestinations = {}  # Plan of each new path
+    dShards = {}  # Plan of each shard
+    setShardCounts = set()
+    lConflicts = []
+    for j, sPlanPath in enumerate(tOptions.MergePlans):
+        lPlanEntries = read_plan(sPlanPath)
+        for dEntry in lPlanEntries:
+            for sField, dPlans in (
+                ("source", dSources),
+                ("destination", dDestinations),
+            ):
+                sPath = dEntry[sField]
+                if sPath in dPlans and dPlans[sPath] != j:
+                    lConflicts.append(
+                        "%s '%s' in '%s' and '%s'"
+                        % (sField, sPath, tOptions.MergePlans[dPlans[sPath]], sPlanPath)
+                    )
+                dPlans[sPath] = j
+            if "shard" in dEntry:
+                nShard, nShards = parse_shard(dEntry["shard"])
+                setShardCounts.add(nShards)
+                if dShards.setdefault(nShard, j) != j:
+                    lConflicts.append(
+                        "shard %s in '%s' and '%s'"
+                        % (
+                            dEntry["shard"],
+                            tOptions.MergePlans[dShards[nShard]],
+                            sPlanPath,
+                        )
+                    )
+        lEntries.extend(lPlanEntries)
+        my_print("Plan '%s': %s files" % (sPlanPath, len(lPlanEntries)), VERBOSE)
+    if len(setShardCounts) > 1:
+        lConflicts.append(
+            "the plans are split in different numbers of shards: %s"
+            % (sorted(setShardCounts))
+        )
+    if len(lConflicts) > 0:
+        for sConflict in lConflicts[:MERGE_MAX_CONFLICTS]:
+            my_print("Conflict: " + sConflict)
+        raise ExifRenameError(
+            "%s conflicts found between the plans, they cannot be merged."
+            % (len(lConflicts)),
+            8,
+        )
+    if len(setShardCounts) == 1:
+        (nShards,) = setShardCounts
+        lMissing = [i for i in range(1, nShards + 1) if i not in dShards]
+        if len(lMissing) > 0:
+            my_print(
+                "Warning: no plan for the shards %s of %s, or they have no file"
+                % (", ".join(str(i) for i in lMissing), nShards)
+            )
+
+    my_print(
+        "%s plans with %s files do not overlap"
+        % (len(tOptions.MergePlans), len(lEntries))
+    )
+    if tOptions.WritePlan is not None:
+        for dEntry in lEntries:
+            dEntry.pop("shard", None)
+        write_plan_entries(lEntries, tOptions.WritePlan)
+        my_print(
+            "Plan of %s files written in '%s'" % (len(lEntries), tOptions.WritePlan)
+        )
+
+
+def get_journal_path(sPlanPath):
+    """
+    Return the path of the journal of the plan sPlanPath.
+    """
+    return sPlanPath + ".journal"
+
+
+def get_plan_digest(sPlanPath):
+    """
+    Return the SHA-256 of the plan file, written in its journal to make sure
+    the journal belongs to the plan.
+    """
+    oHash = hashlib.sha256()
+    with open(sPlanPath, "rb") as f:
+        for sBlock in iter(lambda: f.read(COPY_BLOCK_SIZE), b""):
+            oHash.update(sBlock)
+    return oHash.hexdigest()
+
+
+def read_journal(sJournalPath, sPlanDigest):
+    """
+    Return the tuple (set of the entries of the plan already processed, set
+    of the entries whose copy was started) according to the journal
+    sJournalPath, or None if the journal belongs to another plan. A line cut
+    by a crash at the end of the journal is ignored.
+    """
+    setDone = set()
+    setStarted = set()
+    if not os.path.exists(sJournalPath):
+        return setDone, setStarted
+    with open(sJournalPath) as f:
+        for i, sLine in enumerate(f):
+            try:
+                dLine = json.loads(sLine)
+            except ValueError:
+                continue
+            if i == 0:
+                if dLine.get("plan") != sPlanDigest:
+                    return None
+            elif "started" in dLine:
+                setStarted.update(dLine["started"])
+            else:
+                setDone.add(dLine["entry"])
+    return setDone, setStarted
+
+
+def is_entry_applied(dEntry, bMove):
+    """
+    Tell if the entry dEntry of a plan was applied by a run which stopped
+    before writing it in the journal: the destination is the source image,
+    with its size and modification time, and the source is gone for a move.
+    """
+    try:
+        st = os.stat(dEntry["destination"])
+    except OSError:
+        return False
+    if st.st_size != dEntry["size"] or st.st_mtime_ns != dEntry["mtime_ns"]:
+        return False
+    return not bMove or not os.path.lexists(dEntry["source"])
+
+
+def is_partial_copy(sPath, sSourcePath):
+    """
+    Tell if the regular file sPath holds the beginning, or all, of the file
+    sSourcePath, as left by a copy which was stopped before it was completed
+    and its times set. Only the destination of an entry of a plan whose copy
+    was started by a run, according to the journal, may be such a copy.
+    """
+    try:
+        if not stat.S_ISREG(os.lstat(sPath).st_mode):
+            return False
+        with open(sPath, "rb") as fPartial, open(sSourcePath, "rb") as fSource:
+            if os.fstat(fPartial.fileno()).st_size > os.fstat(fSource.fileno()).st_size:
+                return False
+            while True:
+                sBlock = fPartial.read(COPY_BLOCK_SIZE)
+                if len(sBlock) == 0:
+                    return True
+                if fSource.read(len(sBlock)) != sBlock:
+                    return False
+    except OSError:
+        return False
+
+
+def start_plan_batch(fJournal, lStarted):
+    """
+    Add the indexes lStarted of the entries of a batch whose destination does
+    not exist to the journal before copying them, so that a destination left
+    by a stopped copy can be told from a file which was already there.
+    """
+    fJournal.write(json.dumps({"started": lStarted}) + "\n")
+    fJournal.flush()
+    os.fsync(fJournal.fileno())
+
+
+def sync_plan_batch(lWritten, fJournal, lDone):
+    """
+    Make the files and directories of a batch of entries durable before
+    writing the entries in the journal: the copied files lWritten and their
+    directories are synchronized once per batch, then the indexes lDone
+    of the entries are added to the journal.
+    """
+    setDirectories = set()
+    for sPath, bCopied in lWritten:
+        setDirectories.add(os.path.dirname(sPath) or ".")
+        if bCopied:
+            fd = os.open(sPath, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+    # No directory file descriptor on Windows
+    if hasattr(os, "O_DIRECTORY"):
+        for sDirectory in setDirectories:
+            fd = os.open(sDirectory, os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+    for nEntry in lDone:
+        fJournal.write(json.dumps({"entry": nEntry}) + "\n")
+    fJournal.flush()
+    os.fsync(fJournal.fileno())
+
+
+def apply_plan(tOptions):
+    """
+    Copy, or move, the images according to the plan written by write_plan.
+    Each entry processed is added to the journal of the plan, so a run
+    stopped for any reason resumes where it stopped when the plan is applied
+    again: a destination left incomplete by the stopped run is copied again,
+    even with --no-clobber, the journal telling which copies were started
+    (see start_plan_batch). The files and directories are synchronized on disk, and the
+    journal written, every PLAN_SYNC_BATCH entries.
+    """
+    sPlanPath = tOptions.ApplyPlan
+    lEntries = read_plan(sPlanPath)
+    sJournalPath = get_journal_path(sPlanPath)
+    sPlanDigest = get_plan_digest(sPlanPath)
+    tJournal = read_journal(sJournalPath, sPlanDigest)
+    if tJournal is None:
+        raise ExifRenameError(
+            "journal '%s' does not belong to the plan '%s'. Remove it to apply the plan from the start."
+            % (sJournalPath, sPlanPath),
+            5,
+        )
+    setDone, setStarted = tJournal
+    if len(setDone) > 0:
+        my_print(
+            "Resuming the plan '%s': %s of %s entries already done"
+            % (sPlanPath, len(setDone), len(lEntries))
+        )
+
+    if tOptions.Move:
+        sMode = "Move"
+    else:
+        sMode = "Copy"
+    lPending = [i for i in range(len(lEntries)) if i not in setDone]
+    if tOptions.DryRun:
+        for i in lPending:
+            my_print(
+                "----\nProcessing [%s/%s]:" % (i + 1, len(lEntries))
+                + sMode
+                + " %s ---> %s" % (lEntries[i]["source"], lEntries[i]["destination"])
+            )
+            my_print("Dry-run mode is activated: no operation is done")
+            emit_file_event(
+                lEntries[i]["source"], lEntries[i]["destination"], sMode, True
+            )
+        return
+
+    setDirectories = set()
+    dProgress = start_progress(sMode, len(lPending))
+    bNewJournal = not os.path.exists(sJournalPath)
+    with open(sJournalPath, "a") as fJournal:
+        if bNewJournal:
+            fJournal.write(json.dumps({"plan": sPlanDigest}) + "\n")
+        for j in range(0, len(lPending), PLAN_SYNC_BATCH):
+            dBatch = {}
+            lWritten = []
+            lDone = []
+            lStarted = []
+            for i in lPending[j : j + PLAN_SYNC_BATCH]:
+                dEntry = lEntries[i]
+                sOldPath = dEntry["source"]
+                sNewPath = dEntry["destination"]
+                if is_entry_applied(dEntry, tOptions.Move):
+                    my_print("Already done: %s ---> %s" % (sOldPath, sNewPath), VERBOSE)
+                    lDone.append(i)
+                    continue
+                try:
+                    st = os.stat(sOldPath)
+                except OSError:
+                    st = None
+                if (
+                    st is None
+                    or st.st_size != dEntry["size"]
+                    or st.st_mtime_ns != dEntry["mtime_ns"]
+                ):
+                    my_print(
+                        "File '%s' is missing or changed since the plan was written. Skipping."
+                        % (sOldPath)
+                    )
+                    record_error("plan_source_changed", sOldPath)
+                    lDone.append(i)
+                    continue
+                # A copy stopped by a previous run is done again, whereas
+                # another file is kept with --no-clobber
+                if (
+                    i in setStarted
+                    and os.path.lexists(sNewPath)
+                    and is_partial_copy(sNewPath, sOldPath)
+                ):
+                    my_print(
+                        "Removing '%s', left by a copy which was stopped" % (sNewPath),
+                        VERBOSE,
+                    )
+                    os.remove(sNewPath)
+                if not os.path.lexists(sNewPath):
+                    lStarted.append(i)
+                sDirectory = os.path.dirname(sNewPath)
+                if sDirectory not in setDirectories:
+                    if sDirectory != "" and not os.path.exists(sDirectory):
+                        os.makedirs(sDirectory)
+                    setDirectories.add(sDirectory)
+                dBatch[sOldPath] = (i, sNewPath)
+
+            if len(lStarted) > 0:
+                start_plan_batch(fJournal, lStarted)
+            dPath = dict((k, v[1]) for k, v in dBatch.items())
+            if tOptions.DiskOrder and len(set(dPath.keys()) & set(dPath.values())) == 0:
+                dBatch = dict(sort_on_disk(dBatch.items(), operator.itemgetter(0)))
+                dPath = dict((k, v[1]) for k, v in dBatch.items())
+            iDone = iter_copy_images(
+                dPath, tOptions.Move, tOptions.NoClobber, tOptions.CopyJobs
+            )
+            for (sOldPath, (i, sNewPath)), bDone in zip(dBatch.items(), iDone):
+                if not bDone:
+                    my_print(
+                        "File '%s' already exists and --no-clobber option activated. Skipping renaming of '%s'."
+                        % (sNewPath, sOldPath),
+                        True,
+                    )
+                    record_error("no_clobber_skip", sOldPath)
+                else:
+                    my_print(
+                        "----\nProcessing [%s/%s]:" % (i + 1, len(lEntries))
+                        + sMode
+                        + " %s ---> %s" % (sOldPath, sNewPath),
                         VERBOSE,
                     )
-                    my_print("----", VERBOSE)
-                else:
-                    dNewPathUnique[sOldImagePathWithSameExif] = sNewImagePathUnique
-                i = i + 1
-                my_print(
-                    "Associating\n %s --> %s"
-                    % (sOldImagePathWithSameExif, sNewImagePathUnique),
-                    VERBOSE,
-                )
-            my_print("----", VERBOSE)
+                    lWritten.append((sNewPath, not tOptions.Move))
+                    if tOptions.Move:
+                        lWritten.append((sOldPath, False))
+                    count_in_stats("copy", 1, lEntries[i]["size"])
+                    emit_file_event(sOldPath, sNewPath, sMode)
+                lDone.append(i)
+            sync_plan_batch(lWritten, fJournal, lDone)
+            update_progress(dProgress, len(lDone))
+    end_progress(dProgress)
+
 
-    return dNewPathUnique
+def parse_shard(sShard):
+    """
+    Return the tuple (shard, number of shards) of the shard sShard, "i/N"
+    with i from 1 to N. Raise ExifRenameError if sShard is not valid.
+    """
+    try:
+        nShard, nShards = [int(s) for s in sShard.split("/")]
+    except ValueError:
+        nShard, nShards = 0, 0
+    if nShards < 1 or nShard < 1 or nShard > nShards:
+        raise ExifRenameError(
+            "shard '%s' should be of the form i/N, with i from 1 to N." % (sShard), 7
+        )
+    return nShard, nShards
 
 
-def duplicate_images(dPath, tOptions):
+def get_shard(sKey, nShards):
     """
-    Here is the place where the images file are duplicated, copied or moved.
+    Return the shard, from 1 to nShards, of the destination key sKey. The
+    shard only depends on the key, so it is the same on every machine.
     """
+    sDigest = hashlib.blake2b(
+        sKey.encode("utf-8", "surrogateescape"), digest_size=8
+    ).digest()
+    return int.from_bytes(sDigest, "big") % nShards + 1
 
-    # If requested, copy the input tree in the output directory
-    if tOptions.CopyTree or tOptions.DateDirectory:
-        for sNewPath in list(dPath.values()):
-            sDirectory = os.path.dirname(sNewPath)
-            if not os.path.exists(sDirectory):
-                os.makedirs(sDirectory)
 
-    i = 1
-    nNbrImages = len(list(dPath.keys()))
-    if tOptions.Move:
-        sMode = "Move"
-    else:
-        sMode = "Copy"
-    for sOldPath in list(dPath.keys()):
-        sNewPath = dPath[sOldPath]
-        if tOptions.NoClobber and os.path.exists(sNewPath):
-            my_print(
-                "File '%s' already exists and --no-clobber option activated. Skipping renaming of '%s'."
-                % (sNewPath, sOldPath),
-                True,
+def select_shard_records(lRecords, tOptions):
+    """
+    Return the records of lRecords of the shard tOptions.Shard. The shard of
+    an image is given by its new path before the collision suffix, relative
+    to the output directory: all the images which may collide are in the
+    same shard, which gives them the names of a run with no shards.
+    """
+    nShard, nShards = parse_shard(tOptions.Shard)
+    lShardRecords = []
+    for oRecord in lRecords:
+        sKey = os.path.relpath(get_record_new_path(oRecord), tOptions.OutputDirectory)
+        if get_shard(sKey, nShards) == nShard:
+            lShardRecords.append(oRecord)
+    my_print(
+        "Shard %s: %s of %s images"
+        % (tOptions.Shard, len(lShardRecords), len(lRecords)),
+        VERBOSE,
+    )
+
+    return lShardRecords
+
+
+def exif_rename_files_batch(tOptions, dIndex=None):
+    """
+    Default mode: scan the input, read the EXIF information of all the images,
+    then copy them. Returns the dictionnary of the images processed (key: old
+    path, value: new path). dIndex is the destination index, kept up to date.
+    All the stages share the records of the images, see ImageRecord.
+    """
+
+    # Get all the images
+    with measure_phase("scan"):
+        lRecords = get_image_records(tOptions)
+
+    if len(lRecords) == 0:
+        my_print("No image file identified.")
+        return {}
+
+    # Extract the EXIF information for all images
+    with measure_phase("extraction"):
+        lRecords = read_records_exif(sort_records(lRecords), tOptions)
+
+    with measure_phase("planning"):
+        # Create the path where the file will be copied
+        lRecords = create_records_new_path(lRecords, tOptions)
+        dLibrary = None
+        if tOptions.Against is not None:
+            # The images already imported in the library are skipped
+            with measure_phase("library"):
+                dLibrary = get_library_index(tOptions.Against)
+            lRecords = skip_library_records(lRecords, dLibrary)
+        if tOptions.MaxDirEntries is not None:
+            split_date_directories(
+                lRecords, get_date_layout(tOptions), tOptions.MaxDirEntries
             )
-        else:
-            sProcessing = "----\nProcessing [%s/%s]:" % (i, nNbrImages)
-            my_print(sProcessing + sMode + " %s ---> %s" % (sOldPath, sNewPath))
-            if tOptions.DryRun:
-                my_print("Dry-run mode is activated: no operation is done")
-            elif not tOptions.Move:
-                shutil.copy2(sOldPath, sNewPath)
-            else:
-                shutil.move(sOldPath, sNewPath)
-        my_print("----", VERBOSE)
-        i = i + 1
+        if tOptions.Shard is not None:
+            lRecords = select_shard_records(lRecords, tOptions)
+        nNbrPlanned = len(lRecords)
+
+        # Remove any possible collision by adding a suffix in the file name of image having the same Exif and destination
+        if dIndex is None:
+            dIndex = {}
+        lRecords = get_unique_records_path(lRecords, dIndex, tOptions.Dedupe, dLibrary)
+    count_in_stats("planning", nNbrPlanned)
+
+    # The plan is written to be applied later
+    if tOptions.WritePlan is not None:
+        write_plan(lRecords, tOptions.WritePlan, tOptions.Shard)
+        return RecordPaths(lRecords)
 
+    # Duplicate files, then link the identical ones to them
+    lCopies = [oRecord for oRecord in lRecords if oRecord.oOriginal is None]
+    lLinks = [oRecord for oRecord in lRecords if oRecord.oOriginal is not None]
+    with measure_phase("copy"):
+        duplicate_images(
+            RecordPaths(lCopies), tOptions, dIndex, has_chained_records(lCopies)
+        )
+        if len(lLinks) > 0:
+            link_duplicate_images(lLinks, tOptions, dIndex)
+
+    return RecordPaths(lRecords)
 
-def exif_rename_files(tOptions):
+
+def exif_rename_files(tOptions, bKeepWarm=False):
     """
     Rename the files in sInputDirectory according to the EXIF information.
     Name of the file is of the form: YYYY-MM-DD_HHmm[_NN].jpg
+    With bKeepWarm, the ExifTool process and the cache are kept for the next
+    run, see close_engine.
     """
+    global dGlobalStats
 
-    # Get all the images path
-    dInputPathImages = get_images_path(tOptions)
+    # The backends are chosen again for each run
+    dGlobalBackends.clear()
+    if tOptions.Verify is not None:
+        open_verify(tOptions.Verify)
+    else:
+        close_verify()
+    init_throttle(get_throttle_rates(tOptions), tOptions.ThrottleControl)
+    if tOptions.CacheFile is not None:
+        open_cache(tOptions.CacheFile, tOptions.ClearCache)
+    else:
+        # Cache kept by a previous run
+        close_cache(None)
+    if tOptions.StatsFile is not None:
+        open_stats()
+    else:
+        dGlobalStats = None
 
-    if len(list(dInputPathImages.values())) == 0:
-        my_print("No image file identified.")
-        exit(0)
+    try:
+        if tOptions.ApplyPlan is not None:
+            with measure_phase("copy"):
+                apply_plan(tOptions)
+        elif tOptions.MergePlans is not None:
+            merge_plans(tOptions)
+        elif tOptions.Watch:
+            watch_images(tOptions)
+        elif tOptions.Stream:
+            exif_rename_files_stream(tOptions)
+        else:
+            exif_rename_files_batch(tOptions)
+    finally:
+        if not bKeepWarm:
+            stop_exiftool()
+        close_archives()
+        close_verify()
+        init_throttle(None)
+        close_cache(tOptions.CacheMaxEntries, bKeepWarm)
+        if tOptions.StatsFile is not None:
+            write_stats(tOptions.StatsFile)
 
-    # Extract the EXIF information for all images
-    dExif = get_images_with_exif(list(dInputPathImages.keys()), tOptions.CpNoExif)
 
-    # Create the path where the file will be copied
-    dNewPathRaw = create_new_image_path(dExif, dInputPathImages, tOptions)
+############################################################
+# exif_rename_files as a library
+#
+#
 
-    # Remove any possible collision by adding a suffix in the file name of image having the same Exif and destination
-    dNewPathUnique = get_unique_path_for_images(dNewPathRaw)
 
-    # If requested, copy the input tree in the output directory
-    if tOptions.CopyTree:
-        for sNewPath in list(dNewPathUnique.values()):
-            sDirectory = os.path.dirname(sNewPath)
-            if not os.path.exists(sDirectory):
-                os.makedirs(sDirectory)
+def get_default_options(lInput=None, **dOptions):
+    """
+    Return the options of a run, as given by the command line without any
+    argument, with the input lInput and the options of dOptions. The names
+    of the options are those of the command line options (see get_parser),
+    for example OutputDirectory, Recursive or Move.
+    Raise TypeError if an option does not exist.
+    """
+    tOptions = get_parser().parse_args([])
+    if lInput is not None:
+        tOptions.Input = list(lInput)
+    for sName, value in dOptions.items():
+        if not hasattr(tOptions, sName):
+            raise TypeError("Unknown option '%s'" % (sName))
+        setattr(tOptions, sName, value)
+
+    return tOptions
+
+
+def iter_rename_files(tOptions, bKeepWarm=True):
+    """
+    Rename the files according to the options tOptions, see
+    get_default_options, and yield the events of the run as they happen.
+    Each event is a dictionnary whose key "event" gives its type:
+    * "phase": a phase starts, "phase" is its name and "total" its number of
+      files, None if unknown
+    * "file": an image got its new path, with "source", "destination",
+      "action" ("copy", "move" or "link") and "dry_run"
+    * "duplicate": the image "path" is skipped by --dedupe, being identical
+      to "original"
+    * "error": "error" is the kind of error, as in the statistics, and
+      "path" the file concerned, None if unknown
+    Nothing is printed, unless tOptions.Verbosity is True, and the verbosity
+    is restored at the end of the run. If the iteration
+    is stopped, the run stops at its next event. Raise ExifRenameError if the
+    options are not valid or the run fails. With bKeepWarm, the ExifTool
+    process and the cache are kept for the next run, until close_engine is
+    called. The runs of a process are done one at a time.
+    """
+    check_options(tOptions)
+    qEvents = queue.Queue(STREAM_QUEUE_SIZE * STREAM_CHUNK_SIZE)
+    evStop = threading.Event()
+    lErrors = []
+
+    def put_event(dEvent):
+        if not put_in_stream(qEvents, dEvent, evStop):
+            raise RunStopped()
 
-    # Duplicate files
-    duplicate_images(dNewPathUnique, tOptions)
+    def run():
+        global fGlobalEventSink
+        with oGlobalRunLock:
+            fGlobalEventSink = put_event
+            # The verbosity of the caller is restored, even when the
+            # iteration is stopped
+            nVerbosity = nGlobalVerbosity
+            try:
+                if tOptions.Verbosity:
+                    set_verbosity(VERBOSE)
+                else:
+                    set_verbosity(QUIET)
+                exif_rename_files(tOptions, bKeepWarm)
+            except BaseException as inst:
+                lErrors.append(inst)
+            finally:
+                set_verbosity(nVerbosity)
+                fGlobalEventSink = None
+                put_in_stream(qEvents, None, evStop)
+
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    try:
+        for dEvent in iter(qEvents.get, None):
+            yield dEvent
+    finally:
+        evStop.set()
+        thread.join()
+    for inst in lErrors:
+        if not isinstance(inst, RunStopped):
+            raise inst
+
+
+def close_engine():
+    """
+    Stop the ExifTool process and close the cache kept by the runs of
+    iter_rename_files.
+    """
+    with oGlobalRunLock:
+        stop_exiftool()
+        close_cache(None)
 
 
 ############################################################
@@ -401,9 +5230,10 @@ def exif_rename_files(tOptions):
 #
 
 
-def get_command_line():
+def get_parser():
     """
-    Parse the command line and perform all the checks.
+    Return the parser of the command line, which also gives the default
+    options of the library.
     """
 
     parser = argparse.ArgumentParser(
@@ -436,6 +5266,24 @@ def get_command_line():
         action="store_true",
         default=False,
     )
+    parser.add_argument(
+        "--date-layout",
+        dest="DateLayout",
+        help="Layout of the date subdirectories, directories separated by '/' whose fields YYYY, MM, DD and HH are replaced by the date of the image, such as YYYY/MM/DD (default: YYYY/MM). Implies --date-subdirs",
+        metavar="LAYOUT",
+        action="store",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--max-dir-entries",
+        dest="MaxDirEntries",
+        help="With --date-subdirs, split a date directory which would hold more than N entries in subdirectories of the next date field: day, then hour, and the NoExif directory in numbered subdirectories",
+        metavar="N",
+        action="store",
+        type=int,
+        default=None,
+    )
     parser.add_argument(
         "--dry-run",
         "-t",
@@ -492,6 +5340,230 @@ def get_command_line():
         action="store_true",
         default=False,
     )
+    parser.add_argument(
+        "--jobs",
+        "-j",
+        dest="Jobs",
+        help="Number of workers listing the directories and reading the EXIF information in parallel",
+        action="store",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--jobs-backend",
+        dest="JobsBackend",
+        help="Type of the workers used by '--jobs': 'thread', 'process', or 'asyncio' to keep '--jobs' reads in flight with a few threads on a filesystem with a high latency",
+        action="store",
+        choices=["thread", "process", "asyncio"],
+        default="thread",
+    )
+    parser.add_argument(
+        "--read-timeout",
+        dest="ReadTimeout",
+        help="With '--jobs-backend asyncio', handle an image whose opening or reading takes more than SECONDS, from the start of the call, as an image with no EXIF",
+        metavar="SECONDS",
+        action="store",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--disk-order",
+        dest="DiskOrder",
+        help="Read and copy the files in the order of their position on the disk instead of the order of their path, so a rotational disk reads them almost sequentially. The new file names do not change",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--max-read-mbps",
+        dest="MaxReadMbps",
+        help="Read at most MBPS megabytes per second, for all the workers reading the EXIF information and copying the files",
+        metavar="MBPS",
+        action="store",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--max-write-mbps",
+        dest="MaxWriteMbps",
+        help="Write at most MBPS megabytes per second, for all the workers copying the files",
+        metavar="MBPS",
+        action="store",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--max-files-per-sec",
+        dest="MaxFilesPerSec",
+        help="Open, copy, move or link at most N files per second, for all the workers",
+        metavar="N",
+        action="store",
+        type=float,
+        default=None,
+    )
+    parser.add_argument(
+        "--throttle-control",
+        dest="ThrottleControl",
+        help="JSON file read again each second when it changes, to change the limits during the run: its keys 'max_read_mbps', 'max_write_mbps' and 'max_files_per_sec' replace the options of the same name, null removing a limit",
+        metavar="CONTROLFILE",
+        action="store",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--backend",
+        dest="Backend",
+        help="Reader of the EXIF dates: 'native' (the headers read by the script), 'exifread', 'piexif', 'exiftool', or 'auto' to choose for each type of file the fastest one giving the same dates as the default readers on its first files. The files a backend cannot read, and the types it does not read, are read by the default readers: 'native' then 'exifread' for the images, 'native' then 'exiftool' for the videos",
+        action="store",
+        choices=["auto"] + list(BACKENDS),
+        default=None,
+    )
+    parser.add_argument(
+        "--copy-jobs",
+        dest="CopyJobs",
+        help="Number of files copied or moved in parallel",
+        action="store",
+        type=int,
+        default=1,
+    )
+    parser.add_argument(
+        "--stream",
+        dest="Stream",
+        help="Copy or move the files while the EXIF information of the next ones is read, instead of reading all the files first",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--watch",
+        "-w",
+        dest="Watch",
+        help="Once the files in the input directories are processed, wait for new files and process them as they arrive. Stop with Ctrl-C",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--cache",
+        dest="CacheFile",
+        help="Keep the EXIF information and the directory listings in a cache, so the files which did not change are not read again. The cache is stored in '%s'"
+        % (get_default_cache_path()),
+        action="store_const",
+        const=get_default_cache_path(),
+        default=None,
+    )
+    parser.add_argument(
+        "--cache-file",
+        dest="CacheFile",
+        help="Same as '--cache', with the cache stored in CACHEFILE",
+        metavar="CACHEFILE",
+        action="store",
+        type=str,
+    )
+    parser.add_argument(
+        "--cache-max-entries",
+        dest="CacheMaxEntries",
+        help="Maximum number of files kept in the cache, the least recently used are removed first (default: %s)"
+        % (CACHE_MAX_ENTRIES),
+        action="store",
+        type=int,
+        default=CACHE_MAX_ENTRIES,
+    )
+    parser.add_argument(
+        "--clear-cache",
+        dest="ClearCache",
+        help="Empty the cache before using it",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--write-plan",
+        dest="WritePlan",
+        help="Write the copies or moves to do in PLANFILE instead of doing them, to apply them later with '--apply-plan'",
+        action="store",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--apply-plan",
+        dest="ApplyPlan",
+        help="Copy or move the files according to PLANFILE, written by '--write-plan', instead of looking for files. The progress is kept in a journal, so a stopped run resumes where it stopped",
+        action="store",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--shard",
+        dest="Shard",
+        help="Process only the shard i of N of the images, to split a run between N machines. The images which may get the same name are in the same shard, so the names are those of a single run",
+        metavar="i/N",
+        action="store",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--merge-plans",
+        dest="MergePlans",
+        help="Verify that the plans written by the shards with '--write-plan' do not overlap, and merge them in the plan given by '--write-plan' if provided",
+        metavar="PLANFILE",
+        action="store",
+        nargs="+",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--dedupe",
+        dest="Dedupe",
+        help="Do not copy or move a file identical to another one with the same date, or to a file already in the destination: skip it",
+        action="store_const",
+        const="skip",
+        default=None,
+    )
+    parser.add_argument(
+        "--dedupe-link",
+        dest="Dedupe",
+        help="Same as '--dedupe', but give the new name of a file skipped as a hard link to the identical file",
+        action="store_const",
+        const="link",
+    )
+    parser.add_argument(
+        "--verify",
+        dest="Verify",
+        help="Compute the digest of each file copied while it is copied, then read the copy again from the disk and compare its digest, before removing the original of a move. Stop at the first copy which differs, with exit status 9",
+        action="store_const",
+        const="",
+        default=None,
+    )
+    parser.add_argument(
+        "--verify-manifest",
+        dest="Verify",
+        help="Same as '--verify', with the digests appended to MANIFEST, one JSON line per file",
+        metavar="MANIFEST",
+        action="store",
+        type=str,
+    )
+    parser.add_argument(
+        "--against",
+        dest="Against",
+        help="Skip the images already imported in the library LIBRARY, a directory tree of files named by this script: an image is skipped if a file of the library has its new name, alone or with a '_N' suffix, its size and the same beginning. The numbering of the other images continues after the largest suffix used in the library. With --cache, only the directories of the library which changed are listed again",
+        metavar="LIBRARY",
+        action="store",
+        type=str,
+        default=None,
+    )
+    parser.add_argument(
+        "--stats",
+        dest="StatsFile",
+        help="When the run finishes, write in JSON in the standard output the time, files and bytes of each phase, the extraction latency and the number of errors",
+        action="store_const",
+        const="-",
+        default=None,
+    )
+    parser.add_argument(
+        "--stats-file",
+        dest="StatsFile",
+        help="Same as '--stats', with the statistics written in STATSFILE",
+        metavar="STATSFILE",
+        action="store",
+        type=str,
+    )
     parser.add_argument(
         "--version",
         "-V",
@@ -501,6 +5573,181 @@ def get_command_line():
         default=False,
     )
 
+    return parser
+
+
+def check_options(tOptions):
+    """
+    Perform all the checks of the options tOptions. Raise ExifRenameError,
+    with the exit status of the command line, if they are not valid.
+    """
+
+    # Verify is Copy Tree is provided but without any place to copy the output, or if the input is
+    #  files and not a directroy
+    if tOptions.CopyTree and tOptions.OutputDirectory is None:
+        raise ExifRenameError(
+            "option '--copy-recursive-tree' should be used with '--output-directory'. Please provide an output directory or do not use this option.",
+            2,
+        )
+    # Verify it the output is a directory
+    if tOptions.OutputDirectory is not None and not os.path.isdir(
+        tOptions.OutputDirectory
+    ):
+        raise ExifRenameError(
+            "Directory '%s' provided in '--output-directory' does not exist or is not a directory. Please provide a valid output directory."
+            % (tOptions.OutputDirectory),
+            3,
+        )
+
+    # Verify the date subdirectories
+    if tOptions.DateLayout is not None and any(
+        s in ("", ".", "..") or os.sep in s for s in tOptions.DateLayout.split("/")
+    ):
+        raise ExifRenameError(
+            "option '--date-layout' should be relative directories separated by '/', such as 'YYYY/MM/DD'.",
+            3,
+        )
+    if tOptions.MaxDirEntries is not None and (
+        tOptions.MaxDirEntries < 1
+        or tOptions.OutputDirectory is None
+        or get_date_layout(tOptions) is None
+        or tOptions.Stream
+        or tOptions.Watch
+    ):
+        raise ExifRenameError(
+            "option '--max-dir-entries' should be a positive number used with '--output-directory' and '--date-subdirs', and cannot be used with '--stream' or '--watch'.",
+            3,
+        )
+
+    # Verify the archive inputs
+    if any(is_archive(s) and os.path.isfile(s) for s in tOptions.Input or []) and (
+        tOptions.OutputDirectory is None
+        or tOptions.Move
+        or tOptions.Watch
+        or tOptions.WritePlan is not None
+    ):
+        raise ExifRenameError(
+            "the images of a zip or tar archive are copied out of the archive, it should be used with '--output-directory', and cannot be used with '--move', '--watch' or '--write-plan'.",
+            2,
+        )
+
+    # Verify the number of workers
+    if tOptions.Jobs < 1 or tOptions.CopyJobs < 1:
+        raise ExifRenameError(
+            "options '--jobs' and '--copy-jobs' should be a positive number of workers.",
+            4,
+        )
+    if tOptions.ReadTimeout is not None and (
+        tOptions.ReadTimeout <= 0 or tOptions.JobsBackend != "asyncio"
+    ):
+        raise ExifRenameError(
+            "option '--read-timeout' should be a positive number of seconds, used with '--jobs-backend asyncio'.",
+            4,
+        )
+
+    # Verify the limits
+    for nLimit in (
+        tOptions.MaxReadMbps,
+        tOptions.MaxWriteMbps,
+        tOptions.MaxFilesPerSec,
+    ):
+        if nLimit is not None and nLimit <= 0:
+            raise ExifRenameError(
+                "options '--max-read-mbps', '--max-write-mbps' and '--max-files-per-sec' should be positive.",
+                4,
+            )
+
+    # Verify the files written during the run, before any work is done
+    for sOption, sPath in (
+        ("--cache-file", tOptions.CacheFile),
+        ("--verify-manifest", tOptions.Verify),
+        ("--stats-file", tOptions.StatsFile),
+    ):
+        if sPath and os.path.isdir(sPath):
+            raise ExifRenameError(
+                "option '%s' should be a file, '%s' is a directory." % (sOption, sPath),
+                4,
+            )
+
+    # Verify the backend
+    if (
+        tOptions.Backend is not None
+        and tOptions.Backend != "auto"
+        and not BACKENDS[tOptions.Backend].probe()
+    ):
+        raise ExifRenameError(
+            "backend '%s' given in '--backend' is not installed." % (tOptions.Backend),
+            4,
+        )
+
+    # Verify the plan options
+    if tOptions.WritePlan is not None and (
+        tOptions.ApplyPlan is not None or tOptions.Stream or tOptions.Watch
+    ):
+        raise ExifRenameError(
+            "option '--write-plan' cannot be used with '--apply-plan', '--stream' or '--watch'.",
+            5,
+        )
+    if tOptions.ApplyPlan is not None and (
+        tOptions.Input or tOptions.Stream or tOptions.Watch
+    ):
+        raise ExifRenameError(
+            "option '--apply-plan' takes the files from the plan, it cannot be used with an input, '--stream' or '--watch'.",
+            5,
+        )
+
+    # Verify the shard options
+    if tOptions.Shard is not None:
+        parse_shard(tOptions.Shard)
+        if (
+            tOptions.OutputDirectory is None
+            or tOptions.ApplyPlan is not None
+            or tOptions.Stream
+            or tOptions.Watch
+        ):
+            raise ExifRenameError(
+                "option '--shard' should be used with '--output-directory', and cannot be used with '--apply-plan', '--stream' or '--watch'.",
+                7,
+            )
+    if tOptions.MergePlans is not None and (
+        tOptions.Input
+        or tOptions.ApplyPlan is not None
+        or tOptions.Shard is not None
+        or tOptions.Stream
+        or tOptions.Watch
+    ):
+        raise ExifRenameError(
+            "option '--merge-plans' takes the files from the plans, it cannot be used with an input, '--apply-plan', '--shard', '--stream' or '--watch'.",
+            7,
+        )
+
+    # Verify the dedupe options
+    if tOptions.Dedupe is not None and (tOptions.Stream or tOptions.Watch):
+        raise ExifRenameError(
+            "option '--dedupe' cannot be used with '--stream' or '--watch'.",
+            6,
+        )
+    if tOptions.Against is not None and (
+        not os.path.isdir(tOptions.Against) or tOptions.Stream or tOptions.Watch
+    ):
+        raise ExifRenameError(
+            "option '--against' should be an existing directory, and cannot be used with '--stream' or '--watch'.",
+            6,
+        )
+    if tOptions.Dedupe == "link" and tOptions.WritePlan is not None:
+        raise ExifRenameError(
+            "option '--dedupe-link' cannot be used with '--write-plan', use '--dedupe'.",
+            6,
+        )
+
+
+def get_command_line():
+    """
+    Parse the command line and perform all the checks.
+    """
+
+    parser = get_parser()
+
     # Parse the args
     options = parser.parse_args()
 
@@ -515,29 +5762,17 @@ def get_command_line():
         print("Written by Miguel Tremblay, http://ptaff.ca/miguel/")
         exit(0)
 
-    # Verify is Copy Tree is provided but without any place to copy the output, or if the input is
-    #  files and not a directroy
-    if options.CopyTree and options.OutputDirectory is None:
-        print(
-            "Error: option '--copy-recursive-tree' should be used with '--output-directory'. Please provide an output directory or do not use this option. Exiting."
-        )
-        exit(2)
-    # Verify it the output is a directory
-    if options.OutputDirectory is not None and not os.path.isdir(
-        options.OutputDirectory
-    ):
-        print(
-            "Error: Directory '%s' provided in '--output-directory' does not exist or is not a directory. Please provide a valid output directory. Exiting."
-            % (options.OutputDirectory)
-        )
-        exit(3)
+    try:
+        check_options(options)
+    except ExifRenameError as inst:
+        print("Error: %s Exiting." % (inst))
+        exit(inst.nExitCode)
 
     # Set the global verbosity
-    global nGlobalVerbosity
     if options.Verbosity:
-        nGlobalVerbosity = VERBOSE
+        set_verbosity(VERBOSE)
     else:
-        nGlobalVerbosity = NORMAL
+        set_verbosity(NORMAL)
 
     my_print(
         "Verbosity level is set to: " + str(nGlobalVerbosity), nMessageVerbosity=VERBOSE
@@ -551,4 +5786,8 @@ def get_command_line():
 
 if __name__ == "__main__":
     tOptions = get_command_line()
-    exif_rename_files(tOptions)
+    try:
+        exif_rename_files(tOptions)
+    except ExifRenameError as inst:
+        print("Error: %s Exiting." % (inst))
+        exit(inst.nExitCode)
@@ -6,7 +6,7 @@ import argparse
 import shutil
 import piexif
 
-def rename_photo(src_path, dst_path, move=False, verbose=False):
+def rename_photo(src_path, dst_path, move=False, verbose=False, exif_data=None):
     """Rename a photo file based on its EXIF data.
 
     Args:
@@ -14,15 +14,18 @@ def rename_photo(src_path, dst_path, move=False, verbose=False):
         dst_path (str): The destination file path.
         move (bool, optional): If True, move the file instead of copying it.
         verbose (bool, optional): If True, print verbose output.
+        exif_data (dict, optional): The EXIF data of the file, as returned by
+            piexif.load. The file is parsed only if it is not given.
     """
     if verbose:
         print(f"Processing file {src_path}")
     # Load EXIF data
-    try:
-        exif_data = piexif.load(src_path)
-    except piexif.InvalidImageDataError:
-        # EXIF data not found or invalid, skip the file
-        return
+    if exif_data is None:
+        try:
+            exif_data = piexif.load(src_path)
+        except piexif.InvalidImageDataError:
+            # EXIF data not found or invalid, skip the file
+            return
 
     # Extract date and time from EXIF data
     date_time_original = exif_data["Exif"][piexif.ExifIFD.DateTimeOriginal].decode()
@@ -79,8 +82,8 @@ def process_file(filepath, dst_path, move=False, verbose=False):
             if verbose:
                 print(f"EXIF data not found in {filepath}")
         else:
-            # EXIF data found, rename the file
-            rename_photo(filepath, dst_path, move=move, verbose=verbose)
+            # EXIF data found, rename the file without parsing it again
+            rename_photo(filepath, dst_path, move=move, verbose=verbose, exif_data=exif_data)
     else:
         if verbose:
             print(f"{filepath} is not a JPEG file, skipping.")